@@ -1,27 +1,258 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
-from flask import Flask, jsonify, request, render_template
+import time
+# Startup is timed from here, so the imports below count towards it
+import_started = time.monotonic()
+from flask import Flask, g, request, render_template
 import boto3
 import os
-from interactions import Interactions
+from interactions import Interactions, make_timestamp, parse_timestamp
 from twilio.rest import Client
-from datetime import datetime, timezone
-import time
-import openai
+from twilio.request_validator import RequestValidator
 import random
-from chatapp import ChatApp
+import signal
+import sys
+import atexit
+from chatapp import ChatApp, count_tokens, turn_tokens
+from llm_client import get_client
+from cache import LRUCache, RedisCache
+from response_cache import ResponseCache
+from pipeline import ReplyPipeline
+from delivery import DeliveryTracker
+from segmenter import WHATSAPP_MAX_CHARS, SentenceSegmenter, split_message
+from sender import WhatsAppSender
+from router import ModelRouter
+from idempotency import IdempotencyStore
+from coalescer import MessageCoalescer
+from write_behind import WriteBehindBuffer
+from compact_interactions import CompactInteractions
+from memory_interactions import MemoryInteractions
+from sqlite_interactions import SqliteInteractions
+from metrics import CONTENT_TYPE, Counter, Gauge, Histogram, Registry
+from tracing import JsonFormatter, TraceIdFilter, new_trace_id, reset_trace_id, set_trace_id
+from flask.logging import default_handler
+from lazy import LazyResource
+import threading
+from datetime import datetime, timezone
 
 app = Flask(__name__)
+app.logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+# Every log line of a message carries its trace ID; LOG_FORMAT=json writes them as JSON lines
+default_handler.addFilter(TraceIdFilter())
+if os.environ.get("LOG_FORMAT", "text") == "json":
+  default_handler.setFormatter(JsonFormatter())
 
-dynamodb = boto3.resource("dynamodb",region_name=os.environ["AWS_REGION"])
+FOLLOW_UP = 'Please feel free to ask a follow up question.'
+# Starts the result of a message answered with a canned reply because the model failed
+LLM_FAILED = "model reply failed"
+
+# Send answers chunk by chunk while the model is still generating them
+stream_replies = os.environ.get("STREAM_REPLIES", "false").lower() == "true"
+
+# Where interactions are kept: "dynamodb", or "memory" / "sqlite" to run without network I/O
+storage_backend = os.environ.get("STORAGE_BACKEND", "dynamodb")
 table = os.environ["DDB_TABLE"]
-interactions = Interactions(dynamodb, logger=app.logger)
 
-if not interactions.exists(table):
-  interactions.create_table(table)
+# Cache each phone's conversation so follow-up messages skip the DynamoDB query.
+# An in-process cache goes stale as soon as another process stores a turn for
+# the phone, so it is opt-in and only used when this is the only process.
+history_cache = None
+if os.environ.get("HISTORY_CACHE_REDIS_URL"):
+  history_cache = RedisCache(os.environ["HISTORY_CACHE_REDIS_URL"], ttl=int(os.environ.get("HISTORY_CACHE_TTL", "300")), prefix="history:")
+elif int(os.environ.get("HISTORY_CACHE_SIZE", "0")) > 0:
+  if int(os.environ.get("APP_PROCESSES", "1")) > 1:
+    app.logger.warning("HISTORY_CACHE_SIZE is ignored with more than one worker; set HISTORY_CACHE_REDIS_URL to cache histories")
+  else:
+    history_cache = LRUCache(max_size=int(os.environ["HISTORY_CACHE_SIZE"]), ttl=int(os.environ.get("HISTORY_CACHE_TTL", "300")))
+
+# Answer questions asked before in the same context without calling the model
+response_cache = None
+if os.environ.get("RESPONSE_CACHE", "false").lower() == "true":
+  if os.environ.get("RESPONSE_CACHE_REDIS_URL"):
+    responses = RedisCache(os.environ["RESPONSE_CACHE_REDIS_URL"], ttl=int(os.environ.get("RESPONSE_CACHE_TTL", "86400")), prefix="response:")
+  else:
+    responses = LRUCache(max_size=int(os.environ.get("RESPONSE_CACHE_SIZE", "1000")), ttl=int(os.environ.get("RESPONSE_CACHE_TTL", "86400")))
+  response_cache = ResponseCache(responses, shared_max_turns=int(os.environ.get("RESPONSE_CACHE_SHARED_TURNS", "1")))
+
+
+def make_interactions():
+  """Creates the interactions store. The table is provisioned by bootstrap.py, so no request is made here."""
+  if storage_backend == "memory":
+    interactions = MemoryInteractions(logger=app.logger, cache=history_cache)
+  elif storage_backend == "sqlite":
+    interactions = SqliteInteractions(os.environ.get("SQLITE_PATH", "interactions.db"), logger=app.logger, cache=history_cache)
+  else:
+    dynamodb = boto3.resource("dynamodb",region_name=os.environ["AWS_REGION"])
+    if os.environ.get("INTERACTIONS_LAYOUT", "items") == "compact":
+      # One item per conversation with a compressed transcript
+      interactions = CompactInteractions(dynamodb, logger=app.logger, cache=history_cache, codec=os.environ.get("COMPACT_CODEC", "zlib"))
+    else:
+      interactions = Interactions(dynamodb, logger=app.logger, cache=history_cache)
+    # Optionally batch interaction writes in the background instead of one put per reply
+    if os.environ.get("WRITE_BEHIND", "false").lower() == "true" and type(interactions) is Interactions:
+      interactions.write_behind = WriteBehindBuffer(
+        dynamodb,
+        table,
+        batch_size=int(os.environ.get("WRITE_BEHIND_BATCH", "25")),
+        flush_interval=float(os.environ.get("WRITE_BEHIND_INTERVAL", "1")),
+        max_buffer=int(os.environ.get("WRITE_BEHIND_MAX_BUFFER", "10000")),
+        logger=app.logger,
+      )
+      interactions.write_behind.start()
+  interactions.use_table(table)
+  return interactions
+
+
+def make_idempotency():
+  """Creates the MessageSid store, kept in the interactions table when it is in DynamoDB."""
+  interactions = lazy_interactions.get()
+  return IdempotencyStore(
+    interactions.table if isinstance(interactions, Interactions) else None,
+    ttl=int(os.environ.get("IDEMPOTENCY_TTL", "86400")),
+    lease=int(os.environ.get("IDEMPOTENCY_LEASE", "300")),
+    logger=app.logger,
+  )
+
+
+def make_delivery_tracker():
+  """Creates the delivery tracker, keeping reply statuses in the interactions table when it is in DynamoDB."""
+  interactions = lazy_interactions.get()
+  tracker = DeliveryTracker(
+    complete_delivery,
+    table=interactions.table if isinstance(interactions, Interactions) else None,
+    timeout=int(os.environ.get("DELIVERY_TIMEOUT", "120")),
+    logger=app.logger,
+  )
+  tracker.start()
+  return tracker
+
+
+def shutdown_delivery_tracker():
+  # Judges the replies still awaiting callbacks before the process exits
+  if lazy_delivery_tracker is not None and lazy_delivery_tracker.created:
+    lazy_delivery_tracker.value.stop(int(os.environ.get("PIPELINE_DRAIN_TIMEOUT", "30")))
+
+
+def record_dependency(name, seconds):
+  dependency_init_seconds.observe(seconds, dependency=name)
+
+
+# Clients are created on first use, or by the warm-up thread, instead of at import
+lazy_interactions = LazyResource("interactions", make_interactions, logger=app.logger, on_created=record_dependency)
+# Process each inbound MessageSid once, however often Twilio delivers it
+lazy_idempotency = None
+if os.environ.get("IDEMPOTENCY", "true").lower() == "true":
+  lazy_idempotency = LazyResource("idempotency", make_idempotency, logger=app.logger, on_created=record_dependency)
+lazy_twilio_client = LazyResource(
+  "twilio",
+  lambda: Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"]),
+  logger=app.logger,
+  on_created=record_dependency,
+)
+lazy_llm_client = LazyResource("openai", get_client, logger=app.logger, on_created=record_dependency)
+
+
+def shutdown_write_behind():
+  # Registered before the pipeline, so atexit flushes buffered writes after the pipeline drained
+  if lazy_interactions.created and lazy_interactions.value.write_behind is not None:
+    lazy_interactions.value.write_behind.shutdown()
+
+
+atexit.register(shutdown_write_behind)
+# atexit runs handlers in reverse, so replies awaiting callbacks are judged after the
+# pipeline drained and before buffered writes are flushed
+atexit.register(shutdown_delivery_tracker)
+
+# Optionally acknowledge the webhook at once and reply from a background worker pool.
+# Coalescing bursts of messages always replies in the background.
+pipeline = None
+if os.environ.get("REPLY_MODE", "sync") == "async" or os.environ.get("COALESCE_WINDOW"):
+  pipeline = ReplyPipeline(
+    lambda job: run_job(job),
+    workers=int(os.environ.get("PIPELINE_WORKERS", "4")),
+    max_queue=int(os.environ.get("PIPELINE_MAX_QUEUE", "100")),
+    logger=app.logger,
+  )
+  atexit.register(pipeline.shutdown, int(os.environ.get("PIPELINE_DRAIN_TIMEOUT", "30")))
+
+# Merge messages a phone sends within the window into one reply, one phone at a time
+coalescer = None
+if os.environ.get("COALESCE_WINDOW"):
+  coalescer = MessageCoalescer(
+    lambda phone, batch: pipeline.submit((phone, batch)),
+    window=float(os.environ["COALESCE_WINDOW"]),
+    max_wait=float(os.environ.get("COALESCE_MAX_WAIT", "0")) or None,
+    logger=app.logger,
+    on_drop=lambda phone, batch: release_messages([sid for _, _, _, sid in batch]),
+  )
+  # Registered after the pipeline so buffered messages reach it before it drains
+  atexit.register(coalescer.shutdown)
+
+# Send short follow-ups and hurried replies to a faster model than the main advice
+router = ModelRouter(
+  fast_model=os.environ.get("FAST_MODEL", "gpt-3.5-turbo"),
+  main_model=os.environ.get("MAIN_MODEL", "gpt-4"),
+  short_message_chars=int(os.environ.get("ROUTER_SHORT_MESSAGE_CHARS", "120")),
+  fast_below_budget=float(os.environ.get("ROUTER_FAST_BELOW_BUDGET", "10")),
+  fast_timeout=float(os.environ.get("ROUTER_FAST_TIMEOUT", "10")),
+  main_timeout=float(os.environ.get("ROUTER_MAIN_TIMEOUT", "25")),
+  logger=app.logger,
+)
+
+# Optionally track delivery through Twilio status callbacks instead of polling
+lazy_delivery_tracker = None
+if os.environ.get("STATUS_CALLBACK_URL"):
+  if storage_backend != "dynamodb" and int(os.environ.get("APP_PROCESSES", "1")) > 1:
+    # Without DynamoDB, reply statuses live in the process that sent the reply
+    raise RuntimeError("STATUS_CALLBACK_URL needs STORAGE_BACKEND=dynamodb when more than one process serves the app")
+  lazy_delivery_tracker = LazyResource("delivery", lambda: make_delivery_tracker(), logger=app.logger, on_created=record_dependency)
+
+# Prometheus metrics of the reply path, served on /metrics
+metrics = Registry()
+stage_seconds = metrics.register(Histogram("whatsapp_stage_seconds", "Seconds spent in each stage of a reply.", ["stage"]))
+reply_seconds = metrics.register(Histogram("whatsapp_reply_seconds", "Seconds to process an inbound message, from history query to stored reply."))
+first_chunk_seconds = metrics.register(Histogram("whatsapp_time_to_first_chunk_seconds", "Seconds from calling the model to sending the first reply chunk."))
+last_chunk_seconds = metrics.register(Histogram("whatsapp_time_to_last_chunk_seconds", "Seconds from calling the model to sending the last reply chunk."))
+messages_total = metrics.register(Counter("whatsapp_messages_total", "Inbound messages processed, by outcome.", ["result"]))
+twilio_sends_total = metrics.register(Counter("whatsapp_twilio_sends_total", "Reply chunks sent through Twilio."))
+response_cache_total = metrics.register(Counter("whatsapp_response_cache_total", "Model answers looked up in the response cache, by result.", ["result"]))
+dependency_init_seconds = metrics.register(Histogram("app_dependency_init_seconds", "Seconds taken to create each client.", ["dependency"]))
+if pipeline is not None:
+  metrics.register(Gauge("whatsapp_pipeline_queue_depth", "Replies waiting for a background worker.", pipeline.depth))
+if response_cache is not None:
+  metrics.register(Gauge("whatsapp_response_cache_hit_ratio", "Share of response cache lookups answered from the cache.", lambda: response_cache_hit_ratio(response_cache.stats())))
+if lazy_delivery_tracker is not None:
+  metrics.register(Gauge(
+    "whatsapp_delivery_pending",
+    "Replies sent by this process that are waiting for delivery status callbacks.",
+    lambda: lazy_delivery_tracker.value.pending() if lazy_delivery_tracker.created else 0,
+  ))
+
+
+def response_cache_hit_ratio(stats):
+  """The share of lookups that were hits, from a cache's stats()."""
+  lookups = stats["hits"] + stats["misses"]
+  return stats["hits"] / lookups if lookups else 0.0
+
+
+def observe_stage(stage, started):
+  """Records the seconds a stage of the reply took since started, a time.monotonic() value."""
+  seconds = time.monotonic() - started
+  stage_seconds.observe(seconds, stage=stage)
+  app.logger.debug(f"stage={stage} seconds={seconds:.3f}", extra={"stage": stage, "seconds": round(seconds, 4)})
+
+
+@app.before_request
+def start_trace():
+  # Webhooks are traced by their MessageSid, other requests by a random ID
+  g.trace_token = set_trace_id(new_trace_id(request.values.get("MessageSid")))
+
+
+@app.teardown_request
+def end_trace(exc):
+  if "trace_token" in g:
+    reset_trace_id(g.pop("trace_token"))
 
-# Make twilio client
-twilio_client = Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"])
 
 #Home Page
 @app.route("/")
@@ -29,11 +260,266 @@ def home():
   return render_template("index.html")
 
 
+def process_message(phone, received_message, name, timestamp):
+  """Runs the query, LLM, send and persist stages for one inbound message."""
+  interactions = lazy_interactions.get()
+  twilio_client = lazy_twilio_client.get()
+  stage_started = time.monotonic()
+  # The turns the rolling summary doesn't cover, all of them, or the newest HISTORY_LIMIT without a summary
+  previous_interaction_records, summary = interactions.query_context(phone, int(os.environ.get("HISTORY_LIMIT", "50")))
+  # A campaign's nudge isn't an exchange with the user, so it doesn't move them past the greeting or main advice
+  previous_interaction_count = sum(1 for record in previous_interaction_records if record.get("kind") != "nudge")
+  if summary is not None:
+    # The summarized turns count too; there is only a summary once there were many
+    previous_interaction_count = max(previous_interaction_count, 2)
+    if not previous_interaction_records:
+      # Every turn is summarized; the newest still names the mentor type
+      previous_interaction_records = interactions.query_history(phone, 1)
+  observe_stage("history_query", stage_started)
+  stage_started = time.monotonic()
+
+  # Get mentor type
+  if previous_interaction_count == 0:
+    mentor_type = random.choice(["local", "refugee", "AI"])
+  else:
+    mentor_type = previous_interaction_records[0]["mentor_type"]
+
+  # Send either a simple greeting, main advice, or followup advice depending on the previous_interaction_count
+  cache_key = None
+  cached_reply = None
+  if previous_interaction_count == 0:
+    started = time.monotonic()
+    message_to_send = "Hello there, please tell me your business idea, and I will provide adivce"
+  else:
+    chatapp = ChatApp(mentor_type)
+
+    # Route on the user's own words, before they are wrapped in the persona prompt
+    latency_budget = None
+    if os.environ.get("REPLY_LATENCY_BUDGET"):
+      waited = (datetime.now(timezone.utc) - parse_timestamp(timestamp)).total_seconds()
+      latency_budget = float(os.environ["REPLY_LATENCY_BUDGET"]) - waited
+    route = router.choose(received_message, previous_interaction_count, latency_budget)
+    question = received_message
+
+    # Generate response
+    if previous_interaction_count == 1:
+      if mentor_type == 'local':
+        received_message = (f"Understand and answer the question given by '{received_message}'. You are a highly integrated local entrepreneur mentor based in Kampala. \n" 
+        "You have successfully started and managed businesses in this area for many years. \n"
+        "You are well-connected, deeply understand the local market, and focus on practical solutions. \n"
+        "You believe in step-by-step approaches to entrepreneurship. Now, you are providing solutions to the question raised.\n"
+        "You guide entrepreneurs to build sustainable businesses by leveraging local resources, customer insights, and efficient planning.\n"
+        "You are continuing a detailed mentoring conversation with the user. \n"
+        "Your goal is to answer the question by providing specific, actionable, relevant advice to the questions/concerns pointed out. \n")
+      elif mentor_type == 'refugee':
+        received_message = (f"Understand and answer the question given by '{received_message}'. You are a refugee entrepreneur mentor who overcame significant challenges to build a thriving business in Kampala. \n"
+        "You understand the difficulties faced by refugees, including limited resources, unfamiliar markets, and social barriers, \n"
+        "but you firmly believe in their potential. \n"
+        "Your advice is empathetic, motivational, and aimed at fostering creativity, resilience, and ambition. "
+        "You encourage entrepreneurs to embrace bold, innovative approaches while finding ways to overcome constraints.\n\n"
+        "You are continuing a detailed mentoring conversation with the user. \n"
+        "Your goal is to answer the question by providing specific, actionable, relevant advice to the questions/concerns pointed out. \n")
+      else:
+        received_message = (f"Understand and answer the question given by '{received_message}'."
+        "You are continuing a detailed mentoring conversation with the user. \n"
+        "Your goal is to answer the question by providing specific, actionable, relevant advice to the questions/concerns pointed out. \n")
+      
+    # Add past turns under the token budget, rolling older ones into the stored summary
+    new_summary = chatapp.add_history(
+      previous_interaction_records,
+      summary=summary,
+      token_budget=int(os.environ.get("PROMPT_TOKEN_BUDGET", "6000")),
+      reserved_tokens=count_tokens(received_message),
+      # Summaries outlive the reply, so they are written by the main model whichever model answers
+      summary_model=router.main_model,
+    )
+    if new_summary is not None:
+      interactions.update_summary(phone, new_summary["summary"], new_summary["through"])
+
+    observe_stage("prompt_build", stage_started)
+
+    # Answer a question asked before in the same context from the cache
+    if response_cache is not None:
+      cache_key = response_cache.key(phone, mentor_type, question, chatapp.messages, route.model, name=name)
+      cached_reply = response_cache.get(cache_key)
+      response_cache_total.inc(result="hit" if cached_reply is not None else "miss")
+
+    #get response from the chatbot
+    started = time.monotonic()
+    if cached_reply is not None:
+      message_to_send = cached_reply + FOLLOW_UP
+    elif not stream_replies:
+      message_to_send = chatapp.chat(received_message, route=route)
+      if chatapp.failure is None:
+        message_to_send += FOLLOW_UP
+      observe_stage("llm", started)
+      app.logger.debug(f"message_to_send={message_to_send}")
+
+  # Send whatsapp return message in chunks
+  chunk_sz = int(os.environ["CHUNK_SZ"])
+  max_chars = int(os.environ.get("WHATSAPP_MAX_CHARS", str(WHATSAPP_MAX_CHARS)))
+  reply_parts = []
+  if previous_interaction_count > 0 and stream_replies and cached_reply is None:
+    chunks = stream_chunks(chatapp, received_message, route, chunk_sz, max_chars, reply_parts)
+  else:
+    chunks = split_message(message_to_send, chunk_sz, max_chars)
+  # Delivery is reported to /api/whatsapp/status instead of being polled when there is a tracker
+  reply_id = None
+  status_callback = None
+  if lazy_delivery_tracker is not None:
+    delivery_tracker = lazy_delivery_tracker.get()
+    reply_id = delivery_tracker.begin()
+    status_callback = delivery_tracker.callback_url(os.environ["STATUS_CALLBACK_URL"], reply_id)
+  sender = WhatsAppSender(
+    twilio_client,
+    os.environ["SERVER_PHONE"],
+    max_in_flight=int(os.environ.get("SEND_MAX_IN_FLIGHT", "3")),
+    max_polls=int(os.environ["K_MAX"]),
+    status_callback=status_callback,
+    on_stage=observe_stage,
+    logger=app.logger,
+  )
+  try:
+    result = sender.send(phone, chunks)
+  except Exception:
+    if reply_id is not None:
+      delivery_tracker.discard(reply_id)
+    raise
+  twilio_sends_total.inc(len(result.sids))
+  sent_at = result.sent_at
+  chunk_statuses = result.statuses
+  # Canned replies sent when the model failed are not answers
+  llm_failure = chatapp.failure if previous_interaction_count > 0 and cached_reply is None else None
+  if cache_key is not None and cached_reply is None and llm_failure is None:
+    response_cache.set(cache_key, chatapp.messages[-1]["content"])
+
+  if sent_at:
+    first_chunk_seconds.observe(sent_at[0] - started)
+    last_chunk_seconds.observe(sent_at[-1] - started)
+    app.logger.info(f"time_to_first_chunk={sent_at[0] - started:.3f}s time_to_last_chunk={sent_at[-1] - started:.3f}s for {timestamp} incoming message from {phone}")
+  if reply_parts:
+    message_to_send = "".join(reply_parts)
+  tokens = turn_tokens({"received_message": received_message, "sent_message": message_to_send})
+
+  # If a chunk was not successfully sent, delivered, or read; then return error
+  if not result.succeeded:
+    if reply_id is not None:
+      delivery_tracker.discard(reply_id)
+    server_msg = f"{result.error} for {timestamp} incoming message from {phone}"
+  elif llm_failure is not None:
+    # Don't store the canned reply as a turn, so the next message gets the answer this one should have
+    if reply_id is not None:
+      delivery_tracker.discard(reply_id)
+    server_msg = f"{LLM_FAILED} ({llm_failure}) for {timestamp} incoming message from {phone}"
+  elif reply_id is not None:
+    # Write record to dynamodb once every chunk has reached a terminal status, from
+    # whichever process receives the last status callback
+    record = {
+      "phone": phone,
+      "timestamp": timestamp,
+      "received_message": received_message,
+      "sent_message": message_to_send,
+      "mentor_type": mentor_type,
+      "name": name,
+      "tokens": tokens,
+      "tracked_at_ms": int(time.time() * 1000),
+    }
+    delivery_tracker.track(reply_id, result.sids, record, initial_statuses=chunk_statuses)
+    server_msg = "sent"
+  else:
+    server_msg = "success"
+    # Write record to dynamodb
+    stage_started = time.monotonic()
+    interactions.add_interaction(phone, timestamp, received_message, message_to_send, mentor_type, name, tokens=tokens)
+    observe_stage("add_interaction", stage_started)
+
+  return server_msg
+
+
+def complete_delivery(record, succeeded, statuses):
+  """Stores a tracked reply once every chunk has reached a terminal status."""
+  # The reply may have been sent by another process, so wait time is measured by the wall clock
+  observe_stage("delivery_wait", time.monotonic() - (time.time() - int(record["tracked_at_ms"]) / 1000))
+  if succeeded:
+    stage_started = time.monotonic()
+    lazy_interactions.get().add_interaction(
+      record["phone"], record["timestamp"], record["received_message"], record["sent_message"],
+      record["mentor_type"], record["name"], tokens=int(record["tokens"]),
+    )
+    observe_stage("add_interaction", stage_started)
+  else:
+    app.logger.error(f"delivery of response messages {statuses} failed for {record['timestamp']} incoming message from {record['phone']}")
+
+
+def release_messages(message_sids):
+  """Releases the idempotency leases of messages that weren't processed, so Twilio's retries are processed at once."""
+  if lazy_idempotency is None:
+    return
+  for sid in message_sids:
+    if sid is not None:
+      lazy_idempotency.get().release(sid)
+
+
+def run_message(phone, received_message, name, timestamp, message_sids):
+  """Processes a message and stores its result for duplicate deliveries of the same MessageSids."""
+  message_sids = [sid for sid in message_sids if sid is not None]
+  trace_token = set_trace_id(new_trace_id(message_sids[0] if message_sids else None))
+  started = time.monotonic()
+  try:
+    server_msg = process_message(phone, received_message, name, timestamp)
+  except Exception:
+    messages_total.inc(result="error")
+    # Let a retry of the message process it again
+    release_messages(message_sids)
+    raise
+  finally:
+    reply_seconds.observe(time.monotonic() - started)
+    reset_trace_id(trace_token)
+  if server_msg in ("success", "sent"):
+    messages_total.inc(result=server_msg)
+  else:
+    messages_total.inc(result="llm_failed" if server_msg.startswith(LLM_FAILED) else "undelivered")
+  for sid in message_sids:
+    lazy_idempotency.get().complete(sid, server_msg)
+  return server_msg
+
+
+def run_job(job):
+  """Runs a job taken from the pipeline: a single message, or a phone's coalesced batch."""
+  if coalescer is None:
+    return run_message(*job)
+  phone, batch = job
+  try:
+    # Answer the burst as one message, timed from its first part
+    received_message = "\n".join(message for message, _, _, _ in batch)
+    name = next((name for _, name, _, _ in reversed(batch) if name is not None), None)
+    return run_message(phone, received_message, name, batch[0][2], [sid for _, _, _, sid in batch])
+  finally:
+    coalescer.finished(phone)
+
+
+def stream_chunks(chatapp, message, route, chunk_sz, max_chars, reply_parts):
+  """Yields reply chunks as soon as the streamed answer completes them, collecting the full reply in reply_parts."""
+  segmenter = SentenceSegmenter(chunk_sz, first_chunk_sz=int(os.environ.get("FIRST_CHUNK_SZ", "100")), max_chars=max_chars)
+  for delta in chatapp.chat_stream(message, route=route):
+    reply_parts.append(delta)
+    yield from segmenter.feed(delta)
+  # chat_stream reports a failure once it is exhausted
+  if chatapp.failure is None:
+    reply_parts.append(FOLLOW_UP)
+    yield from segmenter.feed(FOLLOW_UP)
+  yield from segmenter.flush()
+
+
 # POST /api/whatsapp
 @app.route("/api/whatsapp", methods=["POST"])
 def whatsapp_reply():
   #timestamap
-  timestamp = datetime.strftime(datetime.now(timezone.utc), "%m-%d-%y %H:%M:%S UTC")
+  timestamp = make_timestamp()
+
+  if not valid_twilio_signature():
+    app.logger.warning(f"rejected a webhook without a valid Twilio signature at {timestamp}")
+    return {"msg": "forbidden"}, 403
 
   # Attempt to extract the phone number
   try:
@@ -57,96 +543,25 @@ def whatsapp_reply():
     app.logger.error(f"name could not be parsed for {phone} at {timestamp}")
 
   if phone is not None and received_message is not None:
-    previous_interaction_records = interactions.query_interactions(phone)
-    previous_interaction_count = len(previous_interaction_records) 
-
-    # Get mentor type
-    if previous_interaction_count == 0:
-      mentor_type = random.choice(["local", "refugee", "AI"])
-    else:
-      mentor_type = previous_interaction_records[0]["mentor_type"]
+    # Answer duplicate deliveries of a message from the first delivery's result
+    message_sid = request.values.get("MessageSid") if lazy_idempotency is not None else None
+    if message_sid is not None:
+      acquired, record = lazy_idempotency.get().begin(message_sid)
+      if not acquired:
+        return {"msg": record.get("result", "in progress")}
 
-    # Send either a simple greeting, main advice, or followup advice depending on the previous_interaction_count
-    if previous_interaction_count == 0:
-      message_to_send = "Hello there, please tell me your business idea, and I will provide adivce"
+    if coalescer is not None and not pipeline.full():
+      coalescer.add(phone, (received_message, name, timestamp, message_sid))
+      server_msg = "accepted"
+    elif pipeline is None:
+      server_msg = run_message(phone, received_message, name, timestamp, [message_sid])
+    elif coalescer is None and pipeline.submit((phone, received_message, name, timestamp, [message_sid]), key=phone):
+      server_msg = "accepted"
     else:
-      chatapp = ChatApp(mentor_type)
-      for record in previous_interaction_records:
-        chatapp.messages.append({"role":"user", "content": record["received_message"]})
-        chatapp.messages.append({"role":"assistant", "content": record['sent_message']})
-
-      # Generate response
-      if previous_interaction_count == 1:
-        if mentor_type == 'local':
-          received_message = (f"Understand and answer the question given by '{received_message}'. You are a highly integrated local entrepreneur mentor based in Kampala. \n" 
-          "You have successfully started and managed businesses in this area for many years. \n"
-          "You are well-connected, deeply understand the local market, and focus on practical solutions. \n"
-          "You believe in step-by-step approaches to entrepreneurship. Now, you are providing solutions to the question raised.\n"
-          "You guide entrepreneurs to build sustainable businesses by leveraging local resources, customer insights, and efficient planning.\n"
-          "You are continuing a detailed mentoring conversation with the user. \n"
-          "Your goal is to answer the question by providing specific, actionable, relevant advice to the questions/concerns pointed out. \n")
-        elif mentor_type == 'refugee':
-          received_message = (f"Understand and answer the question given by '{received_message}'. You are a refugee entrepreneur mentor who overcame significant challenges to build a thriving business in Kampala. \n"
-          "You understand the difficulties faced by refugees, including limited resources, unfamiliar markets, and social barriers, \n"
-          "but you firmly believe in their potential. \n"
-          "Your advice is empathetic, motivational, and aimed at fostering creativity, resilience, and ambition. "
-          "You encourage entrepreneurs to embrace bold, innovative approaches while finding ways to overcome constraints.\n\n"
-          "You are continuing a detailed mentoring conversation with the user. \n"
-          "Your goal is to answer the question by providing specific, actionable, relevant advice to the questions/concerns pointed out. \n")
-        else:
-          received_message = (f"Understand and answer the question given by '{received_message}'."
-          "You are continuing a detailed mentoring conversation with the user. \n"
-          "Your goal is to answer the question by providing specific, actionable, relevant advice to the questions/concerns pointed out. \n")
-        
-      #get response from the chatbot
-      message_to_send = chatapp.chat(received_message)
-      message_to_send += 'Please feel free to ask a follow up question.'
-      app.logger.error(f"message_to_send={message_to_send}")
-
-    # Send whatsapp return message in chunks
-    i = 0
-    chunk_sz = int(os.environ["CHUNK_SZ"])
-    message_failure_flag = False
-    while i < len(message_to_send):
-      # Increment by chunk sz and search for nearest end of a sentence
-      j = min(i + chunk_sz, len(message_to_send))
-      if j < len(message_to_send):
-        while message_to_send[j] not in [".", "?", "!"] and j < len(message_to_send):
-            j += 1
-        j += 1
-
-      # Define the chunk as section from i to j
-      chunk = message_to_send[i:j]
-
-      # Redefine i
-      i = j
-
-      # Send the message
-      twilio_message = twilio_client.messages.create(
-        to=phone,
-        from_=os.environ["SERVER_PHONE"],
-        body=chunk
-      )
-
-      # Await for a little time until some sort of delivery
-      sid = twilio_message.sid
-      k = 1
-      while k <= int(os.environ["K_MAX"]) and twilio_message.status not in ["delivery_unknown", "delivered", "undelivered", "failed", "read"]:
-          time.sleep(k)
-          twilio_message = twilio_client.messages(sid).fetch()
-          k += 1
-
-      # If message was not successfully sent, delivered, or read; then return error
-      if twilio_message.status not in ["sent", "delivered", "read"]:
-        server_msg = f"devliery of response message sid={sid} failed for {timestamp} incoming message from {phone}"
-        message_failure_flag = True
-        break
-      
-
-    if not message_failure_flag:
-      server_msg = "success"
-      # Write record to dynamodb
-      interactions.add_interaction(phone, timestamp, received_message, message_to_send, mentor_type, name)
+      app.logger.error(f"reply queue full, rejecting message from {phone} at {timestamp}")
+      if message_sid is not None:
+        lazy_idempotency.get().release(message_sid)
+      return {"msg": "busy"}, 503, {"Retry-After": "5"}
 
   else:
     name = ""
@@ -161,5 +576,123 @@ def whatsapp_reply():
   return {"msg": server_msg}
 
 
+def valid_twilio_signature():
+  """Whether the request carries Twilio's X-Twilio-Signature for its URL and form parameters."""
+  if os.environ.get("TWILIO_VALIDATE_SIGNATURE", "true").lower() != "true":
+    return True
+  signature = request.headers.get("X-Twilio-Signature")
+  if not signature:
+    return False
+  url = request.url
+  if os.environ.get("PUBLIC_BASE_URL"):
+    # Behind a proxy the app sees another scheme or host than the URL Twilio signed
+    url = os.environ["PUBLIC_BASE_URL"].rstrip("/") + request.full_path.rstrip("?")
+  return RequestValidator(os.environ.get("TWILIO_AUTH_TOKEN", "")).validate(url, request.form, signature)
+
+
+# GET /health
+@app.route("/health", methods=["GET"])
+def health():
+  # Liveness only: the process serves requests, whatever the state of its dependencies
+  return {"status": "ok", "uptime": round(time.monotonic() - import_started, 1)}
+
+
+# GET /ready
+@app.route("/ready", methods=["GET"])
+def ready():
+  # Ready once every client exists and the table answered; until then, keep warming up
+  dependencies = {resource.name: resource.status() for resource in warm_resources()}
+  dependencies["table"] = dict(table_check)
+  if all(status["ready"] for status in dependencies.values()):
+    return {"status": "ready", "dependencies": dependencies}
+  start_warm_up()
+  return {"status": "warming", "dependencies": dependencies}, 503
+
+
+# GET /metrics
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+  return metrics.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+# POST /api/whatsapp/status
+@app.route("/api/whatsapp/status", methods=["POST"])
+def whatsapp_status():
+  # Anyone could otherwise complete a reply by posting its id as delivered
+  if not valid_twilio_signature():
+    app.logger.warning("rejected a status callback without a valid Twilio signature")
+    return {"msg": "forbidden"}, 403
+  reply_id = request.args.get("reply")
+  sid = request.values.get("MessageSid")
+  status = request.values.get("MessageStatus")
+  if lazy_delivery_tracker is None or reply_id is None or sid is None or status is None:
+    return {"msg": "ignored"}
+  lazy_delivery_tracker.get().update(reply_id, sid, status)
+  return {"msg": "success"}
+
+
+def warm_resources():
+  resources = (lazy_interactions, lazy_idempotency, lazy_delivery_tracker, lazy_twilio_client, lazy_llm_client)
+  return [resource for resource in resources if resource is not None]
+
+
+# Whether the table answered a DescribeTable (or its local equivalent) during warm-up
+table_check = {"ready": False, "seconds": None, "error": None}
+warm_up_lock = threading.Lock()
+warm_up_thread = None
+
+
+def warm_up():
+  """Creates every client and checks the table, so the first message pays for neither."""
+  for resource in warm_resources():
+    try:
+      resource.get()
+    except Exception:
+      # Logged by the resource; the first message or the next readiness check tries again
+      return
+  started = time.monotonic()
+  try:
+    found = lazy_interactions.get().exists(table)
+  except Exception as err:
+    table_check["error"] = f"{type(err).__name__}: {err}"
+    return
+  table_check["seconds"] = round(time.monotonic() - started, 3)
+  if found:
+    table_check.update(ready=True, error=None)
+  else:
+    table_check["error"] = f"table {table} does not exist; run bootstrap.py"
+    app.logger.error(table_check["error"])
+
+
+def start_warm_up():
+  """Starts warm_up in the background unless it is already running."""
+  global warm_up_thread
+  with warm_up_lock:
+    if warm_up_thread is None or not warm_up_thread.is_alive():
+      warm_up_thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+      warm_up_thread.start()
+
+
+def start_background():
+  """Starts the background threads. Threads don't survive fork, so a preloading server calls this in each worker."""
+  if pipeline is not None:
+    pipeline.start()
+  if coalescer is not None:
+    coalescer.start()
+  if os.environ.get("WARM_UP", "true").lower() == "true":
+    start_warm_up()
+
+
+# gunicorn.conf.py sets this when it preloads the app, and starts them after forking instead
+if os.environ.get("DEFER_BACKGROUND_START", "false").lower() != "true":
+  start_background()
+
+startup_seconds = time.monotonic() - import_started
+metrics.register(Gauge("app_startup_seconds", "Seconds from the start of the app import to serving requests.", lambda: startup_seconds))
+app.logger.info(f"app imported in {startup_seconds:.3f}s")
+
+
 if __name__ == "__main__":
+   # Turn SIGTERM into a normal exit so queued replies are drained by atexit
+   signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
    app.run(host="0.0.0.0", port=8080)
\ No newline at end of file
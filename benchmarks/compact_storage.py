@@ -0,0 +1,93 @@
+"""
+Compares read units and latency of the item-per-turn layout (Interactions) with
+the compact single-item layout (CompactInteractions).
+
+Both tables are created, filled with the same synthetic conversations, read
+back with query_history and query_interactions, and deleted again. Run it
+against a scratch account or DynamoDB Local, for example:
+
+    DYNAMODB_ENDPOINT_URL=http://localhost:8000 python3 -m benchmarks.compact_storage --turns 200
+"""
+import argparse
+import os
+import statistics
+import time
+import uuid
+
+import boto3
+
+from compact_interactions import CompactInteractions
+from interactions import Interactions, make_timestamp
+
+
+class CapacityMeter:
+    """Asks DynamoDB for the capacity each call consumes and adds it up."""
+
+    def __init__(self, client):
+        self.units = 0.0
+        client.meta.events.register("provide-client-params.dynamodb.*", self._request_capacity)
+        client.meta.events.register("after-call.dynamodb.*", self._count_capacity)
+
+
+    def _request_capacity(self, params, **kwargs):
+        if kwargs["model"].name in ("GetItem", "Query", "Scan", "BatchGetItem"):
+            params["ReturnConsumedCapacity"] = "TOTAL"
+
+
+    def _count_capacity(self, parsed, **kwargs):
+        consumed = parsed.get("ConsumedCapacity")
+        for capacity in consumed if isinstance(consumed, list) else [consumed] if consumed else []:
+            self.units += capacity.get("CapacityUnits", 0)
+
+
+def fill(interactions, phones, turns, message_sz):
+    for phone in phones:
+        for turn in range(turns):
+            interactions.add_interaction(
+                phone, make_timestamp(), f"question {turn} " + "q" * message_sz,
+                f"answer {turn} " + "a" * message_sz, "refugee", "Benchmark", tokens=message_sz // 2,
+            )
+
+
+def measure(interactions, meter, phones, read):
+    latencies = []
+    meter.units = 0.0
+    for phone in phones:
+        started = time.perf_counter()
+        read(interactions, phone)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return meter.units / len(phones), statistics.median(latencies), max(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare read units and latency of the two interaction layouts.")
+    parser.add_argument("--phones", type=int, default=5, help="Conversations written to each table.")
+    parser.add_argument("--turns", type=int, default=100, help="Turns in each conversation.")
+    parser.add_argument("--message-size", type=int, default=400, help="Characters in each message.")
+    parser.add_argument("--history-limit", type=int, default=50, help="Turns read by query_history.")
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource(
+        "dynamodb",
+        region_name=os.environ.get("AWS_REGION", "us-east-1"),
+        endpoint_url=os.environ.get("DYNAMODB_ENDPOINT_URL"),
+    )
+    meter = CapacityMeter(dynamodb.meta.client)
+    phones = [f"+1555{number:07d}" for number in range(args.phones)]
+    reads = {
+        "query_history": lambda interactions, phone: interactions.query_history(phone, args.history_limit),
+        "query_interactions": lambda interactions, phone: interactions.query_interactions(phone),
+    }
+
+    print(f"{args.phones} conversations of {args.turns} turns, {args.message_size} characters per message")
+    print(f"{'layout':<10} {'read':<20} {'RCU/conversation':>17} {'p50 ms':>8} {'max ms':>8}")
+    for layout, interactions_class in (("items", Interactions), ("compact", CompactInteractions)):
+        interactions = interactions_class(dynamodb)
+        interactions.create_table(f"benchmark-{layout}-{uuid.uuid4().hex[:8]}")
+        try:
+            fill(interactions, phones, args.turns, args.message_size)
+            for name, read in reads.items():
+                units, p50, worst = measure(interactions, meter, phones, read)
+                print(f"{layout:<10} {name:<20} {units:>17.1f} {p50:>8.1f} {worst:>8.1f}")
+        finally:
+            interactions.delete_table()
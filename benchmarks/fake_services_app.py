@@ -0,0 +1,35 @@
+"""
+The app with OpenAI, Twilio and DynamoDB replaced by the fakes, as a WSGI
+entry point, for measuring a real server over HTTP:
+
+    gunicorn -c gunicorn.conf.py benchmarks.fake_services_app:app
+    python3 -m benchmarks.replay --url http://127.0.0.1:8080
+
+Latencies come from FAKE_LLM_LATENCY, FAKE_TWILIO_LATENCY and FAKE_DDB_LATENCY
+(seconds).
+"""
+import os
+
+from benchmarks.fakes import FakeDynamoDB, FakeOpenAI, FakeTwilio, Latency
+from benchmarks.replay import BENCHMARK_ENVIRONMENT
+
+for key, value in BENCHMARK_ENVIRONMENT.items():
+    os.environ.setdefault(key, value)
+
+import app as app_module
+
+llm_latency = float(os.environ.get("FAKE_LLM_LATENCY", "0.5"))
+twilio_latency = float(os.environ.get("FAKE_TWILIO_LATENCY", "0.1"))
+ddb_latency = float(os.environ.get("FAKE_DDB_LATENCY", "0.01"))
+
+FakeOpenAI(Latency(llm_latency, llm_latency / 2)).install()
+app_module.lazy_twilio_client.set(FakeTwilio(Latency(twilio_latency, twilio_latency / 2)))
+storage = FakeDynamoDB(Latency(ddb_latency, ddb_latency / 2), logger=app_module.app.logger, cache=app_module.history_cache)
+storage.create_table(os.environ["DDB_TABLE"])
+app_module.lazy_interactions.set(storage)
+
+app = app_module.app
+
+if __name__ == "__main__":
+    # The development server, as the Dockerfile ran it before gunicorn
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", "8080")))
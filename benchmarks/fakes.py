@@ -0,0 +1,205 @@
+"""
+Local stand-ins for OpenAI, Twilio and DynamoDB, used by the benchmarks so
+the reply path can be measured without paid or remote services. Each fake
+counts its calls and can add latency and inject errors.
+"""
+import itertools
+import random
+import threading
+import time
+import types
+
+import openai
+from botocore.exceptions import ClientError
+from twilio.base.exceptions import TwilioRestException
+
+from memory_interactions import MemoryInteractions
+
+REPLY = (
+    "Start by talking to ten potential customers this week. Ask what they buy today, "
+    "where they buy it and what they pay. Write down the answers and look for patterns. "
+    "Then test a small batch before you spend on stock!"
+)
+
+
+class Latency:
+    """Sleeps for a random time around a mean, with an occasional slow call."""
+
+    def __init__(self, mean=0.0, jitter=0.0, tail=0.0, tail_factor=5.0):
+        """
+        :param mean: Mean seconds of a call.
+        :param jitter: Seconds the latency varies by either way.
+        :param tail: Share of calls, from 0 to 1, that take tail_factor times longer.
+        :param tail_factor: How much longer a slow call takes.
+        """
+        self.mean = mean
+        self.jitter = jitter
+        self.tail = tail
+        self.tail_factor = tail_factor
+
+
+    def wait(self):
+        seconds = max(0.0, random.uniform(self.mean - self.jitter, self.mean + self.jitter))
+        if self.tail and random.random() < self.tail:
+            seconds *= self.tail_factor
+        if seconds:
+            time.sleep(seconds)
+
+
+class CallCounter:
+    """Counts calls and failures across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+
+    def count(self, failed=False):
+        with self.lock:
+            self.calls += 1
+            if failed:
+                self.errors += 1
+
+
+class FakeOpenAI(CallCounter):
+    """Replaces openai.ChatCompletion.create with a canned, optionally slow answer.
+
+    Example:
+        fake = FakeOpenAI(Latency(mean=1.5), error_rate=0.02)
+        fake.install()
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, reply=REPLY, stream_delay=0.02):
+        """
+        :param latency: Latency before the answer, or before its first streamed part.
+        :param error_rate: Share of calls, from 0 to 1, that fail with a retryable error.
+        :param reply: The answer every call gets.
+        :param stream_delay: Seconds between streamed parts.
+        """
+        super().__init__()
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.reply = reply
+        self.stream_delay = stream_delay
+
+
+    def install(self):
+        """
+        Routes every ChatCompletion call to this fake.
+        """
+        openai.ChatCompletion.create = self.create
+
+
+    def create(self, **kwargs):
+        self.latency.wait()
+        if random.random() < self.error_rate:
+            self.count(failed=True)
+            raise openai.error.ServiceUnavailableError("Injected by the benchmark")
+        self.count()
+        if kwargs.get("stream"):
+            return self._stream()
+        return {"choices": [{"message": types.SimpleNamespace(content=self.reply)}]}
+
+
+    def _stream(self):
+        for word in self.reply.split(" "):
+            time.sleep(self.stream_delay)
+            yield {"choices": [{"delta": {"content": word + " "}}]}
+
+
+class FakeTwilio(CallCounter):
+    """A Twilio client whose messages are sent to nowhere.
+
+    Assign it to app.twilio_client. Messages report the given status at once,
+    so the app does not poll.
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, status="delivered"):
+        """
+        :param latency: Latency of each API call.
+        :param error_rate: Share of sends, from 0 to 1, that fail with an HTTP 500.
+        :param status: The status sent messages report.
+        """
+        super().__init__()
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.status = status
+        self.sids = itertools.count(1)
+        self.messages = _Messages(self)
+
+
+class _Messages:
+    # Mimics client.messages, which is called as well as used as an object
+
+    def __init__(self, fake):
+        self.fake = fake
+
+
+    def create(self, to, from_, body, status_callback=None):
+        self.fake.latency.wait()
+        if random.random() < self.fake.error_rate:
+            self.fake.count(failed=True)
+            raise TwilioRestException(500, "/Messages.json", "Injected by the benchmark")
+        self.fake.count()
+        return types.SimpleNamespace(sid=f"SM{next(self.fake.sids):032d}", status=self.fake.status)
+
+
+    def __call__(self, sid):
+        return types.SimpleNamespace(fetch=lambda: self._fetch(sid))
+
+
+    def _fetch(self, sid):
+        self.fake.latency.wait()
+        self.fake.count()
+        return types.SimpleNamespace(sid=sid, status=self.fake.status)
+
+
+class FakeDynamoDB(MemoryInteractions):
+    """In-memory interactions with DynamoDB-like latency and throttling.
+
+    Assign it to app.interactions after creating its table.
+    """
+
+    def __init__(self, latency=None, error_rate=0.0, logger=None, cache=None):
+        """
+        :param latency: Latency of each read and write.
+        :param error_rate: Share of calls, from 0 to 1, that are throttled.
+        :param logger: Logger used to report storage errors.
+        :param cache: Optional LRUCache holding each phone's interactions.
+        """
+        super().__init__(logger=logger, cache=cache)
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.counter = CallCounter()
+
+
+    def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None):
+        self._call()
+        return super().iter_interactions(phone, newest_first, page_size, limit)
+
+
+    def get_summary(self, phone):
+        self._call()
+        return super().get_summary(phone)
+
+
+    def put_summary(self, phone, summary, through):
+        self._call()
+        super().put_summary(phone, summary, through)
+
+
+    def _store(self, item):
+        self._call()
+        super()._store(item)
+
+
+    def _call(self):
+        self.latency.wait()
+        if random.random() < self.error_rate:
+            self.counter.count(failed=True)
+            raise ClientError(
+                {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "Injected by the benchmark"}},
+                "Query",
+            )
+        self.counter.count()
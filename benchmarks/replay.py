@@ -0,0 +1,305 @@
+"""
+Replays WhatsApp webhooks against the Flask app in process, with OpenAI,
+Twilio and DynamoDB replaced by the fakes in benchmarks/fakes.py, and reports
+webhook latency, throughput and external calls per message.
+
+    python3 -m benchmarks.replay --phones 50 --messages 4 --concurrency 16
+    python3 -m benchmarks.replay --webhooks benchmarks/sample_webhooks.jsonl --save-baseline baseline.json
+    python3 -m benchmarks.replay --baseline baseline.json
+
+The app reads its settings from the environment as usual, so REPLY_MODE,
+COALESCE_WINDOW and the rest can be compared run against run. With
+--baseline, the run fails when p95 latency or throughput is worse than the
+baseline by more than --tolerance.
+
+With --url, the webhooks go over HTTP to a running server instead, e.g. one
+started from benchmarks/fake_services_app.py, so servers can be compared. The
+fakes then live in the server, and only latency and throughput are reported.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from twilio.request_validator import RequestValidator
+
+from benchmarks.fakes import FakeDynamoDB, FakeOpenAI, FakeTwilio, Latency
+
+# The app reads these at import; none of them reach a real service
+BENCHMARK_ENVIRONMENT = {
+    "STORAGE_BACKEND": "memory",
+    "DDB_TABLE": "benchmark",
+    "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+    "TWILIO_AUTH_TOKEN": "benchmark",
+    "SERVER_PHONE": "whatsapp:+15550000000",
+    "OPENAI_API_KEY": "benchmark",
+    "CHUNK_SZ": "1500",
+    "K_MAX": "3",
+}
+
+BODIES = [
+    "Hi",
+    "I want to sell second-hand shoes in Kampala.",
+    "How much stock should I buy to start?",
+    "Where can I find customers?",
+    "Should I register the business first?",
+]
+
+
+def percentile(values, share):
+    """
+    :param values: The measurements.
+    :param share: The percentile as a share from 0 to 1.
+    :return: The nearest-rank percentile of the values.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+def synthetic_conversations(phones, messages):
+    """
+    :return: One list of webhook forms per phone, in the order the phone sends them.
+    """
+    conversations = []
+    for number in range(phones):
+        phone = f"whatsapp:+1555{number:07d}"
+        conversations.append([
+            {"From": phone, "Body": BODIES[turn % len(BODIES)], "ProfileName": f"User {number}"}
+            for turn in range(messages)
+        ])
+    return conversations
+
+
+def load_conversations(path, repeat):
+    """
+    Reads webhook forms from a JSON lines file, one form per line, and groups
+    them by phone. Each repeat sends them again from a new set of phones.
+
+    :return: One list of webhook forms per phone, in file order.
+    """
+    with open(path) as webhooks:
+        forms = [json.loads(line) for line in webhooks if line.strip()]
+    conversations = OrderedDict()
+    for copy in range(repeat):
+        for form in forms:
+            phone = form["From"] if copy == 0 else f"{form['From']}-{copy}"
+            conversations.setdefault(phone, []).append(dict(form, From=phone))
+    return list(conversations.values())
+
+
+class HttpClient:
+    """Posts webhooks to a running server over one keep-alive connection."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=120)
+        self.prefix = parts.path.rstrip("/")
+
+
+    def post(self, path, data, headers=None):
+        body = urlencode(data)
+        headers = dict(headers or {}, **{"Content-Type": "application/x-www-form-urlencoded"})
+        try:
+            self.connection.request("POST", self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The server closed the idle connection; reconnect once
+            self.connection.close()
+            self.connection.request("POST", self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+        response.read()
+        return response
+
+
+def replay(app_module, conversations, concurrency, url=None):
+    """
+    Sends every conversation's webhooks in order, running conversations concurrently.
+
+    :param url: Post to the server at this URL instead of the app in process.
+    :return: The webhook latencies in seconds, and the number of failed webhooks.
+    """
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    sids = iter(range(1, sys.maxsize))
+
+    # Sign the webhooks as Twilio would, with the token the app validates them with
+    validator = RequestValidator(os.environ.get("TWILIO_AUTH_TOKEN", BENCHMARK_ENVIRONMENT["TWILIO_AUTH_TOKEN"]))
+    webhook_url = (url.rstrip("/") if url else "http://localhost") + "/api/whatsapp"
+
+    def send(conversation):
+        client = HttpClient(url) if url else app_module.app.test_client()
+        for form in conversation:
+            with lock:
+                form = dict(form, MessageSid=form.get("MessageSid") or f"SMbench{next(sids):026d}")
+            headers = {"X-Twilio-Signature": validator.compute_signature(webhook_url, form)}
+            started = time.perf_counter()
+            try:
+                response = client.post("/api/whatsapp", data=form, headers=headers)
+                failed = (response.status if url else response.status_code) >= 400
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if failed:
+                    failures.append(form)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, conversations))
+    return latencies, len(failures)
+
+
+def wait_until_idle(app_module, timeout):
+    """
+    Waits for the background pipeline and coalescer to finish every reply.
+
+    :return: True when they finished within the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pipeline = app_module.pipeline
+        coalescer = app_module.coalescer
+        busy = pipeline is not None and (
+            pipeline.depth() or pipeline.stats["completed"] + pipeline.stats["failed"] < pipeline.stats["submitted"]
+        )
+        if coalescer is not None and coalescer.phones:
+            busy = True
+        if not busy:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def reply_mode(app_module):
+    """
+    :return: How the app in process replies, "sync", "async" or "coalesced",
+             and the coalescing window in seconds, or None.
+    """
+    if app_module.coalescer is not None:
+        return "coalesced", app_module.coalescer.window
+    return ("async" if app_module.pipeline is not None else "sync"), None
+
+
+def compare(report, baseline, tolerance):
+    """
+    Prints each metric next to its baseline.
+
+    :return: False when p95 latency or throughput regressed by more than tolerance.
+    """
+    for key in ("reply_mode", "coalesce_window"):
+        if key in baseline and baseline[key] != report[key]:
+            print(f"The baseline ran with {key} {baseline[key]}, this run with {report[key]}")
+    print(f"{'metric':<28} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key in ("p50_ms", "p95_ms", "p99_ms", "rps", "llm_calls_per_message", "twilio_calls_per_message",
+                "storage_calls_per_message"):
+        before, after = baseline.get(key), report[key]
+        if after is None:
+            continue
+        change = f"{(after - before) / before:+.0%}" if before else ""
+        print(f"{key:<28} {before if before is not None else '':>12} {after:>12} {change:>8}")
+    regressed = []
+    if baseline.get("p95_ms") and report["p95_ms"] > baseline["p95_ms"] * (1 + tolerance):
+        regressed.append("p95 latency")
+    if baseline.get("rps") and report["rps"] < baseline["rps"] * (1 - tolerance):
+        regressed.append("throughput")
+    if regressed:
+        print(f"Regressed beyond {tolerance:.0%}: {', '.join(regressed)}")
+    return not regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay webhooks against the app with fake external services.")
+    parser.add_argument("--webhooks", help="JSON lines file of webhook forms; synthetic conversations when omitted.")
+    parser.add_argument("--repeat", type=int, default=1, help="Times the webhooks file is replayed, from new phones.")
+    parser.add_argument("--phones", type=int, default=20, help="Synthetic conversations.")
+    parser.add_argument("--messages", type=int, default=3, help="Messages in each synthetic conversation.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Conversations sending at once.")
+    parser.add_argument("--url", help="Post to a running server, e.g. http://127.0.0.1:8080, instead of in process.")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Mean seconds of an OpenAI call.")
+    parser.add_argument("--llm-errors", type=float, default=0.0, help="Share of OpenAI calls that fail.")
+    parser.add_argument("--twilio-latency", type=float, default=0.1, help="Mean seconds of a Twilio call.")
+    parser.add_argument("--twilio-errors", type=float, default=0.0, help="Share of Twilio sends that fail.")
+    parser.add_argument("--ddb-latency", type=float, default=0.01, help="Mean seconds of a DynamoDB call.")
+    parser.add_argument("--ddb-errors", type=float, default=0.0, help="Share of DynamoDB calls that are throttled.")
+    parser.add_argument("--tail", type=float, default=0.01, help="Share of fake calls that take five times longer.")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="Seconds to wait for background replies.")
+    parser.add_argument("--baseline", help="JSON report to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline.")
+    parser.add_argument("--save-baseline", help="Write this run's report to the file.")
+    args = parser.parse_args()
+
+    app_module = llm = twilio = storage = None
+    if not args.url:
+        for key, value in BENCHMARK_ENVIRONMENT.items():
+            os.environ.setdefault(key, value)
+        import app as app_module
+
+        # The app logs every reply; keep the report readable
+        app_module.app.logger.setLevel(os.environ.get("BENCHMARK_LOG_LEVEL", "CRITICAL"))
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+        llm = FakeOpenAI(Latency(args.llm_latency, args.llm_latency / 2, args.tail), args.llm_errors)
+        llm.install()
+        twilio = FakeTwilio(
+            Latency(args.twilio_latency, args.twilio_latency / 2, args.tail), args.twilio_errors
+        )
+        storage = FakeDynamoDB(
+            Latency(args.ddb_latency, args.ddb_latency / 2, args.tail), args.ddb_errors,
+            logger=app_module.app.logger, cache=app_module.history_cache,
+        )
+        storage.create_table(f"benchmark-{os.getpid()}")
+        app_module.lazy_twilio_client.set(twilio)
+        app_module.lazy_interactions.set(storage)
+
+    if args.webhooks:
+        conversations = load_conversations(args.webhooks, args.repeat)
+    else:
+        conversations = synthetic_conversations(args.phones, args.messages)
+    messages = sum(len(conversation) for conversation in conversations)
+
+    started = time.perf_counter()
+    latencies, failed = replay(app_module, conversations, args.concurrency, args.url)
+    # Throughput and calls per message count the background and coalesced
+    # replies too; a server's background replies can't be observed from here
+    drained = args.url or wait_until_idle(app_module, args.drain_timeout)
+    elapsed = time.perf_counter() - started
+    # A server's settings aren't visible from here either
+    mode, window = reply_mode(app_module) if app_module else (None, None)
+
+    report = {
+        "messages": messages,
+        "failed_webhooks": failed,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "rps": round(messages / elapsed, 2),
+        "llm_calls_per_message": round(llm.calls / messages, 2) if llm else None,
+        "twilio_calls_per_message": round(twilio.calls / messages, 2) if twilio else None,
+        "storage_calls_per_message": round(storage.counter.calls / messages, 2) if storage else None,
+        "reply_mode": mode,
+        "coalesce_window": window,
+        "drained": bool(drained),
+        "concurrency": args.concurrency,
+    }
+    print(f"{messages} messages from {len(conversations)} phones in {elapsed:.1f}s"
+          f"{'' if drained else ' (background replies still running)'}")
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            if not compare(report, json.load(baseline_file), args.tolerance):
+                sys.exit(1)
@@ -0,0 +1,54 @@
+import argparse
+import logging
+import os
+
+import boto3
+
+from idempotency import IdempotencyStore
+from interactions import Interactions
+from sqlite_interactions import SqliteInteractions
+
+logger = logging.getLogger(__name__)
+
+
+def bootstrap(interactions, table_name, enable_ttl=True):
+    """
+    Creates the interactions table unless it exists, and turns on time to
+    live for it either way, so running it again finishes an earlier run. The
+    app no longer does this at startup, so run it once per environment
+    before deploying.
+
+    :param interactions: The storage to provision.
+    :param table_name: The name of the table.
+    :param enable_ttl: Turn on DynamoDB's time to live for idempotency records.
+    :return: True when the table was created.
+    """
+    created = False
+    if interactions.exists(table_name):
+        logger.info("Table %s exists", table_name)
+    else:
+        logger.info("Creating table %s", table_name)
+        interactions.create_table(table_name)
+        created = True
+    if enable_ttl and isinstance(interactions, Interactions):
+        IdempotencyStore(interactions.table, logger=logger).enable_ttl()
+    return created
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the table the app stores interactions in.")
+    parser.add_argument("--table", default=os.environ.get("DDB_TABLE"), help="The table (defaults to DDB_TABLE).")
+    parser.add_argument("--backend", default=os.environ.get("STORAGE_BACKEND", "dynamodb"), choices=["dynamodb", "sqlite"],
+                        help="The storage backend (defaults to STORAGE_BACKEND).")
+    parser.add_argument("--no-ttl", action="store_true", help="Don't turn on time to live for idempotency records.")
+    args = parser.parse_args()
+    if not args.table:
+        parser.error("--table or DDB_TABLE is required")
+
+    logging.basicConfig(level=logging.INFO)
+    if args.backend == "sqlite":
+        interactions = SqliteInteractions(os.environ.get("SQLITE_PATH", "interactions.db"), logger=logger)
+    else:
+        # Both DynamoDB layouts share the same key schema
+        interactions = Interactions(boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"]), logger=logger)
+    bootstrap(interactions, args.table, enable_ttl=not args.no_ttl)
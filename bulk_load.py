@@ -0,0 +1,460 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import boto3
+from botocore.config import Config
+
+from bootstrap import bootstrap
+from interactions import Interactions
+
+logger = logging.getLogger(__name__)
+
+# The share of a provisioned table's write capacity a load may use, leaving
+# the rest to the app
+PROVISIONED_SHARE = 0.8
+# Write units per second for on-demand tables, which have no provisioned rate
+ON_DEMAND_WCU = 1000
+# Error codes DynamoDB throttles an attempt with
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+# Ends a worker's stream of items
+_DONE = object()
+
+
+def read_items(path, chunk_size=1 << 16):
+    """
+    Streams the items of a JSON lines file, one item per line, or of a file
+    holding one JSON array of items, gzip compressed when the path ends in
+    .gz. Neither is read into memory whole. Numbers are read as Decimal, as
+    DynamoDB requires, and items without a phone and timestamp are skipped.
+
+    :param path: The file to read.
+    :param chunk_size: Characters read at a time from a JSON array.
+    :return: A generator of items.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as items_file:
+        if path.endswith((".jsonl", ".jsonl.gz")):
+            items = (json.loads(line, parse_float=Decimal) for line in items_file if line.strip())
+        else:
+            items = _iter_array(items_file, chunk_size)
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or "phone" not in item or "timestamp" not in item:
+                logger.warning("Skipped item %s of %s, which has no phone or timestamp", index + 1, path)
+                continue
+            yield item
+
+
+def _iter_array(items_file, chunk_size):
+    # Decodes the array element by element from a buffer that is refilled as
+    # it runs out; an element cut off at the end of the buffer fails to decode
+    # until the rest of it is read
+    decoder = json.JSONDecoder(parse_float=Decimal)
+    buffer = items_file.read(chunk_size).lstrip()
+    if not buffer.startswith("["):
+        raise ValueError(f"{items_file.name} holds neither JSON lines nor a JSON array")
+    buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip().lstrip(",").lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            more = items_file.read(chunk_size)
+            if not more:
+                raise
+            buffer += more
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+class CapacityThrottle:
+    """Paces writes to the write capacity they actually consume.
+
+    Every BatchWriteItem call asks DynamoDB for the capacity it consumed, and
+    that is taken from a bucket refilled at rate units per second; writers
+    wait while the bucket is in debt. The rate adapts like TCP: it is halved
+    whenever DynamoDB throttles an attempt or leaves items unprocessed, at
+    most once a second, and grows by a tenth for every second without
+    throttling, up to max_rate. Attempts are watched one by one, so throttles
+    that botocore retries before the call returns count too.
+
+    Example:
+        throttle = CapacityThrottle(max_rate=800)
+        throttle.watch(dynamodb.meta.client)
+        for item in items:
+            throttle.wait()
+            writer.put_item(Item=item)
+    """
+
+    def __init__(self, max_rate, min_rate=1):
+        """
+        :param max_rate: The most write units to consume per second.
+        :param min_rate: The rate is never lowered below this.
+        """
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.consumed = 0.0
+        self.throttled = 0
+        self._tokens = max_rate
+        self._refilled = time.monotonic()
+        self._raised = self._refilled
+        self._cut = self._refilled - 1
+        self._lock = threading.Lock()
+
+
+    def watch(self, client):
+        """
+        Meters the BatchWriteItem calls of a DynamoDB client.
+
+        :param client: A DynamoDB client, such as resource.meta.client.
+        """
+        client.meta.events.register("provide-client-params.dynamodb.BatchWriteItem", self._request_capacity)
+        client.meta.events.register("after-call.dynamodb.BatchWriteItem", self._count_capacity)
+        client.meta.events.register("needs-retry.dynamodb.BatchWriteItem", self._count_attempt)
+
+
+    def wait(self):
+        """
+        Blocks while more capacity was consumed than the rate allows.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens > 0:
+                    return
+                delay = -self._tokens / self.rate
+            time.sleep(min(delay, 1))
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if now - self._raised >= 1:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+            self._raised = now
+
+
+    def _request_capacity(self, params, **kwargs):
+        params["ReturnConsumedCapacity"] = "TOTAL"
+
+
+    def _count_capacity(self, parsed, **kwargs):
+        # The final attempt of a call; throttled attempts before it were
+        # counted by _count_attempt
+        units = sum(capacity.get("CapacityUnits", 0) for capacity in parsed.get("ConsumedCapacity") or [])
+        with self._lock:
+            self._refill()
+            self.consumed += units
+            self._tokens -= units
+            if parsed.get("UnprocessedItems"):
+                self._back_off()
+
+
+    def _count_attempt(self, response=None, **kwargs):
+        # Emitted after every attempt, before botocore decides to retry it;
+        # returns None so the retry handler still decides
+        if response is None:
+            return None
+        error = response[1].get("Error", {}).get("Code")
+        if error in THROTTLING_ERRORS:
+            with self._lock:
+                self._refill()
+                self._back_off()
+        return None
+
+
+    def _back_off(self):
+        # Called with the lock held; several workers throttled together, or
+        # one call retried several times, halve the rate once
+        self.throttled += 1
+        now = time.monotonic()
+        if now - self._cut >= 1:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._cut = now
+        self._raised = now
+
+
+class BulkLoader:
+    """Writes a stream of items to a table with parallel batch writers.
+
+    Each worker thread has its own boto3 session and sends batches of 25
+    items with Table.batch_writer, which retries unprocessed items. Items
+    reach the workers through a bounded queue, so memory stays flat however
+    many are loaded, and a shared CapacityThrottle keeps the workers together
+    under the table's write capacity. Progress and throughput are logged as
+    the load runs.
+
+    Example:
+        loader = BulkLoader(dynamodb, "interactions-v2", workers=8, max_wcu=800)
+        written = loader.load(read_items("interactions.jsonl.gz"))
+    """
+
+    def __init__(self, dyn_resource, table_name, workers=8, max_wcu=None, progress_interval=10):
+        """
+        :param dyn_resource: A Boto3 DynamoDB resource; its region and endpoint
+                             are used for the workers' own resources.
+        :param table_name: The table to write.
+        :param workers: Batch writers running at once.
+        :param max_wcu: The most write units per second; defaults to 80% of the
+                        table's provisioned write capacity, or 1000 on demand.
+        :param progress_interval: Seconds between progress reports.
+        """
+        self.dyn_resource = dyn_resource
+        self.table_name = table_name
+        self.workers = workers
+        self.progress_interval = progress_interval
+        if max_wcu is None:
+            max_wcu = default_max_wcu(dyn_resource.Table(table_name))
+        self.throttle = CapacityThrottle(max_wcu)
+        self.written = 0
+        self._lock = threading.Lock()
+
+
+    def load(self, items):
+        """
+        Writes items, replacing any with the same key.
+
+        :param items: The items, any iterable.
+        :return: The number of items written.
+        """
+        pending = queue.Queue(maxsize=self.workers * 100)
+        failed = threading.Event()
+        errors = []
+        threads = [
+            threading.Thread(target=self._work, args=(pending, failed, errors), name=f"bulk-load-{index}", daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        started = last_report = time.monotonic()
+        try:
+            for item in items:
+                if not self._offer(pending, item, failed):
+                    break
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    self._report(started, last_report)
+        finally:
+            for _ in threads:
+                self._offer(pending, _DONE, failed)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        self._report(started, time.monotonic())
+        return self.written
+
+
+    def _offer(self, pending, item, failed):
+        # Waits for room in the queue unless a worker has failed
+        while not failed.is_set():
+            try:
+                pending.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def _work(self, pending, failed, errors):
+        region = self.dyn_resource.meta.client.meta.region_name
+        endpoint = self.dyn_resource.meta.client.meta.endpoint_url
+        # Resources aren't thread-safe, so each worker builds its own; retry
+        # throttled calls longer than by default, as the throttle backs off too
+        dynamodb = boto3.session.Session().resource(
+            "dynamodb", region_name=region, endpoint_url=endpoint,
+            config=Config(retries={"max_attempts": 10, "mode": "standard"}),
+        )
+        self.throttle.watch(dynamodb.meta.client)
+        interactions = Interactions(dynamodb, logger=logger)
+        interactions.use_table(self.table_name)
+        try:
+            interactions.write_batch(self._drain(pending, failed))
+        except Exception as err:
+            errors.append(err)
+            failed.set()
+
+
+    def _drain(self, pending, failed):
+        while not failed.is_set():
+            try:
+                item = pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            self.throttle.wait()
+            yield item
+            with self._lock:
+                self.written += 1
+
+
+    def _report(self, started, now):
+        elapsed = max(now - started, 1e-9)
+        logger.info(
+            "Wrote %s items to %s, %.0f items/s, %.0f WCU/s, limit %.0f WCU/s, %s throttled calls",
+            self.written, self.table_name, self.written / elapsed, self.throttle.consumed / elapsed,
+            self.throttle.rate, self.throttle.throttled,
+        )
+
+
+def default_max_wcu(table):
+    """
+    :param table: A Boto3 Table.
+    :return: 80% of the table's provisioned write capacity, or 1000 write
+             units per second for an on-demand table.
+    """
+    if (table.billing_mode_summary or {}).get("BillingMode") == "PAY_PER_REQUEST":
+        return ON_DEMAND_WCU
+    provisioned = (table.provisioned_throughput or {}).get("WriteCapacityUnits", 0)
+    if provisioned:
+        return max(1, provisioned * PROVISIONED_SHARE)
+    return ON_DEMAND_WCU
+
+
+def copy_table(source, loader, segments=4, turns_only=False):
+    """
+    Copies a table into another with a parallel scan. Run it again with
+    turns_only after the app has switched tables to catch up on the turns
+    written while the first copy ran; turns never change once written, so
+    writing them again is harmless.
+
+    :param source: An Interactions object for the table to read.
+    :param loader: A BulkLoader for the table to write.
+    :param segments: Segments scanned in parallel.
+    :param turns_only: Copy only the turns, not summaries or idempotency records.
+    :return: The number of items copied.
+    """
+    return loader.load(source.scan_all(segments, include_meta=not turns_only))
+
+
+def match_capacity(source_table, destination_table, on_demand=False):
+    """
+    Gives a new table the billing mode and capacity of the table it replaces,
+    as it is created with only 10 write units, which would also cap the
+    load's default rate at 8 units per second.
+
+    :param source_table: The Boto3 Table being replaced.
+    :param destination_table: The Boto3 Table replacing it.
+    :param on_demand: Give the new table on-demand capacity whatever the
+                      source has.
+    """
+    client = destination_table.meta.client
+    destination_on_demand = (destination_table.billing_mode_summary or {}).get("BillingMode") == "PAY_PER_REQUEST"
+    if on_demand or (source_table.billing_mode_summary or {}).get("BillingMode") == "PAY_PER_REQUEST":
+        if destination_on_demand:
+            return
+        update = {"BillingMode": "PAY_PER_REQUEST"}
+    else:
+        throughput = {
+            key: source_table.provisioned_throughput[key] for key in ("ReadCapacityUnits", "WriteCapacityUnits")
+        }
+        current = {key: (destination_table.provisioned_throughput or {}).get(key) for key in throughput}
+        if not destination_on_demand and current == throughput:
+            return
+        update = {"BillingMode": "PROVISIONED", "ProvisionedThroughput": throughput}
+    client.update_table(TableName=destination_table.name, **update)
+    client.get_waiter("table_exists").wait(TableName=destination_table.name)
+    destination_table.reload()
+    logger.info("Set the capacity of %s: %s", destination_table.name, update)
+
+
+def rebuild(dyn_resource, source_name, destination_name, workers=8, max_wcu=None, segments=4, on_demand=False):
+    """
+    Copies a table into a new one, which the app can then be switched to
+    without downtime. The source table is only read. The new table gets the
+    source's billing mode and capacity before it is filled.
+
+    :param dyn_resource: A Boto3 DynamoDB resource.
+    :param source_name: The table the app uses now.
+    :param destination_name: The table to create and fill.
+    :param workers: Batch writers running at once.
+    :param max_wcu: The most write units per second; see BulkLoader.
+    :param segments: Segments of the source scanned in parallel.
+    :param on_demand: Give the new table on-demand capacity instead of the source's.
+    :return: The number of items copied.
+    """
+    source = Interactions(dyn_resource, logger=logger)
+    if not source.exists(source_name):
+        raise ValueError(f"table {source_name} does not exist")
+    destination = Interactions(dyn_resource, logger=logger)
+    bootstrap(destination, destination_name)
+    match_capacity(source.table, destination.table, on_demand)
+    loader = BulkLoader(dyn_resource, destination_name, workers=workers, max_wcu=max_wcu)
+    copied = copy_table(source, loader, segments)
+    logger.info(
+        "Copied %s items from %s to %s. To switch over: set DDB_TABLE=%s on the App Runner service, "
+        "wait for the deployment, run\n  python3 bulk_load.py copy --source %s --destination %s --turns-only\n"
+        "to copy the turns written in the meantime, then delete %s once you're satisfied.",
+        copied, source_name, destination_name, destination_name, source_name, destination_name, source_name,
+    )
+    return copied
+
+
+def rebuild_name(table_name):
+    """
+    :param table_name: The table being rebuilt.
+    :return: A name for the new table, unique to the second.
+    """
+    return f"{table_name}-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load items into the interactions table, or copy it into a new one.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    load_parser = subparsers.add_parser("load", help="Load a JSON lines file or a JSON array of items.")
+    load_parser.add_argument("--file", required=True, help="A .json, .jsonl, .json.gz or .jsonl.gz file.")
+    load_parser.add_argument("--table", default=os.environ.get("DDB_TABLE"), help="The table (defaults to DDB_TABLE).")
+    copy_parser = subparsers.add_parser("copy", help="Copy one existing table into another.")
+    copy_parser.add_argument("--turns-only", action="store_true",
+                             help="Copy only the turns, to catch up after switching tables.")
+    rebuild_parser = subparsers.add_parser("rebuild", help="Create a new table and copy a table into it.")
+    rebuild_parser.add_argument("--on-demand", action="store_true", help="Give the new table on-demand capacity instead of the source's.")
+    for subparser in (copy_parser, rebuild_parser):
+        subparser.add_argument("--source", default=os.environ.get("DDB_TABLE"),
+                               help="The table to read (defaults to DDB_TABLE).")
+        subparser.add_argument("--destination", help="The table to write; a timestamped name by default for rebuild.")
+        subparser.add_argument("--segments", type=int, default=4, help="Segments of the source scanned in parallel.")
+    for subparser in (load_parser, copy_parser, rebuild_parser):
+        subparser.add_argument("--workers", type=int, default=8, help="Batch writers running at once.")
+        subparser.add_argument("--max-wcu", type=float,
+                               help="Most write units per second; defaults to 80%% of the table's provisioned capacity.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+    if args.command == "load":
+        if not args.table:
+            parser.error("--table or DDB_TABLE is required")
+        if not Interactions(dynamodb, logger=logger).exists(args.table):
+            parser.error(f"table {args.table} does not exist; create it with bootstrap.py")
+        loader = BulkLoader(dynamodb, args.table, workers=args.workers, max_wcu=args.max_wcu)
+        loader.load(read_items(args.file))
+    elif args.command == "copy":
+        if not args.source or not args.destination:
+            parser.error("--source (or DDB_TABLE) and --destination are required")
+        source = Interactions(dynamodb, logger=logger)
+        if not source.exists(args.source):
+            parser.error(f"table {args.source} does not exist")
+        if not Interactions(dynamodb, logger=logger).exists(args.destination):
+            parser.error(f"table {args.destination} does not exist; use rebuild to create it")
+        loader = BulkLoader(dynamodb, args.destination, workers=args.workers, max_wcu=args.max_wcu)
+        copy_table(source, loader, args.segments, turns_only=args.turns_only)
+    else:
+        if not args.source:
+            parser.error("--source or DDB_TABLE is required")
+        rebuild(dynamodb, args.source, args.destination or rebuild_name(args.source), workers=args.workers,
+                max_wcu=args.max_wcu, segments=args.segments, on_demand=args.on_demand)
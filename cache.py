@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+
+class LRUCache:
+    """An in-process, size-bounded LRU cache whose entries expire after a TTL.
+
+    The cache is safe to share between threads and keeps hit, miss, eviction and
+    expiration counters.
+
+    Example:
+        cache = LRUCache(max_size=1000, ttl=300)
+        cache.set("whatsapp:+256700000000", [])
+        cache.get("whatsapp:+256700000000")
+    """
+
+    def __init__(self, max_size=1000, ttl=300, clock=time.monotonic):
+        """
+        :param max_size: Maximum number of entries kept.
+        :param ttl: Seconds an entry stays valid after it was set.
+        :param clock: Function returning the current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> (expires_at, value), least recently used first
+        self.entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+
+    def get(self, key):
+        """
+        Gets a value and marks it as recently used.
+
+        :param key: The cache key.
+        :return: The cached value, or None when absent or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self.entries[key]
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+
+    def set(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries when full.
+
+        :param key: The cache key.
+        :param value: The value to store.
+        """
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+
+    def delete(self, key):
+        """
+        Removes a value if present.
+
+        :param key: The cache key.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def stats(self):
+        """
+        :return: The counters and current size of the cache.
+        """
+        with self.lock:
+            return dict(self.counters, size=len(self.entries))
+
+
+class RedisCache:
+    """A cache shared between instances, backed by Redis.
+
+    It has the same interface as LRUCache so either can be handed to the
+    classes that cache data. Values must be JSON serializable. Size is bounded
+    by the Redis maxmemory policy, so evictions are counted by Redis itself.
+    Requires the optional redis package.
+    """
+
+    def __init__(self, url, ttl=300, prefix="apprunner:"):
+        """
+        :param url: The Redis URL, such as redis://cache.example.com:6379/0.
+        :param ttl: Seconds an entry stays valid after it was set.
+        :param prefix: Prefix added to every key.
+        """
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        with self.lock:
+            self.counters["hits" if raw is not None else "misses"] += 1
+        return None if raw is None else json.loads(raw)
+
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value, default=json_default), ex=self.ttl)
+
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def json_default(value):
+    """
+    Serializes the values json can't, for json.dumps(default=json_default).
+    DynamoDB returns numbers as Decimal, which become ints or floats.
+
+    :param value: A value json.dumps can't serialize.
+    :return: A serializable value.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
@@ -0,0 +1,534 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+from twilio.base.exceptions import TwilioException
+from twilio.rest import Client
+
+from cache import RedisCache
+from chatapp import ChatApp
+from delivery import SUCCESS_STATUSES, TERMINAL_STATUSES
+from interactions import Interactions, SUMMARY_KEY, make_timestamp, parse_timestamp, sortable_timestamp
+from segmenter import WHATSAPP_MAX_CHARS, split_message
+
+logger = logging.getLogger(__name__)
+
+# Sort key prefix of the item recording a campaign's outcome for a phone. Like
+# the summary it sorts before every turn, so conversations don't include it.
+CAMPAIGN_KEY_PREFIX = "#campaign#"
+NUDGE_PROMPT = ("Write a short WhatsApp message following up with {name}, whom you last mentored {days} days ago. "
+    "Ask how their business idea is going, mention something specific from your conversation, "
+    "and invite them to reply with an update. Answer with the message only, in at most three sentences.")
+
+
+def select_candidates(interactions, inactive_days, max_age_days=None, mentor_types=None, segments=4, now=None):
+    """
+    Finds the phones to nudge with a parallel scan of the turns, keeping each
+    phone's latest turn. Memory grows with the number of phones.
+
+    :param interactions: An Interactions object whose table exists.
+    :param inactive_days: Only phones silent for at least this many days.
+    :param max_age_days: Only phones active within this many days, if given.
+    :param mentor_types: Only phones whose latest turn has one of these mentor types.
+    :param segments: Segments scanned in parallel.
+    :param now: The aware datetime the days are counted from; defaults to now.
+    :return: Dicts of phone, timestamp, mentor_type and name of the latest
+             turn, sorted by phone.
+    """
+    now = now or datetime.now(timezone.utc)
+    newest = make_timestamp(now - timedelta(days=inactive_days))
+    oldest = make_timestamp(now - timedelta(days=max_age_days)) if max_age_days else None
+    latest = {}
+    for item in interactions.scan_all(segments, ["phone", "timestamp", "mentor_type", "name"]):
+        current = latest.get(item["phone"])
+        if current is None or sortable_timestamp(item["timestamp"]) > sortable_timestamp(current["timestamp"]):
+            latest[item["phone"]] = item
+    candidates = []
+    for phone, item in sorted(latest.items()):
+        timestamp = sortable_timestamp(item["timestamp"])
+        if timestamp > newest or (oldest is not None and timestamp < oldest):
+            continue
+        if mentor_types and item.get("mentor_type") not in mentor_types:
+            continue
+        candidates.append({
+            "phone": phone,
+            "timestamp": item["timestamp"],
+            "mentor_type": item.get("mentor_type") or "AI",
+            "name": item.get("name") or "",
+        })
+    return candidates
+
+
+class Checkpoint:
+    """The progress of a campaign, kept in two files so it can be resumed.
+
+    The candidates are written once, as JSON lines, next to a small JSON file
+    holding the campaign, the index of the first candidate whose batch isn't
+    fully recorded, and the counts so far. The JSON file is replaced
+    atomically after every batch, so a crash leaves the previous checkpoint.
+
+    Example:
+        checkpoint = Checkpoint("campaign-june.json")
+        state = checkpoint.load()
+        if state is None:
+            checkpoint.start("june", select_candidates(interactions, 14))
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The checkpoint file; the candidates go to the same path
+                     with .candidates.jsonl added.
+        """
+        self.path = path
+        self.candidates_path = path + ".candidates.jsonl"
+
+
+    def load(self):
+        """
+        :return: The saved state, or None when there is no checkpoint.
+        """
+        try:
+            with open(self.path, encoding="utf-8") as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+
+
+    def candidates(self):
+        """
+        :return: The candidates saved by start.
+        """
+        with open(self.candidates_path, encoding="utf-8") as candidates_file:
+            return [json.loads(line) for line in candidates_file if line.strip()]
+
+
+    def start(self, campaign_id, candidates):
+        """
+        Saves the candidates of a new campaign and a checkpoint at its start.
+
+        :param campaign_id: The campaign.
+        :param candidates: The candidates from select_candidates.
+        :return: The new state.
+        """
+        with open(self.candidates_path + ".tmp", "w", encoding="utf-8") as candidates_file:
+            for candidate in candidates:
+                candidates_file.write(json.dumps(candidate, ensure_ascii=False) + "\n")
+        os.replace(self.candidates_path + ".tmp", self.candidates_path)
+        state = {"campaign": campaign_id, "selected_at": make_timestamp(), "total": len(candidates), "next": 0, "counts": {}}
+        self.save(state)
+        return state
+
+
+    def save(self, state):
+        """
+        :param state: The state to save.
+        """
+        with open(self.path + ".tmp", "w", encoding="utf-8") as checkpoint_file:
+            json.dump(state, checkpoint_file, indent=2)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Pacer:
+    """Spaces calls evenly at a fixed rate, across threads."""
+
+    def __init__(self, rate):
+        """
+        :param rate: Calls per second.
+        """
+        self.interval = 1 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        """
+        Blocks until the caller's turn.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Campaign:
+    """Sends a generated follow-up message to each of many phones.
+
+    Candidates are handled in batches. For each batch, one round of
+    BatchGetItem fetches every phone's latest turn, summary and record of
+    this campaign; messages are then generated concurrently, at most
+    llm_concurrency at a time, and sent through Twilio by send_workers
+    threads at no more than send_rate messages per second. Twilio accepts a
+    message it can't deliver, such as a free-form message outside WhatsApp's
+    24 hour window, so a batch's messages are then polled until WhatsApp has
+    them, for up to confirm_timeout seconds. Outcomes are stored with batched
+    writes: a campaign record per phone, and the message itself as a turn
+    marked "kind": "nudge", so the mentor sees it when the user replies.
+
+    A phone is claimed with a conditional put of a "sending" record before
+    its message goes out, so of two runs of the same campaign at once only
+    one messages it. A phone whose record is "sent" or "sending" is never
+    messaged again by the same campaign, so after a crash between sending
+    and recording, the
+    phone is counted as unknown instead of being messaged twice. So is a
+    phone whose message was still queued at confirm_timeout.
+
+    WhatsApp only delivers free-form messages within 24 hours of the user's
+    last message; past that, messages need an approved template, content_sid.
+
+    Example:
+        campaign = Campaign(interactions, twilio_client, "whatsapp:+15550000000", "june")
+        counts = campaign.run(candidates)
+    """
+
+    def __init__(self, interactions, twilio_client, from_, campaign_id, model="gpt-4", prompt=NUDGE_PROMPT,
+                 llm_concurrency=8, send_rate=10, send_workers=4, batch_size=50, content_sid=None,
+                 history_cache=None, retry_failed=False, dry_run=False, confirm_timeout=30, logger=None):
+        """
+        :param interactions: An Interactions object whose table exists.
+        :param twilio_client: The Twilio client.
+        :param from_: The WhatsApp number messages are sent from.
+        :param campaign_id: Names the campaign; a phone gets one message per campaign.
+        :param model: The model that writes the messages.
+        :param prompt: The instruction given to the model, with {name} and {days} fields.
+        :param llm_concurrency: Messages generated at once.
+        :param send_rate: Messages sent per second.
+        :param send_workers: Threads sending messages.
+        :param batch_size: Phones handled per batch and checkpoint.
+        :param content_sid: Optional approved WhatsApp template, sent with the
+                            generated message as its {{1}} variable.
+        :param history_cache: Optional RedisCache the app keeps histories in,
+                              cleared for every phone messaged.
+        :param retry_failed: Message again phones whose earlier send failed.
+        :param dry_run: Generate and log the messages without sending or recording them.
+        :param confirm_timeout: Seconds a batch's messages may take to reach
+                                WhatsApp before they are recorded as unconfirmed.
+        :param logger: Logger used to report progress and failures.
+        """
+        self.interactions = interactions
+        self.twilio_client = twilio_client
+        self.from_ = from_
+        self.campaign_id = campaign_id
+        self.model = model
+        self.prompt = prompt
+        self.llm_concurrency = llm_concurrency
+        self.pacer = Pacer(send_rate)
+        self.send_workers = send_workers
+        self.batch_size = batch_size
+        self.content_sid = content_sid
+        self.history_cache = history_cache
+        self.retry_failed = retry_failed
+        self.dry_run = dry_run
+        self.confirm_timeout = confirm_timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+
+    @property
+    def record_key(self):
+        return CAMPAIGN_KEY_PREFIX + self.campaign_id
+
+
+    def run(self, candidates, start=0, counts=None, on_batch=None):
+        """
+        Handles the candidates from start on.
+
+        :param candidates: The candidates from select_candidates.
+        :param start: The index of the first candidate to handle.
+        :param counts: Counts carried over from an earlier run.
+        :param on_batch: Optional on_batch(next, counts) called after each
+                         batch is recorded, to checkpoint progress.
+        :return: The counts of phones by outcome.
+        """
+        counts = dict(counts or {})
+        started = time.monotonic()
+        handled = 0
+        with ThreadPoolExecutor(self.llm_concurrency, thread_name_prefix="campaign-llm") as generators, \
+                ThreadPoolExecutor(self.send_workers, thread_name_prefix="campaign-send") as senders:
+            for batch_start in range(start, len(candidates), self.batch_size):
+                batch = candidates[batch_start:batch_start + self.batch_size]
+                for outcome in self._run_batch(batch, generators, senders):
+                    counts[outcome] = counts.get(outcome, 0) + 1
+                handled += len(batch)
+                if on_batch is not None:
+                    on_batch(batch_start + len(batch), counts)
+                self.logger.info(
+                    "Campaign %s: %s of %s phones done, %.1f phones/s, %s",
+                    self.campaign_id, batch_start + len(batch), len(candidates),
+                    handled / max(time.monotonic() - started, 1e-9), counts,
+                )
+        return counts
+
+
+    def _run_batch(self, batch, generators, senders):
+        # Returns the outcome of every phone of the batch
+        states = self._states(batch)
+        outcomes = []
+        todo = []
+        for candidate in batch:
+            record = states[candidate["phone"]]["record"]
+            if record is None or (record["status"] == "failed" and self.retry_failed):
+                todo.append(candidate)
+            elif record["status"] == "sending":
+                # Claimed by a run that stopped before recording the outcome
+                outcomes.append("unknown")
+            else:
+                outcomes.append("skipped")
+
+        messages = list(generators.map(lambda candidate: self._generate(candidate, states[candidate["phone"]]), todo))
+        generated = [(candidate, message) for candidate, message in zip(todo, messages) if message is not None]
+        outcomes.extend("generation_failed" for message in messages if message is None)
+        if self.dry_run:
+            for candidate, message in generated:
+                self.logger.info("Would send to %s: %s", candidate["phone"], message)
+            return outcomes + ["generated"] * len(generated)
+
+        claimed = list(senders.map(lambda pair: self._claim(pair[0]), generated))
+        # Another run claimed these since their records were read
+        outcomes.extend("skipped" for ok in claimed if not ok)
+        generated = [pair for pair, ok in zip(generated, claimed) if ok]
+        results = list(senders.map(lambda pair: self._send(*pair), generated))
+        statuses = self._confirm([sid for sids, error in results if error is None for sid in sids], senders)
+        items = []
+        for (candidate, message), (sids, error) in zip(generated, results):
+            if error is None:
+                error = next((f"message {sid} {statuses[sid]}" for sid in sids
+                              if statuses[sid] in TERMINAL_STATUSES and statuses[sid] not in SUCCESS_STATUSES), None)
+            if error is None and all(statuses[sid] in SUCCESS_STATUSES for sid in sids):
+                items.append(self._record(candidate, "sent", message_sids=sids, message=message))
+                items.append({
+                    "phone": candidate["phone"],
+                    "timestamp": make_timestamp(),
+                    # The mentor wrote first; there is no user message to this turn
+                    "kind": "nudge",
+                    "campaign": self.campaign_id,
+                    "received_message": "",
+                    "sent_message": message,
+                    "mentor_type": candidate["mentor_type"],
+                    "name": candidate["name"],
+                })
+                outcomes.append("sent")
+            elif error is None:
+                # Still queued; it may yet be delivered, so it isn't sent again
+                items.append(self._record(candidate, "sending", message_sids=sids, message=message))
+                outcomes.append("unknown")
+            else:
+                items.append(self._record(candidate, "failed", message_sids=sids, error=error))
+                outcomes.append("failed")
+        self.interactions.write_batch(items)
+        if self.history_cache is not None:
+            for candidate, _ in generated:
+                self.history_cache.delete(candidate["phone"])
+        return outcomes
+
+
+    def _states(self, batch):
+        # Each phone's latest turn, summary and campaign record, in one round
+        # of BatchGetItem calls
+        keys = []
+        for candidate in batch:
+            keys.append({"phone": candidate["phone"], "timestamp": candidate["timestamp"]})
+            keys.append({"phone": candidate["phone"], "timestamp": SUMMARY_KEY})
+            keys.append({"phone": candidate["phone"], "timestamp": self.record_key})
+        states = {candidate["phone"]: {"latest": None, "summary": None, "record": None} for candidate in batch}
+        for item in self.interactions.batch_get(keys):
+            state = states[item["phone"]]
+            if item["timestamp"] == SUMMARY_KEY:
+                state["summary"] = {"summary": item["summary"], "through": item["through"]}
+            elif item["timestamp"] == self.record_key:
+                state["record"] = item
+            else:
+                state["latest"] = item
+        return states
+
+
+    def _generate(self, candidate, state):
+        # Returns the message, or None when it couldn't be generated; the
+        # phone is then left unrecorded, so a later run tries again
+        try:
+            chatapp = ChatApp(candidate["mentor_type"])
+            records = [state["latest"]] if state["latest"] is not None else []
+            chatapp.add_history(records, summary=state["summary"])
+            days = (datetime.now(timezone.utc) - parse_timestamp(sortable_timestamp(candidate["timestamp"]))).days
+            chatapp.messages.append({
+                "role": "user",
+                "content": self.prompt.format(name=candidate["name"] or "the entrepreneur", days=days),
+            })
+            response = chatapp.client.chat_completion(self.model, chatapp.messages, estimated_tokens=chatapp.prompt_tokens())
+            message = response["choices"][0]["message"].content.strip()
+        except Exception as err:
+            self.logger.warning("Couldn't write the message for %s. Here's why: %s", candidate["phone"], err)
+            return None
+        return message or None
+
+
+    def _send(self, candidate, message):
+        # Returns the SIDs of the chunks sent, and an error when a chunk failed
+        sids = []
+        chunks = [message] if self.content_sid else list(split_message(message, WHATSAPP_MAX_CHARS))
+        for chunk in chunks:
+            self.pacer.wait()
+            try:
+                if self.content_sid:
+                    sent = self.twilio_client.messages.create(
+                        to=candidate["phone"], from_=self.from_, content_sid=self.content_sid,
+                        content_variables=json.dumps({"1": chunk}),
+                    )
+                else:
+                    sent = self.twilio_client.messages.create(to=candidate["phone"], from_=self.from_, body=chunk)
+            except TwilioException as err:
+                self.logger.error("Couldn't send the message to %s. Here's why: %s", candidate["phone"], err)
+                return sids, str(err)
+            sids.append(sent.sid)
+        return sids, None
+
+
+    def _claim(self, candidate):
+        # Returns whether the phone's "sending" record was written, which it
+        # isn't when another run has recorded the phone first
+        put_kwargs = {"Item": self._record(candidate, "sending"), "ConditionExpression": "attribute_not_exists(phone)"}
+        if self.retry_failed:
+            put_kwargs.update(
+                ConditionExpression="attribute_not_exists(phone) OR #status = :failed",
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={":failed": "failed"},
+            )
+        try:
+            self.interactions.table.put_item(**put_kwargs)
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            self.logger.error(
+                "Couldn't claim %s for campaign %s. Here's why: %s: %s",
+                candidate["phone"],
+                self.campaign_id,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        return True
+
+
+    def _confirm(self, sids, senders):
+        # Polls the messages until WhatsApp has them or they fail, and returns
+        # sid -> last status seen
+        statuses = {sid: "queued" for sid in sids}
+        pending = list(sids)
+        deadline = time.monotonic() + self.confirm_timeout
+        while pending and time.monotonic() < deadline:
+            time.sleep(1)
+            for sid, status in zip(pending, senders.map(self._fetch_status, pending)):
+                if status is not None:
+                    statuses[sid] = status
+            pending = [sid for sid in pending
+                       if statuses[sid] not in SUCCESS_STATUSES and statuses[sid] not in TERMINAL_STATUSES]
+        return statuses
+
+
+    def _fetch_status(self, sid):
+        try:
+            return self.twilio_client.messages(sid).fetch().status
+        except TwilioException as err:
+            self.logger.warning("Couldn't fetch the status of %s. Here's why: %s", sid, err)
+            return None
+
+
+    def _record(self, candidate, status, **details):
+        return dict(
+            {"phone": candidate["phone"], "timestamp": self.record_key, "status": status, "updated_at": make_timestamp()},
+            **details
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a generated follow-up message to past mentees.")
+    parser.add_argument("--campaign", required=True, help="Names the campaign; a phone gets one message per campaign.")
+    parser.add_argument("--table", default=os.environ.get("DDB_TABLE"), help="The table (defaults to DDB_TABLE).")
+    parser.add_argument("--checkpoint", help="The checkpoint file; defaults to campaign-<campaign>.json.")
+    parser.add_argument("--inactive-days", type=int, default=14, help="Only phones silent for at least this many days.")
+    parser.add_argument("--max-age-days", type=int, default=180, help="Only phones active within this many days; 0 for all.")
+    parser.add_argument("--mentor-types", help="Comma-separated mentor types to include; defaults to all.")
+    parser.add_argument("--limit", type=int, help="The most phones to select.")
+    parser.add_argument("--segments", type=int, default=4, help="Segments scanned in parallel when selecting phones.")
+    parser.add_argument("--model", default=os.environ.get("MAIN_MODEL", "gpt-4"), help="The model (defaults to MAIN_MODEL).")
+    parser.add_argument("--prompt-file", help="A file holding the instruction to the model, with {name} and {days} fields.")
+    parser.add_argument("--llm-concurrency", type=int, default=int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8")),
+                        help="Messages generated at once (defaults to OPENAI_MAX_CONCURRENCY).")
+    parser.add_argument("--send-rate", type=float, default=10, help="Messages sent per second.")
+    parser.add_argument("--send-workers", type=int, default=4, help="Threads sending messages.")
+    parser.add_argument("--batch-size", type=int, default=50, help="Phones handled per batch and checkpoint.")
+    parser.add_argument("--content-sid", help="An approved WhatsApp template to send the message in, as variable {{1}}; "
+                        "required unless --inactive-days is 0, as WhatsApp drops free-form messages after 24 hours.")
+    parser.add_argument("--retry-failed", action="store_true", help="Message again phones whose earlier send failed.")
+    parser.add_argument("--dry-run", action="store_true", help="Generate and log the messages without sending them.")
+    args = parser.parse_args()
+    if not args.table:
+        parser.error("--table or DDB_TABLE is required")
+    if os.environ.get("INTERACTIONS_LAYOUT", "items") != "items":
+        parser.error("campaigns read the item-per-turn layout; unset INTERACTIONS_LAYOUT")
+    if args.inactive_days >= 1 and not args.content_sid and not args.dry_run:
+        parser.error("--content-sid is required with --inactive-days 1 or more: "
+                     "WhatsApp only delivers free-form messages within 24 hours of the user's last message")
+
+    logging.basicConfig(level=logging.INFO)
+    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+    interactions = Interactions(dynamodb, logger=logger)
+    if not interactions.exists(args.table):
+        parser.error(f"table {args.table} does not exist")
+
+    checkpoint = Checkpoint(args.checkpoint or f"campaign-{args.campaign}.json")
+    state = checkpoint.load()
+    if state is not None and state["campaign"] != args.campaign:
+        parser.error(f"{checkpoint.path} belongs to campaign {state['campaign']}")
+    if state is None:
+        candidates = select_candidates(
+            interactions, args.inactive_days, args.max_age_days,
+            args.mentor_types.split(",") if args.mentor_types else None, args.segments,
+        )[:args.limit]
+        state = checkpoint.start(args.campaign, candidates)
+        logger.info("Selected %s phones for campaign %s", len(candidates), args.campaign)
+    else:
+        candidates = checkpoint.candidates()
+        logger.info("Resuming campaign %s at phone %s of %s", args.campaign, state["next"], state["total"])
+
+    prompt = NUDGE_PROMPT
+    if args.prompt_file:
+        with open(args.prompt_file, encoding="utf-8") as prompt_file:
+            prompt = prompt_file.read().strip()
+    history_cache = None
+    if os.environ.get("HISTORY_CACHE_REDIS_URL"):
+        history_cache = RedisCache(os.environ["HISTORY_CACHE_REDIS_URL"], prefix="history:")
+
+    def save_progress(next_index, counts):
+        if not args.dry_run:
+            state.update(next=next_index, counts=counts)
+            checkpoint.save(state)
+
+    campaign = Campaign(
+        interactions,
+        Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"]),
+        os.environ["SERVER_PHONE"],
+        args.campaign,
+        model=args.model,
+        prompt=prompt,
+        llm_concurrency=args.llm_concurrency,
+        send_rate=args.send_rate,
+        send_workers=args.send_workers,
+        batch_size=args.batch_size,
+        content_sid=args.content_sid,
+        history_cache=history_cache,
+        retry_failed=args.retry_failed,
+        dry_run=args.dry_run,
+        logger=logger,
+    )
+    counts = campaign.run(candidates, start=state["next"], counts=state["counts"], on_batch=save_progress)
+    logger.info("Campaign %s finished: %s", args.campaign, counts)
@@ -1,11 +1,64 @@
-import os
+import functools
 import openai
+from llm_client import get_client, CircuitOpenError, DeadlineExceededError, FALLBACK_REPLY, RETRYABLE_ERRORS
+from router import Route
+
+# Characters per token used when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+# Tokens added by the chat format around every message
+TOKENS_PER_MESSAGE = 4
+# Used when the caller does not route the reply
+DEFAULT_ROUTE = Route("gpt-4", None, None, "default")
+# Tokens expected in an answer, charged to the tokens-per-minute quota up front
+ANSWER_TOKENS = 800
+
+SUMMARY_PROMPT = ("Summarize the mentoring conversation below for the mentor's own notes. "
+    "Keep the user's business idea, their situation, the advice already given and any open questions. "
+    "Answer with the summary only, in at most 200 words.")
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.encoding_for_model("gpt-4")
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """
+    Counts the tokens of a message, using tiktoken when it is installed and a
+    character estimate otherwise. Results are cached per text.
+
+    :param text: The message text.
+    :return: The number of tokens.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text))
+
+
+def turn_tokens(record):
+    """
+    :param record: An interaction record.
+    :return: The tokens used by the record's two messages, read from the record
+             when it was stored with a count.
+    """
+    if record.get("tokens") is not None:
+        return int(record["tokens"])
+    return count_tokens(record["received_message"]) + count_tokens(record["sent_message"]) + 2 * TOKENS_PER_MESSAGE
+
 
 class ChatApp:
     def __init__(self, mentor_type):
-        # Setting the API key to use the OpenAI API
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+        # The shared client holds the API key and the connection pool
+        self.client = get_client()
         self.mentor_type = mentor_type
+        # Why the last reply is a canned message instead of the model's answer, or None
+        self.failure = None
         if mentor_type == 'local':
             self.messages = [
                 {"role": "system", "content":  ("You are a highly integrated local entrepreneur mentor based in Kampala. "
@@ -28,21 +81,186 @@ class ChatApp:
         "Your goal is to evaluate business ideas critically and offer specific, actionable guidance to enhance their feasibility and implementation.")}
             ]
 
-    def chat(self, message):
+    def add_history(self, records, summary=None, token_budget=None, reserved_tokens=0, summary_model=None):
+        """
+        Adds past turns to the prompt while keeping it under a token budget.
+        The persona prompt and the newest turns are kept verbatim. Older turns
+        are replaced by a rolling summary, which is only recomputed once the
+        turns since the last summary no longer fit; it then covers all but
+        the newest half of the budget so it stays valid for several messages.
+
+        :param records: The interaction records, oldest first.
+        :param summary: The stored summary as {"summary": text, "through": timestamp}.
+        :param token_budget: The maximum prompt size in tokens; None keeps every turn.
+        :param reserved_tokens: Tokens kept free for the message about to be sent.
+        :param summary_model: The model that writes the summary; defaults to
+                              the model of DEFAULT_ROUTE.
+        :return: The new summary when it was recomputed; otherwise, None.
+        """
+        if summary is not None:
+            records = [record for record in records if record["timestamp"] > summary["through"]]
+        if token_budget is None:
+            self._add_summary_and_turns(summary, records)
+            return None
+
+        available = token_budget - reserved_tokens - sum(count_tokens(m["content"]) + TOKENS_PER_MESSAGE for m in self.messages)
+        if summary is not None:
+            available -= count_tokens(summary["summary"]) + TOKENS_PER_MESSAGE
+        if not records or sum(turn_tokens(record) for record in records) <= available:
+            self._add_summary_and_turns(summary, records)
+            return None
+
+        # Keep the newest turns that fit in half of the room and summarize the rest
+        kept = []
+        used = 0
+        for record in reversed(records):
+            used += turn_tokens(record)
+            if used > available // 2:
+                break
+            kept.insert(0, record)
+        summarized = records[:len(records) - len(kept)]
+        try:
+            new_summary = {
+                "summary": self.summarize(summary["summary"] if summary else None, summarized, model=summary_model),
+                "through": summarized[-1]["timestamp"],
+            }
+        except Exception as e:
+            # Answer from the newest turns alone rather than fail the reply
+            print(f"Summary error: {e}")
+            self._add_summary_and_turns(summary, kept)
+            return None
+        self._add_summary_and_turns(new_summary, kept)
+        return new_summary
+
+
+    def summarize(self, previous_summary, records, model=None):
+        """
+        Folds turns into a running summary of the conversation.
+
+        :param previous_summary: The summary so far, if any.
+        :param records: The interaction records to fold in, oldest first.
+        :param model: The model that writes the summary; defaults to the model
+                      of DEFAULT_ROUTE.
+        :return: The updated summary text.
+        """
+        transcript = []
+        if previous_summary:
+            transcript.append(f"Summary so far: {previous_summary}")
+        for record in records:
+            # A campaign's nudge is a mentor message the user didn't ask for
+            if record.get("kind") != "nudge":
+                transcript.append(f"User: {record['received_message']}")
+            transcript.append(f"Mentor: {record['sent_message']}")
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": "\n".join(transcript)},
+        ]
+        response = self.client.chat_completion(
+            model or DEFAULT_ROUTE.model, messages, estimated_tokens=self.prompt_tokens(messages)
+        )
+        return response["choices"][0]["message"].content
+
+
+    def _complete(self, route, **kwargs):
+        try:
+            return self.client.chat_completion(
+                route.model, self.messages, estimated_tokens=self.prompt_tokens(), timeout=route.timeout, **kwargs
+            )
+        except (openai.error.Timeout, DeadlineExceededError) as e:
+            if route.fallback is None:
+                raise
+            print(f"{route.model} timed out ({e}), failing over to {route.fallback}")
+            return self.client.chat_completion(
+                route.fallback, self.messages, estimated_tokens=self.prompt_tokens(), **kwargs
+            )
+
+
+    def prompt_tokens(self, messages=None):
+        """
+        :param messages: The messages to count; defaults to the prompt built so far.
+        :return: The prompt tokens plus the tokens expected in the answer.
+        """
+        messages = self.messages if messages is None else messages
+        return sum(count_tokens(m["content"]) + TOKENS_PER_MESSAGE for m in messages) + ANSWER_TOKENS
+
+
+    def _add_summary_and_turns(self, summary, records):
+        if summary is not None:
+            self.messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary['summary']}"})
+        for record in records:
+            if record.get("kind") != "nudge":
+                self.messages.append({"role":"user", "content": record["received_message"]})
+            self.messages.append({"role":"assistant", "content": record['sent_message']})
+
+
+    def chat(self, message, route=DEFAULT_ROUTE):
+        """
+        Answers a message. When the model can't answer, returns a canned
+        message for the user instead and sets failure, so the caller doesn't
+        store it as a turn of the conversation.
+
+        :param message: The user message.
+        :param route: The Route choosing the model.
+        :return: The reply text.
+        """
+        self.failure = None
         try: 
             self.messages.append({"role": "user", "content": message})
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=self.messages
-            )
+            response = self._complete(route)
             self.messages.append({"role": "assistant", "content": response["choices"][0]["message"].content})
             return response["choices"][0]["message"].content
-        except openai.error.InvalidRequestError as e:
+        except Exception as e:
+            self.failure, reply = self._canned_reply(e)
+            return reply
+
+
+    def _canned_reply(self, e):
+        # The failure and the message sent in place of the answer the model couldn't give
+        if isinstance(e, (CircuitOpenError, DeadlineExceededError, *RETRYABLE_ERRORS)):
+            print(f"OpenAI unavailable: {e}")
+            return "unavailable", FALLBACK_REPLY
+        if isinstance(e, openai.error.InvalidRequestError):
             print(f"InvalidRequestError: {e}")
-            return "There was an error with your request. Please check your input and try again."
-        except openai.error.AuthenticationError:
+            return "invalid_request", "There was an error with your request. Please check your input and try again."
+        if isinstance(e, openai.error.AuthenticationError):
             print("Authentication Error: Check your API key.")
-            return "There was an authentication error. Please verify your API key."
+            return "authentication", "There was an authentication error. Please verify your API key."
+        print(f"Unexpected error: {e}")
+        return "error", "An unexpected error occurred. Please try again later."
+
+
+    def chat_stream(self, message, route=DEFAULT_ROUTE):
+        """
+        Like chat, but yields the reply piece by piece as the model generates
+        it. failure is set once the generator is exhausted; when the answer
+        breaks off after some of it was yielded, it is "truncated", and
+        nothing more is yielded.
+
+        :param message: The user message.
+        :param route: The Route choosing the model.
+        :return: A generator of reply text fragments.
+        """
+        self.failure = None
+        self.messages.append({"role": "user", "content": message})
+        parts = []
+        response = None
+        try:
+            response = self._complete(route, stream=True)
+            for event in response:
+                delta = event["choices"][0]["delta"].get("content")
+                if delta:
+                    parts.append(delta)
+                    yield delta
         except Exception as e:
-            print(f"Unexpected error: {e}")
-            return "An unexpected error occurred. Please try again later."
\ No newline at end of file
+            self.failure, reply = self._canned_reply(e)
+            if parts:
+                # Part of the answer went out already; don't garble it with a canned message
+                self.failure = "truncated"
+            else:
+                yield reply
+        else:
+            self.messages.append({"role": "assistant", "content": "".join(parts)})
+        finally:
+            # Frees the connection slot also when the caller stops reading early
+            if response is not None and hasattr(response, "close"):
+                response.close()
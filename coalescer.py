@@ -0,0 +1,176 @@
+import heapq
+import logging
+import threading
+import time
+
+
+class MessageCoalescer:
+    """Merges bursts of messages from one phone and never runs a phone twice at once.
+
+    Each message restarts its phone's debounce window. When the window passes
+    without a new message, or the oldest message has waited max_wait seconds,
+    the buffered messages are handed to dispatch as one batch. Messages that
+    arrive while a phone's batch is being processed wait until finished is
+    called for that phone, and then form the next batch.
+
+    Example:
+        coalescer = MessageCoalescer(lambda phone, batch: pipeline.submit((phone, batch)), window=2)
+        coalescer.start()
+        coalescer.add(phone, message)
+        ...
+        # once the worker has processed the batch
+        coalescer.finished(phone)
+    """
+
+    def __init__(self, dispatch, window=2, max_wait=None, logger=None, clock=time.monotonic, on_drop=None):
+        """
+        :param dispatch: Called as dispatch(phone, batch) from the coalescer's
+                         thread; returns False when the batch could not be taken,
+                         in which case it is retried after another window.
+        :param window: Seconds of quiet that end a burst.
+        :param max_wait: Seconds after which a burst is dispatched regardless;
+                         defaults to three windows.
+        :param logger: Logger used to report failed dispatches.
+        :param clock: Function returning the current time in seconds.
+        :param on_drop: Optional on_drop(phone, batch), called with the
+                        messages that could not be dispatched at shutdown, so
+                        they can be released for a retry.
+        """
+        self.dispatch = dispatch
+        self.window = window
+        self.max_wait = 3 * window if max_wait is None else max_wait
+        self.logger = logger or logging.getLogger(__name__)
+        self.clock = clock
+        self.on_drop = on_drop
+        self.condition = threading.Condition()
+        # phone -> {"pending": [...], "first_at": time, "due": time, "running": bool}
+        self.phones = {}
+        self.schedule = []
+        self.thread = None
+        self.stopping = False
+
+
+    def start(self):
+        """
+        Starts the thread that dispatches batches when they are due.
+        """
+        if self.thread is None:
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+            self.thread.start()
+
+
+    def add(self, phone, message):
+        """
+        Buffers a message.
+
+        :param phone: The phone the message came from.
+        :param message: The message, passed on unchanged in the batch.
+        """
+        with self.condition:
+            now = self.clock()
+            state = self.phones.setdefault(phone, {"pending": [], "first_at": now, "due": None, "running": False})
+            if not state["pending"]:
+                state["first_at"] = now
+            state["pending"].append(message)
+            if not state["running"]:
+                self._schedule(phone, state, now)
+
+
+    def finished(self, phone):
+        """
+        Marks a phone's batch as processed, letting its next batch go ahead.
+
+        :param phone: The phone whose batch was processed.
+        """
+        with self.condition:
+            state = self.phones.get(phone)
+            if state is None:
+                return
+            state["running"] = False
+            if state["pending"]:
+                self._schedule(phone, state, self.clock())
+            else:
+                del self.phones[phone]
+
+
+    def shutdown(self):
+        """
+        Dispatches every buffered batch at once and stops the thread.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    def _schedule(self, phone, state, now):
+        # Must be called with the condition held
+        state["due"] = min(now + self.window, state["first_at"] + self.max_wait)
+        heapq.heappush(self.schedule, (state["due"], phone))
+        self.condition.notify()
+
+
+    def _take_due(self, now, everything):
+        # Must be called with the condition held
+        batches = []
+        if everything:
+            # Shutting down: hand over whatever is buffered rather than lose it
+            for phone, state in self.phones.items():
+                if state["pending"]:
+                    batches.append((phone, state["pending"]))
+                    state["pending"] = []
+                    state["running"] = True
+            self.schedule = []
+            return batches
+        while self.schedule and self.schedule[0][0] <= now:
+            due, phone = heapq.heappop(self.schedule)
+            state = self.phones.get(phone)
+            # Skip entries superseded by a later message or already dispatched
+            if state is None or state["running"] or state["due"] != due or not state["pending"]:
+                continue
+            batches.append((phone, state["pending"]))
+            state["pending"] = []
+            state["running"] = True
+        return batches
+
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not (self.schedule and self.schedule[0][0] <= self.clock()):
+                    timeout = self.schedule[0][0] - self.clock() if self.schedule else None
+                    self.condition.wait(timeout)
+                batches = self._take_due(self.clock(), everything=self.stopping)
+                stopping = self.stopping
+            for phone, batch in batches:
+                try:
+                    taken = self.dispatch(phone, batch)
+                except Exception:
+                    self.logger.exception("Couldn't dispatch messages from %s", phone)
+                    taken = False
+                if taken is False:
+                    self._requeue(phone, batch)
+            if stopping:
+                return
+
+
+    def _requeue(self, phone, batch):
+        with self.condition:
+            state = self.phones[phone]
+            state["pending"] = batch + state["pending"]
+            state["running"] = False
+            if not self.stopping:
+                state["first_at"] = self.clock()
+                self._schedule(phone, state, self.clock())
+                return
+            dropped = state["pending"]
+            del self.phones[phone]
+        self.logger.error("Dropped %s messages from %s at shutdown", len(dropped), phone)
+        if self.on_drop is not None:
+            try:
+                self.on_drop(phone, dropped)
+            except Exception:
+                self.logger.exception("Couldn't release the dropped messages from %s", phone)
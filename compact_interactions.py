@@ -0,0 +1,414 @@
+import struct
+import threading
+import time
+import zlib
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from interactions import Interactions
+
+# Sort key of the item holding a phone's metadata and newest transcript segment
+CONVERSATION_KEY = "#conversation"
+# Sort key prefix of the items holding older, full transcript segments
+SEGMENT_PREFIX = CONVERSATION_KEY + "#"
+# Compressed transcript bytes after which a segment spills into its own item.
+# Every append rewrites the conversation item, and every read fetches it, so
+# it is kept to a few write units rather than near DynamoDB's 400 KB limit
+SEGMENT_BYTES = 12 * 1024
+# Attempts at an optimistic update of the conversation item
+MAX_ATTEMPTS = 5
+# Seconds the summary of a history read may be reused by get_summary
+SUMMARY_REUSE_SECONDS = 5
+
+_LENGTH = struct.Struct(">I")
+
+
+def encode_turns(turns, codec="zlib"):
+    """
+    Packs turns into a compressed, length-prefixed binary transcript. Every turn
+    is its timestamp, received message and sent message as length-prefixed
+    UTF-8 strings, followed by its token count (0 when unknown).
+
+    :param turns: The turns as (timestamp, received_message, sent_message, tokens).
+    :param codec: "zlib", or "zstd" when the zstandard package is installed.
+    :return: The transcript bytes, starting with a byte naming the codec.
+    """
+    raw = bytearray()
+    for timestamp, received_message, sent_message, tokens in turns:
+        for text in (timestamp, received_message, sent_message):
+            data = text.encode("utf-8")
+            raw += _LENGTH.pack(len(data)) + data
+        raw += _LENGTH.pack(tokens or 0)
+    if codec == "zstd":
+        import zstandard
+
+        return b"s" + zstandard.ZstdCompressor().compress(bytes(raw))
+    return b"z" + zlib.compress(bytes(raw))
+
+
+def decode_turns(transcript):
+    """
+    Unpacks a transcript made by encode_turns.
+
+    :param transcript: The transcript bytes.
+    :return: The turns as (timestamp, received_message, sent_message, tokens).
+    """
+    if not transcript:
+        return []
+    if transcript[:1] == b"s":
+        import zstandard
+
+        raw = zstandard.ZstdDecompressor().decompress(transcript[1:])
+    else:
+        raw = zlib.decompress(transcript[1:])
+    turns = []
+    offset = 0
+    while offset < len(raw):
+        fields = []
+        for _ in range(3):
+            (length,) = _LENGTH.unpack_from(raw, offset)
+            offset += _LENGTH.size
+            fields.append(raw[offset:offset + length].decode("utf-8"))
+            offset += length
+        (tokens,) = _LENGTH.unpack_from(raw, offset)
+        offset += _LENGTH.size
+        turns.append((*fields, tokens))
+    return turns
+
+
+class CompactInteractions(Interactions):
+    """Stores each phone's conversation in one item with a compressed transcript.
+
+    The conversation item holds the metadata (mentor type, name, turn count,
+    rolling summary) and the newest transcript segment. When that segment
+    outgrows SEGMENT_BYTES it moves to an overflow item of its own, so reading
+    the newest turns costs a single GetItem however long the conversation is.
+    The conversation item is updated with optimistic locking on its version.
+
+    get_summary takes the summary from the conversation item the thread's last
+    history read fetched, if that read was for the same phone and at most
+    SUMMARY_REUSE_SECONDS ago, instead of reading the item again.
+
+    The table uses the same key schema as Interactions, and the API is the same,
+    so the two layouts are interchangeable. Writes go straight to the table; a
+    write-behind buffer is not used with this layout.
+
+    Example data structure for a conversation item in this table:
+        {
+            "phone": "4082349456",
+            "timestamp": "#conversation",
+            "mentor_type": "refugee",
+            "name": "Jeffrey",
+            "turns": 12,
+            "segments": 0,
+            "transcript": b"z...",
+            "version": 12
+        }
+    """
+
+    def __init__(self, dyn_resource, logger=None, cache=None, codec="zlib"):
+        """
+        :param dyn_resource: A Boto3 DynamoDB resource.
+        :param cache: Optional LRUCache or RedisCache holding each phone's interactions.
+        :param codec: The transcript compression, "zlib" or "zstd".
+        """
+        super().__init__(dyn_resource, logger=logger, cache=cache)
+        self.codec = codec
+        # The summary of the conversation item each thread read last, as
+        # (phone, summary, time.monotonic() of the read)
+        self._last_read = threading.local()
+
+
+    def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None):
+        """
+        Lazily reads the interactions by phone number, segment by segment.
+
+        :param phone: phone number.
+        :param newest_first: Yield the newest interaction first.
+        :param page_size: Unused; segments are read whole.
+        :param limit: Stop after this many interactions.
+        :return: A generator of interactions by phone number.
+        """
+        conversation = self._get_conversation(phone)
+        self._last_read.summary = (phone, self._summary(conversation), time.monotonic())
+        if conversation is None or "transcript" not in conversation:
+            return
+        returned = 0
+        for transcript in self._iter_transcripts(phone, conversation, newest_first):
+            turns = decode_turns(transcript)
+            if newest_first:
+                turns.reverse()
+            for turn in turns:
+                yield self._to_item(phone, conversation, turn)
+                returned += 1
+                if limit is not None and returned >= limit:
+                    return
+
+
+    def scan_all(self, segments=4, attributes=None, page_size=None, include_meta=False):
+        """
+        Reads every interaction of every phone with a parallel scan of the
+        conversation items, decoding their transcripts. Overflow segments are
+        queried per conversation, in the consuming thread.
+
+        :param segments: The number of segments scanned at once.
+        :param attributes: Optional attribute names to keep in each interaction.
+        :param page_size: The number of items each scan call evaluates; keep it
+                          small, as conversation items can be large.
+        :param include_meta: Read the stored items themselves instead, to copy
+                             the table.
+        :return: A generator of interactions.
+        """
+        if include_meta:
+            return super().scan_all(segments, attributes, page_size, include_meta=True)
+        return self._scan_conversations(segments, attributes, page_size)
+
+
+    def _scan_conversations(self, segments, attributes, page_size):
+        scan_kwargs = {
+            "FilterExpression": "#timestamp = :conversation",
+            "ExpressionAttributeNames": {"#timestamp": "timestamp"},
+            "ExpressionAttributeValues": {":conversation": CONVERSATION_KEY},
+        }
+        if page_size:
+            scan_kwargs["Limit"] = page_size
+        for conversation in self._scan_segments(scan_kwargs, segments):
+            if "transcript" not in conversation:
+                continue
+            phone = conversation["phone"]
+            for transcript in self._iter_transcripts(phone, conversation, newest_first=False):
+                for turn in decode_turns(transcript):
+                    item = self._to_item(phone, conversation, turn)
+                    if attributes:
+                        item = {name: item[name] for name in attributes if name in item}
+                    yield item
+
+
+    def get_summary(self, phone):
+        last_read = getattr(self._last_read, "summary", None)
+        self._last_read.summary = None
+        if last_read is not None and last_read[0] == phone and time.monotonic() - last_read[2] <= SUMMARY_REUSE_SECONDS:
+            return last_read[1]
+        try:
+            # Skip the transcript; only the summary is needed
+            response = self.table.get_item(
+                Key={"phone": phone, "timestamp": CONVERSATION_KEY},
+                ProjectionExpression="summary, through",
+                ConsistentRead=True,
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't get the summary for %s. Here's why: %s %s",
+                phone,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        return self._summary(response.get("Item"))
+
+
+    def put_summary(self, phone, summary, through):
+        self._last_read.summary = None
+        try:
+            # Bumping the version makes a concurrent append retry instead of
+            # overwriting the summary with the one it read
+            self.table.update_item(
+                Key={"phone": phone, "timestamp": CONVERSATION_KEY},
+                UpdateExpression="SET summary = :summary, through = :through, "
+                                 "version = if_not_exists(version, :zero) + :one",
+                ExpressionAttributeValues={":summary": summary, ":through": through, ":zero": 0, ":one": 1},
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't store the summary for %s. Here's why: %s %s",
+                phone,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+
+
+    def put_conversation(self, phone, mentor_type, name, turns, summary=None):
+        """
+        Writes a whole conversation at once, as done when converting a table.
+        Does nothing when the phone already has a conversation item.
+
+        :param phone: phone number.
+        :param mentor_type: The mentor type of the conversation.
+        :param name: The user's name.
+        :param turns: The turns, oldest first, as (timestamp, received_message, sent_message, tokens).
+        :param summary: Optional summary as returned by get_summary.
+        :return: True when the conversation was written.
+        """
+        if self._get_conversation(phone) is not None:
+            return False
+        # Split on the uncompressed size, which compression only makes smaller
+        segments = [[]]
+        size = 0
+        for turn in turns:
+            turn_size = 16 + sum(len(text.encode("utf-8")) for text in turn[:3])
+            if segments[-1] and size + turn_size > SEGMENT_BYTES:
+                segments.append([])
+                size = 0
+            segments[-1].append(turn)
+            size += turn_size
+
+        item = {
+            "phone": phone,
+            "timestamp": CONVERSATION_KEY,
+            "mentor_type": mentor_type,
+            "name": name,
+            "turns": len(turns),
+            "segments": len(segments) - 1,
+            "transcript": encode_turns(segments[-1], self.codec),
+            "version": len(turns),
+        }
+        if summary is not None:
+            item.update(summary)
+        try:
+            for number, segment in enumerate(segments[:-1], start=1):
+                self.table.put_item(
+                    Item={
+                        "phone": phone,
+                        "timestamp": f"{SEGMENT_PREFIX}{number:06d}",
+                        "transcript": encode_turns(segment, self.codec),
+                    }
+                )
+            self.table.put_item(Item=item, ConditionExpression="attribute_not_exists(phone)")
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            self.logger.error(
+                "Couldn't write the conversation of %s. Here's why: %s %s",
+                phone,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        return True
+
+
+    def _store(self, item):
+        for _ in range(MAX_ATTEMPTS):
+            conversation = self._get_conversation(item["phone"])
+            try:
+                self._append(item, conversation)
+            except ClientError as err:
+                if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                    # Another writer appended first; read the new version and retry
+                    continue
+                self.logger.error(
+                    "Couldn't add interaction %s, %s, %s to the table %s because %s and %s",
+                    item["phone"],
+                    item["timestamp"],
+                    item["name"],
+                    self.table.name,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                raise
+            return
+        raise RuntimeError(f"Couldn't add the interaction of {item['phone']} after {MAX_ATTEMPTS} attempts")
+
+
+    def _append(self, item, conversation):
+        turn = (item["timestamp"], item["received_message"], item["sent_message"], int(item.get("tokens") or 0))
+        # A conversation item may hold only a summary so far
+        conversation = conversation or {}
+        tail = self._transcript(conversation)
+        segments = int(conversation.get("segments", 0))
+        if len(tail) > SEGMENT_BYTES:
+            # Spill the full segment into its own item and start a new one
+            segments += 1
+            self.table.put_item(
+                Item={
+                    "phone": item["phone"],
+                    "timestamp": f"{SEGMENT_PREFIX}{segments:06d}",
+                    "transcript": tail,
+                }
+            )
+            turns = [turn]
+        else:
+            turns = decode_turns(tail) + [turn]
+
+        version = int(conversation.get("version", 0))
+        self.table.put_item(
+            Item={
+                **{key: conversation[key] for key in ("summary", "through") if key in conversation},
+                "phone": item["phone"],
+                "timestamp": CONVERSATION_KEY,
+                "mentor_type": item["mentor_type"],
+                "name": item["name"],
+                "turns": int(conversation.get("turns", 0)) + 1,
+                "segments": segments,
+                "transcript": encode_turns(turns, self.codec),
+                "version": version + 1,
+            },
+            ConditionExpression="attribute_not_exists(version) OR version = :version",
+            ExpressionAttributeValues={":version": version},
+        )
+
+
+    def _get_conversation(self, phone):
+        try:
+            response = self.table.get_item(
+                Key={"phone": phone, "timestamp": CONVERSATION_KEY}, ConsistentRead=True
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't get the conversation of %s. Here's why: %s %s",
+                phone,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        return response.get("Item")
+
+
+    def _iter_transcripts(self, phone, conversation, newest_first):
+        if newest_first:
+            yield self._transcript(conversation)
+        if int(conversation.get("segments", 0)):
+            query_kwargs = {
+                "KeyConditionExpression": Key("phone").eq(phone) & Key("timestamp").begins_with(SEGMENT_PREFIX),
+                "ScanIndexForward": not newest_first,
+                # Segments are large, so fetch them one at a time
+                "Limit": 1,
+            }
+            while True:
+                response = self.table.query(**query_kwargs)
+                for segment in response["Items"]:
+                    yield self._transcript(segment)
+                if "LastEvaluatedKey" not in response:
+                    break
+                query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        if not newest_first:
+            yield self._transcript(conversation)
+
+
+    def _summary(self, conversation):
+        if conversation is None or "summary" not in conversation:
+            return None
+        return {"summary": conversation["summary"], "through": conversation["through"]}
+
+
+    def _transcript(self, item):
+        transcript = item.get("transcript", b"")
+        # Boto3 returns binary attributes wrapped in a Binary object
+        return getattr(transcript, "value", transcript)
+
+
+    def _to_item(self, phone, conversation, turn):
+        timestamp, received_message, sent_message, tokens = turn
+        item = {
+            "phone": phone,
+            "timestamp": timestamp,
+            "received_message": received_message,
+            "sent_message": sent_message,
+            "mentor_type": conversation["mentor_type"],
+            "name": conversation["name"],
+        }
+        if tokens:
+            item["tokens"] = tokens
+        return item
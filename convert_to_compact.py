@@ -0,0 +1,73 @@
+import argparse
+import logging
+import os
+
+import boto3
+
+from compact_interactions import CompactInteractions
+from idempotency import KEY_PREFIX
+from interactions import Interactions
+
+logger = logging.getLogger(__name__)
+
+
+def convert(source, destination, dry_run=False):
+    """
+    Copies every conversation from the item-per-turn layout into the compact
+    layout, including its rolling summary. Phones that already have a compact
+    conversation are skipped, so an interrupted run can be started again.
+
+    :param source: An Interactions object for the table to read.
+    :param destination: A CompactInteractions object for the table to write.
+    :param dry_run: Only count the conversations that would be converted.
+    :return: The number of conversations converted.
+    """
+    phones = set()
+    scan_kwargs = {"ProjectionExpression": "phone"}
+    while True:
+        response = source.table.scan(**scan_kwargs)
+        # Idempotency records are keyed by MessageSid and are not conversations
+        phones.update(item["phone"] for item in response["Items"] if not item["phone"].startswith(KEY_PREFIX))
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    converted = 0
+    for phone in sorted(phones):
+        items = list(source.iter_interactions(phone))
+        if not items:
+            continue
+        if dry_run:
+            converted += 1
+            continue
+        turns = [
+            (item["timestamp"], item["received_message"], item["sent_message"], int(item.get("tokens", 0)))
+            for item in items
+        ]
+        if destination.put_conversation(
+            phone, items[-1]["mentor_type"], items[-1]["name"], turns, summary=source.get_summary(phone)
+        ):
+            converted += 1
+        else:
+            logger.info("Skipped %s, which is already converted", phone)
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy interactions into the compact single-item layout.")
+    parser.add_argument("--source", default=os.environ.get("DDB_TABLE"), help="The table to read (defaults to DDB_TABLE).")
+    parser.add_argument("--destination", required=True, help="The table to write; created when missing.")
+    parser.add_argument("--codec", default=os.environ.get("COMPACT_CODEC", "zlib"), choices=["zlib", "zstd"])
+    parser.add_argument("--dry-run", action="store_true", help="Only count the conversations that would be converted.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+    source = Interactions(dynamodb, logger=logger)
+    if not source.exists(args.source):
+        parser.error(f"table {args.source} does not exist")
+    destination = CompactInteractions(dynamodb, logger=logger, codec=args.codec)
+    if not destination.exists(args.destination) and not args.dry_run:
+        destination.create_table(args.destination)
+    count = convert(source, destination, dry_run=args.dry_run)
+    logger.info("%s %s conversations from %s", "Would convert" if args.dry_run else "Converted", count, args.source)
@@ -0,0 +1,384 @@
+import logging
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+from botocore.exceptions import ClientError
+
+from idempotency import TTL_ATTRIBUTE
+
+# Statuses after which Twilio will not report any further progress for a message
+TERMINAL_STATUSES = {"delivered", "undelivered", "failed", "read", "delivery_unknown"}
+# Statuses that count as a successful hand-off to the user
+SUCCESS_STATUSES = {"sent", "delivered", "read"}
+# Sort key of tracked replies; their partition key is the prefixed reply ID, so
+# they never share a partition with a phone's interactions.
+DELIVERY_KEY = "#delivery"
+KEY_PREFIX = "#reply#"
+
+
+class DeliveryTracker:
+    """Tracks the delivery of multi-chunk replies from Twilio status callbacks.
+
+    A reply is begun before its first chunk is sent, which gives it an ID for
+    the chunks' status callback URL. Once the chunks are sent, track stores
+    their SIDs together with a record of the reply. Status callbacks update
+    the chunk states, and once every chunk of a reply is terminal,
+    on_complete(record, succeeded, statuses) runs exactly once.
+
+    With a table, replies are items in the interactions table, so whichever
+    process or instance receives a callback can complete the reply, and a
+    conditional write makes sure only one does. Without a table, as with the
+    memory and SQLite storage backends, replies are kept in process, which is
+    only correct when a single process serves the webhooks and the callbacks.
+
+    The process that sent a reply completes it after timeout if its callbacks
+    never arrive, judging it by the last status seen, like the old polling
+    loop did when it ran out of attempts. stop does the same for the replies
+    still pending when the process exits.
+
+    Example:
+        tracker = DeliveryTracker(store_reply, table=interactions.table, timeout=60)
+        tracker.start()
+        reply_id = tracker.begin()
+        sids = send(chunks, status_callback=tracker.callback_url(url, reply_id))
+        tracker.track(reply_id, sids, {"phone": phone, ...})
+        tracker.update(reply_id, "SM1", "delivered")
+    """
+
+    def __init__(self, on_complete, table=None, timeout=60, ttl=86400, sweep_interval=5, logger=None):
+        """
+        :param on_complete: Called as on_complete(record, succeeded, statuses)
+                            once every chunk is terminal or the reply timed out.
+        :param table: The Boto3 Table holding the interactions, or None to keep
+                      replies in process only.
+        :param timeout: Seconds to wait for all chunks of a reply to become terminal.
+        :param ttl: Seconds a reply is kept in the table.
+        :param sweep_interval: Seconds between sweeps for timed out replies.
+        :param logger: Logger used to report failed completion callbacks.
+        """
+        self.on_complete = on_complete
+        self.table = table
+        self.timeout = timeout
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        # reply_id -> reply, without a table; a reply is a dict with the chunk
+        # statuses, the sids once tracked, the record and whether it is done
+        self.replies = {}
+        # reply_id -> deadline of the replies this process sent and hasn't seen completed
+        self.own = {}
+        self.stopped = threading.Event()
+        self.sweeper = None
+
+
+    def start(self):
+        """
+        Starts the sweeper thread.
+        """
+        if self.sweeper is None:
+            self.stopped.clear()
+            self.sweeper = threading.Thread(
+                target=self._sweep_forever, name="delivery-sweeper", daemon=True
+            )
+            self.sweeper.start()
+
+
+    def stop(self, drain_timeout=0):
+        """
+        Stops the sweeper thread, then waits up to drain_timeout seconds for the
+        replies this process sent to complete, and completes the rest by their
+        last known statuses.
+
+        :param drain_timeout: Seconds to wait for pending replies.
+        """
+        self.stopped.set()
+        if self.sweeper is not None:
+            self.sweeper.join()
+            self.sweeper = None
+        deadline = time.monotonic() + drain_timeout
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(min(1, self.sweep_interval))
+            self._forget_completed()
+        self.sweep(now=float("inf"))
+
+
+    def begin(self):
+        """
+        Starts a reply, before any of its chunks is sent.
+
+        :return: The reply ID, for callback_url and track.
+        """
+        reply_id = uuid.uuid4().hex
+        if self.table is None:
+            with self.lock:
+                self.replies[reply_id] = {"statuses": {}, "sids": None, "record": None, "done": False}
+            return reply_id
+        try:
+            self.table.put_item(
+                Item={
+                    "phone": KEY_PREFIX + reply_id,
+                    "timestamp": DELIVERY_KEY,
+                    "statuses": {},
+                    TTL_ATTRIBUTE: int(time.time()) + self.ttl,
+                }
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't start tracking reply %s. Here's why: %s: %s",
+                reply_id,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        return reply_id
+
+
+    def callback_url(self, url, reply_id):
+        """
+        :param url: The public URL of the status callback endpoint.
+        :param reply_id: The reply ID from begin.
+        :return: The status callback URL for the chunks of the reply.
+        """
+        return url + ("&" if "?" in url else "?") + urlencode({"reply": reply_id})
+
+
+    def discard(self, reply_id):
+        """
+        Forgets a reply whose chunks could not all be sent.
+
+        :param reply_id: The reply ID from begin.
+        """
+        if self.table is None:
+            with self.lock:
+                self.replies.pop(reply_id, None)
+            return
+        try:
+            self.table.delete_item(Key={"phone": KEY_PREFIX + reply_id, "timestamp": DELIVERY_KEY})
+        except ClientError as err:
+            # Time to live removes it eventually
+            self.logger.warning(
+                "Couldn't discard reply %s. Here's why: %s: %s",
+                reply_id,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+
+
+    def track(self, reply_id, sids, record, initial_statuses=None):
+        """
+        Registers the sent chunks of a reply.
+
+        :param reply_id: The reply ID from begin.
+        :param sids: The message SIDs of the reply chunks.
+        :param record: What on_complete receives; with a table, it is stored in
+                       DynamoDB, so it must hold plain values.
+        :param initial_statuses: Optional sid -> status reported by messages.create.
+        """
+        statuses = {sid: status for sid, status in (initial_statuses or {}).items() if sid in sids and status}
+        with self.lock:
+            self.own[reply_id] = time.monotonic() + self.timeout
+        if self.table is None:
+            with self.lock:
+                reply = self.replies[reply_id]
+                reply.update(sids=list(sids), record=record)
+                for sid, status in statuses.items():
+                    # Callbacks may have reported a later status already
+                    reply["statuses"].setdefault(sid, status)
+        else:
+            names = {"#sids": "sids", "#record": "record"}
+            values = {":sids": list(sids), ":record": record}
+            assignments = ["#sids = :sids", "#record = :record"]
+            for index, (sid, status) in enumerate(statuses.items()):
+                names["#statuses"] = "statuses"
+                names[f"#s{index}"] = sid
+                values[f":s{index}"] = status
+                # Callbacks may have reported a later status already
+                assignments.append(f"#statuses.#s{index} = if_not_exists(#statuses.#s{index}, :s{index})")
+            try:
+                reply = self.table.update_item(
+                    Key={"phone": KEY_PREFIX + reply_id, "timestamp": DELIVERY_KEY},
+                    UpdateExpression="SET " + ", ".join(assignments),
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values,
+                    ReturnValues="ALL_NEW",
+                )["Attributes"]
+            except ClientError as err:
+                self.logger.error(
+                    "Couldn't track reply %s. Here's why: %s: %s",
+                    reply_id,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                raise
+        self._complete_if_terminal(reply_id, reply)
+
+
+    def update(self, reply_id, sid, status):
+        """
+        Records a status reported by a Twilio status callback.
+
+        :param reply_id: The reply ID from the callback URL.
+        :param sid: The message SID.
+        :param status: The reported MessageStatus.
+        :return: True when the status was recorded for a chunk of a tracked
+                 reply; False when the reply is unknown or the chunk's status
+                 is terminal already.
+        """
+        if self.table is None:
+            with self.lock:
+                reply = self.replies.get(reply_id)
+                if reply is None or (reply["sids"] is not None and sid not in reply["sids"]):
+                    return False
+                # Callbacks can arrive out of order, so never leave a terminal status
+                if reply["statuses"].get(sid) in TERMINAL_STATUSES:
+                    return False
+                reply["statuses"][sid] = status
+        else:
+            terminal = {f":t{index}": value for index, value in enumerate(sorted(TERMINAL_STATUSES))}
+            try:
+                reply = self.table.update_item(
+                    Key={"phone": KEY_PREFIX + reply_id, "timestamp": DELIVERY_KEY},
+                    UpdateExpression="SET #statuses.#sid = :status",
+                    # Callbacks can arrive out of order, so never leave a terminal status
+                    ConditionExpression=f"attribute_exists(phone) AND NOT (#statuses.#sid IN ({', '.join(terminal)}))",
+                    ExpressionAttributeNames={"#statuses": "statuses", "#sid": sid},
+                    ExpressionAttributeValues=dict(terminal, **{":status": status}),
+                    ReturnValues="ALL_NEW",
+                )["Attributes"]
+            except ClientError as err:
+                if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                    # An unknown or expired reply, or a chunk that is terminal already
+                    return False
+                self.logger.error(
+                    "Couldn't record status %s of %s. Here's why: %s: %s",
+                    status,
+                    sid,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                raise
+        self._complete_if_terminal(reply_id, reply)
+        return True
+
+
+    def pending(self):
+        """
+        :return: The number of replies this process sent whose delivery it
+                 hasn't seen completed yet.
+        """
+        with self.lock:
+            return len(self.own)
+
+
+    def sweep(self, now=None):
+        """
+        Completes every reply this process sent whose deadline has passed.
+
+        :param now: The current time.monotonic() value, for testing.
+        :return: The number of replies that timed out.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            expired = [reply_id for reply_id, deadline in self.own.items() if deadline <= now]
+        timed_out = 0
+        for reply_id in expired:
+            reply = self._finish(reply_id)
+            with self.lock:
+                self.own.pop(reply_id, None)
+            if reply is not None:
+                timed_out += 1
+                self._complete(reply, timed_out=True)
+        return timed_out
+
+
+    def _complete_if_terminal(self, reply_id, reply):
+        if reply.get("done") or reply.get("sids") is None:
+            return
+        if all(reply["statuses"].get(sid) in TERMINAL_STATUSES for sid in reply["sids"]):
+            reply = self._finish(reply_id)
+            with self.lock:
+                self.own.pop(reply_id, None)
+            if reply is not None:
+                self._complete(reply, timed_out=False)
+
+
+    def _finish(self, reply_id):
+        # Marks the reply done, exactly once across processes. Returns the
+        # reply when this call did it, and None when it was done already.
+        if self.table is None:
+            with self.lock:
+                reply = self.replies.pop(reply_id, None)
+                if reply is None or reply["done"]:
+                    return None
+                reply["done"] = True
+                return reply
+        try:
+            return self.table.update_item(
+                Key={"phone": KEY_PREFIX + reply_id, "timestamp": DELIVERY_KEY},
+                UpdateExpression="SET #done = :true",
+                ConditionExpression="attribute_exists(phone) AND attribute_not_exists(#done)",
+                ExpressionAttributeNames={"#done": "done"},
+                ExpressionAttributeValues={":true": True},
+                ReturnValues="ALL_NEW",
+            )["Attributes"]
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return None
+            self.logger.error(
+                "Couldn't complete reply %s. Here's why: %s: %s",
+                reply_id,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+
+
+    def _complete(self, reply, timed_out):
+        statuses = {sid: reply["statuses"].get(sid) for sid in reply["sids"] or []}
+        succeeded = bool(statuses) and all(status in SUCCESS_STATUSES for status in statuses.values())
+        if timed_out:
+            self.logger.error("Delivery of %s timed out with statuses %s", list(statuses), statuses)
+        if reply["record"] is None:
+            # The process that sent it stopped before tracking it
+            return
+        try:
+            self.on_complete(reply["record"], succeeded, statuses)
+        except Exception:
+            self.logger.exception("Delivery completion callback failed for %s", list(statuses))
+
+
+    def _forget_completed(self):
+        # Drops the replies this process sent that another process completed
+        with self.lock:
+            own = list(self.own)
+        if self.table is None or not own:
+            return
+        client = self.table.meta.client
+        for start in range(0, len(own), 100):
+            keys = [{"phone": KEY_PREFIX + reply_id, "timestamp": DELIVERY_KEY} for reply_id in own[start:start + 100]]
+            try:
+                response = client.batch_get_item(
+                    RequestItems={self.table.name: {
+                        "Keys": keys, "ProjectionExpression": "phone, #done", "ExpressionAttributeNames": {"#done": "done"},
+                    }}
+                )
+            except ClientError as err:
+                self.logger.warning(
+                    "Couldn't check pending replies. Here's why: %s: %s",
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                return
+            with self.lock:
+                for item in response["Responses"].get(self.table.name, []):
+                    if item.get("done"):
+                        self.own.pop(item["phone"][len(KEY_PREFIX):], None)
+
+
+    def _sweep_forever(self):
+        while not self.stopped.wait(self.sweep_interval):
+            self._forget_completed()
+            self.sweep()
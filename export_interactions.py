@@ -0,0 +1,197 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+
+import boto3
+
+from cache import json_default
+from compact_interactions import CompactInteractions
+from interactions import Interactions, sortable_timestamp
+from sqlite_interactions import SqliteInteractions
+
+logger = logging.getLogger(__name__)
+
+# Every attribute of an interaction, in the column order of exported files
+ATTRIBUTES = ["phone", "timestamp", "mentor_type", "name", "received_message", "sent_message", "tokens"]
+# What the aggregation reads; DynamoDB can't project the length of a message,
+# so both messages are read
+AGGREGATE_ATTRIBUTES = ["phone", "timestamp", "mentor_type", "received_message", "sent_message"]
+# Upper bounds of the message length buckets, in characters
+LENGTH_BUCKETS = [20, 50, 100, 200, 500, 1000, 2000, 4000]
+
+
+def export_jsonl(items, path):
+    """
+    Writes interactions as JSON lines, gzip compressed when the path ends in .gz.
+
+    :param items: The interactions.
+    :param path: The file to write.
+    :return: The number of interactions written.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    written = 0
+    with opener(path, "wt", encoding="utf-8") as export_file:
+        for item in items:
+            export_file.write(json.dumps(item, ensure_ascii=False, default=json_default) + "\n")
+            written += 1
+    return written
+
+
+def export_parquet(items, path, attributes=None, batch_size=10000):
+    """
+    Writes interactions to a zstd compressed Parquet file, one row group per
+    batch. Requires the optional pyarrow package.
+
+    :param items: The interactions.
+    :param path: The file to write.
+    :param attributes: The columns to write; defaults to every attribute.
+    :param batch_size: Interactions held in memory and written as one row group.
+    :return: The number of interactions written.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    columns = attributes or ATTRIBUTES
+    schema = pyarrow.schema(
+        [(column, pyarrow.int64() if column == "tokens" else pyarrow.string()) for column in columns]
+    )
+    written = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression="zstd") as writer:
+        batch = {column: [] for column in columns}
+        for item in items:
+            for column in columns:
+                value = item.get(column)
+                batch[column].append(int(value) if column == "tokens" and value is not None else value)
+            written += 1
+            if written % batch_size == 0:
+                writer.write_table(pyarrow.table(batch, schema=schema))
+                batch = {column: [] for column in columns}
+        if batch[columns[0]]:
+            writer.write_table(pyarrow.table(batch, schema=schema))
+    return written
+
+
+class Aggregate:
+    """Outcome statistics of the interactions, built in one pass.
+
+    Per mentor type it counts turns and phones, and buckets the lengths of
+    received and sent messages; per day it counts turns. Memory grows with
+    the number of phones and days, not with the number of interactions.
+
+    Example:
+        aggregate = Aggregate()
+        for item in interactions.scan_all(attributes=AGGREGATE_ATTRIBUTES):
+            aggregate.add(item)
+        print(aggregate.report())
+    """
+
+    def __init__(self):
+        self.turns = {}
+        self.phones = {}
+        self.days = {}
+        self.lengths = {}
+
+
+    def add(self, item):
+        """
+        Counts an interaction.
+
+        :param item: The interaction.
+        """
+        mentor_type = item.get("mentor_type") or "unknown"
+        self.turns[mentor_type] = self.turns.get(mentor_type, 0) + 1
+        self.phones.setdefault(mentor_type, set()).add(item["phone"])
+        day = sortable_timestamp(item["timestamp"])[:10]
+        self.days[day] = self.days.get(day, 0) + 1
+        lengths = self.lengths.setdefault(mentor_type, {})
+        for message in ("received_message", "sent_message"):
+            length = len(item.get(message) or "")
+            distribution = lengths.setdefault(
+                message, {"count": 0, "total": 0, "max": 0, "buckets": [0] * (len(LENGTH_BUCKETS) + 1)}
+            )
+            distribution["count"] += 1
+            distribution["total"] += length
+            distribution["max"] = max(distribution["max"], length)
+            bucket = next((index for index, bound in enumerate(LENGTH_BUCKETS) if length <= bound), len(LENGTH_BUCKETS))
+            distribution["buckets"][bucket] += 1
+
+
+    def report(self):
+        """
+        :return: The statistics as a JSON-serializable dict.
+        """
+        labels = [f"<={bound}" for bound in LENGTH_BUCKETS] + [f">{LENGTH_BUCKETS[-1]}"]
+        mentor_types = {}
+        for mentor_type, turns in sorted(self.turns.items()):
+            phones = len(self.phones[mentor_type])
+            mentor_types[mentor_type] = {
+                "turns": turns,
+                "phones": phones,
+                "turns_per_phone": round(turns / phones, 2),
+                "message_lengths": {
+                    message: {
+                        "mean": round(distribution["total"] / distribution["count"], 1),
+                        "max": distribution["max"],
+                        "buckets": dict(zip(labels, distribution["buckets"])),
+                    }
+                    for message, distribution in self.lengths[mentor_type].items()
+                },
+            }
+        return {
+            "turns": sum(self.turns.values()),
+            "mentor_types": mentor_types,
+            "turns_per_day": dict(sorted(self.days.items())),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the interactions table, or aggregate statistics of it.")
+    parser.add_argument("--table", default=os.environ.get("DDB_TABLE"), help="The table (defaults to DDB_TABLE).")
+    parser.add_argument("--backend", default=os.environ.get("STORAGE_BACKEND", "dynamodb"), choices=["dynamodb", "sqlite"],
+                        help="The storage backend (defaults to STORAGE_BACKEND).")
+    parser.add_argument("--layout", default=os.environ.get("INTERACTIONS_LAYOUT", "items"), choices=["items", "compact"],
+                        help="The DynamoDB layout (defaults to INTERACTIONS_LAYOUT).")
+    parser.add_argument("--output", help="A .jsonl, .jsonl.gz or .parquet file; the statistics file with --aggregate.")
+    parser.add_argument("--aggregate", action="store_true",
+                        help="Write turns per mentor type, turns per day and message length distributions as JSON.")
+    parser.add_argument("--attributes", help="Comma-separated attributes to export; defaults to all.")
+    parser.add_argument("--segments", type=int, default=4, help="Segments scanned in parallel.")
+    parser.add_argument("--page-size", type=int, help="Items evaluated by each scan call.")
+    args = parser.parse_args()
+    if not args.table:
+        parser.error("--table or DDB_TABLE is required")
+    if not args.aggregate and not (args.output or "").endswith((".jsonl", ".jsonl.gz", ".parquet")):
+        parser.error("--output must be a .jsonl, .jsonl.gz or .parquet file unless --aggregate is given")
+
+    logging.basicConfig(level=logging.INFO)
+    if args.backend == "sqlite":
+        interactions = SqliteInteractions(os.environ.get("SQLITE_PATH", "interactions.db"), logger=logger)
+    else:
+        dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+        if args.layout == "compact":
+            interactions = CompactInteractions(dynamodb, logger=logger)
+        else:
+            interactions = Interactions(dynamodb, logger=logger)
+    if not interactions.exists(args.table):
+        parser.error(f"table {args.table} does not exist")
+
+    if args.aggregate:
+        aggregate = Aggregate()
+        for item in interactions.scan_all(args.segments, AGGREGATE_ATTRIBUTES, args.page_size):
+            aggregate.add(item)
+        report = json.dumps(aggregate.report(), indent=2, ensure_ascii=False)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as report_file:
+                report_file.write(report + "\n")
+        else:
+            print(report)
+    else:
+        attributes = args.attributes.split(",") if args.attributes else None
+        items = interactions.scan_all(args.segments, attributes, args.page_size)
+        if args.output.endswith(".parquet"):
+            count = export_parquet(items, args.output, attributes)
+        else:
+            count = export_jsonl(items, args.output)
+        logger.info("Exported %s interactions from %s to %s", count, args.table, args.output)
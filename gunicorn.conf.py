@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+#
+# The webhook spends nearly all its time waiting on OpenAI, Twilio and DynamoDB,
+# so one worker process runs many threads (gthread). The coalescer, the OpenAI
+# quotas and circuit breaker, and the metrics are per process, so more workers
+# are opt-in. Every setting can be overridden with the environment variable
+# named next to it.
+import os
+import sys
+
+
+def _read_first(paths):
+    for path in paths:
+        try:
+            with open(path) as limit_file:
+                return limit_file.read().split()
+        except OSError:
+            continue
+    return None
+
+
+def available_cpus():
+    """
+    :return: The CPUs the container may use, honoring cgroup quotas.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _read_first(["/sys/fs/cgroup/cpu.max"])
+    if quota and quota[0] != "max":
+        cpus = min(cpus, max(1, int(quota[0]) // int(quota[1])))
+    else:
+        quota = _read_first(["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"])
+        period = _read_first(["/sys/fs/cgroup/cpu/cpu.cfs_period_us"])
+        if quota and period and int(quota[0]) > 0:
+            cpus = min(cpus, max(1, int(quota[0]) // int(period[0])))
+    return cpus
+
+
+def available_memory_mb():
+    """
+    :return: The megabytes of memory the container may use, or None when unknown.
+    """
+    limit = _read_first(["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"])
+    if limit and limit[0] != "max" and int(limit[0]) < 1 << 60:
+        return int(limit[0]) // (1024 * 1024)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_workers():
+    # One process per CPU is enough for I/O-bound threads, plus one so a CPU-bound
+    # moment (prompt building, JSON) doesn't stall a core. Each process holds its
+    # own clients and caches, so memory caps the count too.
+    workers = available_cpus() + 1
+    memory_mb = available_memory_mb()
+    if memory_mb is not None:
+        workers = min(workers, max(1, memory_mb // int(os.environ.get("GUNICORN_WORKER_MEMORY_MB", "200"))))
+    return max(1, workers)
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "gthread"
+# One process keeps per-process state whole; GUNICORN_WORKERS=auto sizes the
+# workers to the container for CPU-heavy deployments
+if os.environ.get("GUNICORN_WORKERS", "1") == "auto":
+    workers = default_workers()
+else:
+    workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+# Tells the app how many processes share this container, so each takes its
+# share of the OpenAI quotas
+os.environ["APP_PROCESSES"] = str(workers)
+# Concurrent webhooks per process. A synchronous reply holds its thread for
+# the whole model call, so webhooks in flight are about arrival rate times
+# reply time (Little's law); idle threads cost little memory.
+threads = int(os.environ.get("GUNICORN_THREADS", "128"))
+# Connections queued beyond the busy threads before the kernel refuses them
+backlog = int(os.environ.get("GUNICORN_BACKLOG", "1024"))
+
+# A synchronous reply waits for the model (OPENAI_TIMEOUT, 30s by default) and
+# then polls Twilio up to K_MAX times, so allow a request about two minutes.
+# With gthread this is the worker's heartbeat timeout, which long requests
+# don't trip by themselves; it catches a wedged process.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+# Longer than the idle timeout of the load balancer in front (60s), so the
+# balancer, not gunicorn, closes idle connections and no request hits a closing socket
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "75"))
+# On SIGTERM, finish in-flight webhooks and drain the reply queue
+# (PIPELINE_DRAIN_TIMEOUT) before the worker is killed
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", str(int(os.environ.get("PIPELINE_DRAIN_TIMEOUT", "30")) + 15)))
+# Recycle workers now and then so slow leaks don't build up; jitter keeps them
+# from restarting together
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = max_requests // 10
+
+# Import the app, and with it boto3, openai and twilio, once in the master so
+# workers share those pages and start quickly. Clients and background threads
+# are created after the fork, since neither sockets nor threads survive it.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+if preload_app:
+    os.environ["DEFER_BACKGROUND_START"] = "true"
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info").lower()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        sys.modules["app"].start_background()
+
+
+def worker_exit(server, worker):
+    # Hand buffered bursts to the reply queue, drain it, judge the replies still
+    # awaiting status callbacks, then flush buffered writes, in that order,
+    # before the worker's interpreter exits
+    app_module = sys.modules.get("app")
+    if app_module is not None:
+        if app_module.coalescer is not None:
+            app_module.coalescer.shutdown()
+        if app_module.pipeline is not None:
+            app_module.pipeline.shutdown(int(os.environ.get("PIPELINE_DRAIN_TIMEOUT", "30")))
+        app_module.shutdown_delivery_tracker()
+        app_module.shutdown_write_behind()
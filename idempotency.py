@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from cache import LRUCache
+
+# Sort key of idempotency records; their partition key is the prefixed MessageSid,
+# so they never share a partition with a phone's interactions.
+IDEMPOTENCY_KEY = "#idempotency"
+KEY_PREFIX = "#message#"
+# Attribute DynamoDB's time to live deletes expired records by
+TTL_ATTRIBUTE = "expires_at"
+
+
+class IdempotencyStore:
+    """Makes sure each inbound Twilio message is processed only once.
+
+    Before a message is processed, begin takes a lease on its MessageSid with a
+    conditional write to the interactions table. Duplicate deliveries, whether
+    Twilio retries or concurrent requests, fail the condition and get the stored
+    result, or learn that the message is still in progress. Records expire
+    through DynamoDB's time to live. An in-process cache answers repeated
+    duplicates without a DynamoDB call. Without a table, as with the memory and
+    SQLite storage backends, the in-process cache is the only record, so
+    duplicates are only caught within one process.
+
+    Example:
+        store = IdempotencyStore(interactions.table)
+        acquired, record = store.begin(message_sid)
+        if acquired:
+            store.complete(message_sid, process(...))
+        else:
+            return record.get("result", "in progress")
+    """
+
+    def __init__(self, table, ttl=86400, lease=300, logger=None, local_size=10000):
+        """
+        :param table: The Boto3 Table holding the interactions, or None to keep
+                      records in process only.
+        :param ttl: Seconds a record is kept after the message arrived.
+        :param lease: Seconds before an unfinished message may be processed again,
+                      in case the worker processing it died.
+        :param logger: Logger used to report errors.
+        :param local_size: Records kept in the in-process cache.
+        """
+        self.table = table
+        self.ttl = ttl
+        self.lease = lease
+        self.logger = logger or logging.getLogger(__name__)
+        # With a table, the local cache only saves calls; without one it is the record
+        self.local = LRUCache(max_size=local_size, ttl=lease if table is not None else ttl)
+        self.lock = threading.Lock()
+
+
+    def enable_ttl(self):
+        """
+        Turns on DynamoDB's time to live for the table so expired records are
+        deleted. Does nothing when it is on already.
+        """
+        if self.table is None:
+            return
+        try:
+            description = self.table.meta.client.describe_time_to_live(TableName=self.table.name)
+            if description["TimeToLiveDescription"]["TimeToLiveStatus"] in ("ENABLED", "ENABLING"):
+                self.logger.info("Time to live is already on for %s", self.table.name)
+                return
+            self.table.meta.client.update_time_to_live(
+                TableName=self.table.name,
+                TimeToLiveSpecification={"Enabled": True, "AttributeName": TTL_ATTRIBUTE},
+            )
+        except ClientError as err:
+            # Another run may have turned it on since it was described
+            if err.response["Error"]["Code"] == "ValidationException" and "already enabled" in err.response["Error"]["Message"]:
+                return
+            self.logger.error(
+                "Couldn't enable time to live on %s. Here's why: %s: %s",
+                self.table.name,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+
+
+    def begin(self, message_sid):
+        """
+        Takes the lease for processing a message.
+
+        :param message_sid: The Twilio MessageSid.
+        :return: (True, None) when the caller should process the message; otherwise,
+                 (False, record) with the record of the earlier delivery.
+        """
+        if self.table is None:
+            with self.lock:
+                record = self.local.get(message_sid)
+                if record is not None:
+                    return False, record
+                self.local.set(message_sid, {"status": "in_progress"})
+            return True, None
+        record = self.local.get(message_sid)
+        if record is not None:
+            return False, record
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    "phone": KEY_PREFIX + message_sid,
+                    "timestamp": IDEMPOTENCY_KEY,
+                    "status": "in_progress",
+                    "lease_until": now + self.lease,
+                    TTL_ATTRIBUTE: now + self.ttl,
+                },
+                # Time to live deletes lazily, so expired records count as absent
+                ConditionExpression="attribute_not_exists(phone) OR #expires < :now "
+                                    "OR (#status = :in_progress AND lease_until < :now)",
+                ExpressionAttributeNames={"#expires": TTL_ATTRIBUTE, "#status": "status"},
+                ExpressionAttributeValues={":now": now, ":in_progress": "in_progress"},
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                self.logger.error(
+                    "Couldn't take the lease for %s. Here's why: %s: %s",
+                    message_sid,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                raise
+            response = self.table.get_item(
+                Key={"phone": KEY_PREFIX + message_sid, "timestamp": IDEMPOTENCY_KEY}
+            )
+            record = response.get("Item", {"status": "in_progress"})
+            if record["status"] == "done":
+                self.local.set(message_sid, record)
+            return False, record
+        self.local.set(message_sid, {"status": "in_progress"})
+        return True, None
+
+
+    def complete(self, message_sid, result):
+        """
+        Stores the result of a processed message for later duplicates.
+
+        :param message_sid: The Twilio MessageSid.
+        :param result: The result to hand to duplicate deliveries.
+        """
+        record = {"status": "done", "result": result}
+        self.local.set(message_sid, record)
+        if self.table is None:
+            return
+        try:
+            self.table.update_item(
+                Key={"phone": KEY_PREFIX + message_sid, "timestamp": IDEMPOTENCY_KEY},
+                UpdateExpression="SET #status = :done, #result = :result",
+                ExpressionAttributeNames={"#status": "status", "#result": "result"},
+                ExpressionAttributeValues={":done": "done", ":result": result},
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't store the result for %s. Here's why: %s: %s",
+                message_sid,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+
+
+    def release(self, message_sid):
+        """
+        Gives up the lease after processing failed, so a retry can process the message.
+
+        :param message_sid: The Twilio MessageSid.
+        """
+        self.local.delete(message_sid)
+        if self.table is None:
+            return
+        try:
+            self.table.delete_item(
+                Key={"phone": KEY_PREFIX + message_sid, "timestamp": IDEMPOTENCY_KEY}
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't release the lease for %s. Here's why: %s: %s",
+                message_sid,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
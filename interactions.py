@@ -1,8 +1,59 @@
-import boto3
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 
-class Interactions:
+from storage import InteractionStore
+
+# Sort key format. ISO-8601 in UTC sorts chronologically as a string.
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+# Sort key format used before TIMESTAMP_FORMAT; see migrate_timestamps.py.
+LEGACY_TIMESTAMP_FORMAT = "%m-%d-%y %H:%M:%S UTC"
+# Sort key of the item holding a phone's rolling conversation summary. It sorts
+# before every turn, whose keys start with a digit in both formats.
+SUMMARY_KEY = "#summary"
+TURN_KEY_START = "0"
+
+
+def make_timestamp(moment=None):
+    """
+    Formats a moment as an interaction sort key.
+
+    :param moment: An aware datetime; defaults to now.
+    :return: The sort key string.
+    """
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_timestamp(timestamp):
+    """
+    Parses an interaction sort key made by make_timestamp.
+
+    :param timestamp: The sort key string.
+    :return: The aware datetime.
+    """
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def sortable_timestamp(timestamp):
+    """
+    Converts a legacy sort key to the sortable format.
+
+    :param timestamp: A sort key in either format.
+    :return: The sort key in TIMESTAMP_FORMAT.
+    """
+    try:
+        moment = datetime.strptime(timestamp, LEGACY_TIMESTAMP_FORMAT)
+    except ValueError:
+        return timestamp
+    return make_timestamp(moment.replace(tzinfo=timezone.utc))
+
+
+class Interactions(InteractionStore):
     """Encapsulates an Amazon DynamoDB table of movie data.
 
     Example data structure for a movie record in this table:
@@ -12,16 +63,21 @@ class Interactions:
             "received_message": "My business idea is selling peanuts in Kampala",
             "mentor_type": "refugee",
             "sent_message": "You need to do amrket research on peanuts market in Uganda",
-            "timestamp": "12-21-24 10:19:23 UTC"
+            "timestamp": "2024-12-21T10:19:23.000000Z"
         }
     """
 
-    def __init__(self, dyn_resource, logger=None):
+    def __init__(self, dyn_resource, logger=None, cache=None, write_behind=None):
         """
         :param dyn_resource: A Boto3 DynamoDB resource.
+        :param cache: Optional LRUCache or RedisCache holding each phone's
+                      interactions, written through by add_interaction.
+        :param write_behind: Optional WriteBehindBuffer that add_interaction hands
+                             items to instead of writing them itself.
         """
+        super().__init__(logger=logger, cache=cache)
         self.dyn_resource = dyn_resource
-        self.logger = logger
+        self.write_behind = write_behind
         # The table variable is set during the scenario in the call to
         # 'exists' if the table exists. Otherwise, it is set by 'create_table'.
         self.table = None
@@ -55,6 +111,17 @@ class Interactions:
         return exists
 
 
+    def use_table(self, table_name):
+        """
+        Uses a table without checking that it exists. Unlike exists, this makes
+        no request; a missing table shows up as ResourceNotFoundException on
+        first use.
+
+        :param table_name: The name of the table.
+        """
+        self.table = self.dyn_resource.Table(table_name)
+
+
     def create_table(self, table_name):
         """
         Creates an Amazon DynamoDB table that can be used to store movie data.
@@ -115,61 +182,83 @@ class Interactions:
             return tables
 
 
-    # def write_batch(self, movies):
-    #     """
-    #     Fills an Amazon DynamoDB table with the specified data, using the Boto3
-    #     Table.batch_writer() function to put the items in the table.
-    #     Inside the context manager, Table.batch_writer builds a list of
-    #     requests. On exiting the context manager, Table.batch_writer starts sending
-    #     batches of write requests to Amazon DynamoDB and automatically
-    #     handles chunking, buffering, and retrying.
-
-    #     :param movies: The data to put in the table. Each item must contain at least
-    #                    the keys required by the schema that was specified when the
-    #                    table was created.
-    #     """
-    #     try:
-    #         with self.table.batch_writer() as writer:
-    #             for movie in movies:
-    #                 writer.put_item(Item=movie)
-    #     except ClientError as err:
-    #         logger.error(
-    #             "Couldn't load data into table %s. Here's why: %s: %s",
-    #             self.table.name,
-    #             err.response["Error"]["Code"],
-    #             err.response["Error"]["Message"],
-    #         )
-    #         raise
+    def write_batch(self, items):
+        """
+        Fills the table with the specified items, using the Boto3
+        Table.batch_writer() function to put them in the table.
+        Inside the context manager, Table.batch_writer builds a list of
+        requests. On exiting the context manager, Table.batch_writer starts sending
+        batches of write requests to Amazon DynamoDB and automatically
+        handles chunking, buffering, and retrying.
+
+        :param items: The data to put in the table, any iterable. Each item must
+                      contain at least the phone and timestamp keys.
+        :return: The number of items written.
+        """
+        written = 0
+        try:
+            # A later item with the same key replaces an earlier one in the same batch
+            with self.table.batch_writer(overwrite_by_pkeys=["phone", "timestamp"]) as writer:
+                for item in items:
+                    writer.put_item(Item=item)
+                    written += 1
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't load data into table %s. Here's why: %s: %s",
+                self.table.name,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        return written
 
 
-    def add_interaction(self, phone, timestamp, received_message, sent_message, mentor_type, name):
+    def batch_get(self, keys, max_retries=5):
         """
-        Adds an interaction to the table.
-
-        :param phone: The phone number.
-        :param timestamp: timestamp of the interaction.
-        :param received_message: The message received.
-        :param sent_message: The message sent from AI.
-        :param mentor_type: Refugee/Local/AI
-        :param name: The name of the person.
+        Gets items by key with BatchGetItem, 100 keys per call. Keys DynamoDB
+        leaves unprocessed are requested again after a growing delay.
+
+        :param keys: The keys, as {"phone": ..., "timestamp": ...} dicts.
+        :param max_retries: Calls made for unprocessed keys before giving up.
+        :return: The items found, in no particular order.
         """
+        items = []
+        keys = list(keys)
+        for start in range(0, len(keys), 100):
+            request = {self.table.name: {"Keys": keys[start:start + 100]}}
+            for attempt in range(max_retries + 1):
+                try:
+                    response = self.dyn_resource.batch_get_item(RequestItems=request)
+                except ClientError as err:
+                    self.logger.error(
+                        "Couldn't get items from table %s. Here's why: %s: %s",
+                        self.table.name,
+                        err.response["Error"]["Code"],
+                        err.response["Error"]["Message"],
+                    )
+                    raise
+                items.extend(response["Responses"].get(self.table.name, []))
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+                if attempt == max_retries:
+                    raise RuntimeError(f"{len(request[self.table.name]['Keys'])} keys of {self.table.name} stayed unprocessed")
+                time.sleep(min(2 ** attempt * 0.1, 5))
+        return items
+
+
+    def _store(self, item):
         try:
-            self.table.put_item(
-                Item={
-                    "phone": phone,
-                    "timestamp": timestamp,
-                    "received_message": received_message,
-                    "sent_message": sent_message,
-                    "mentor_type": mentor_type,
-                    "name": name,
-                }
-            )
+            if self.write_behind is not None:
+                self.write_behind.put(item)
+            else:
+                self.table.put_item(Item=item)
         except ClientError as err:
             self.logger.error(
                 "Couldn't add interaction %s, %s, %s to the table %s because %s and %s",
-                phone,
-                timestamp,
-                name,
+                item["phone"],
+                item["timestamp"],
+                item["name"],
                 self.table.name,
                 err.response["Error"]["Code"],
                 err.response["Error"]["Message"],
@@ -230,25 +319,183 @@ class Interactions:
     #         return response["Attributes"]
 
 
-    def query_interactions(self, phone):
+    def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None):
+        """
+        Lazily pages through the interactions by phone number.
+
+        :param phone: phone number.
+        :param newest_first: Yield the newest interaction first.
+        :param page_size: The number of items read by each query call.
+        :param limit: Stop after this many interactions.
+        :return: A generator of interactions by phone number.
+        """
+        query_kwargs = {
+            "KeyConditionExpression": Key("phone").eq(phone) & Key("timestamp").gte(TURN_KEY_START),
+            "ScanIndexForward": not newest_first,
+        }
+        if page_size:
+            query_kwargs["Limit"] = page_size
+        returned = 0
+        while True:
+            try:
+                response = self.table.query(**query_kwargs)
+            except ClientError as err:
+                self.logger.error(
+                    "Couldn't query for interactions by %s. Here's why: %s %s",
+                    phone,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                raise
+            for item in response["Items"]:
+                yield item
+                returned += 1
+                if limit is not None and returned >= limit:
+                    return
+            if "LastEvaluatedKey" not in response:
+                return
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+    def get_summary(self, phone):
         """
-        Queries for interactions by phone number. 
+        Gets the rolling summary of a phone's conversation.
 
         :param phone: phone number.
-        :return: The list of interactions by phone number.
+        :return: The summary as {"summary": text, "through": timestamp of the last
+                 summarized interaction}, or None when there is none.
         """
         try:
-            response = self.table.query(KeyConditionExpression=Key("phone").eq(phone))
+            response = self.table.get_item(Key={"phone": phone, "timestamp": SUMMARY_KEY})
         except ClientError as err:
             self.logger.error(
-                "Couldn't query for interactions by %s. Here's why: %s %s",
+                "Couldn't get the summary for %s. Here's why: %s %s",
                 phone,
                 err.response["Error"]["Code"],
                 err.response["Error"]["Message"],
             )
             raise
-        else:
-            return response["Items"]
+        item = response.get("Item")
+        if item is None:
+            return None
+        return {"summary": item["summary"], "through": item["through"]}
+
+
+    def put_summary(self, phone, summary, through):
+        """
+        Stores the rolling summary of a phone's conversation.
+
+        :param phone: phone number.
+        :param summary: The summary text.
+        :param through: The timestamp of the last summarized interaction.
+        """
+        try:
+            self.table.put_item(
+                Item={"phone": phone, "timestamp": SUMMARY_KEY, "summary": summary, "through": through}
+            )
+        except ClientError as err:
+            self.logger.error(
+                "Couldn't store the summary for %s. Here's why: %s %s",
+                phone,
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+
+
+    def scan_all(self, segments=4, attributes=None, page_size=None, include_meta=False):
+        """
+        Reads every interaction of every phone with a parallel scan. Each of
+        the segments is scanned by its own thread, page by page, and at most a
+        few pages per segment wait to be consumed, so memory stays flat however
+        large the table is. Summaries and idempotency records are skipped.
+        Interactions come in no particular order.
+
+        :param segments: The number of segments scanned at once.
+        :param attributes: Optional attribute names to read, such as ["phone",
+                           "timestamp", "mentor_type"]; defaults to all.
+        :param page_size: The number of items each scan call evaluates.
+        :param include_meta: Read every item of the table, including summaries
+                             and idempotency records, to copy it.
+        :return: A generator of interactions.
+        """
+        scan_kwargs = {}
+        if not include_meta:
+            scan_kwargs = {
+                "FilterExpression": "#timestamp >= :turns",
+                "ExpressionAttributeNames": {"#timestamp": "timestamp"},
+                "ExpressionAttributeValues": {":turns": TURN_KEY_START},
+            }
+        if attributes:
+            # Placeholders, as name and timestamp are reserved words
+            names = {f"#a{index}": attribute for index, attribute in enumerate(attributes)}
+            scan_kwargs["ProjectionExpression"] = ", ".join(names)
+            scan_kwargs.setdefault("ExpressionAttributeNames", {}).update(names)
+        if page_size:
+            scan_kwargs["Limit"] = page_size
+        return self._scan_segments(scan_kwargs, segments)
+
+
+    def _scan_segments(self, scan_kwargs, segments):
+        # Scans the table's segments in a thread pool, yielding the items of
+        # each page as it arrives. Clients are thread safe, unlike the Table
+        # resource, and the resource's client serializes plain Python values
+        # like the Table does.
+        client = self.dyn_resource.meta.client
+        table_name = self.table.name
+        pages = queue.Queue(maxsize=2 * segments)
+        stopped = threading.Event()
+
+        def offer(page):
+            while not stopped.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def scan_segment(segment):
+            kwargs = dict(scan_kwargs, TableName=table_name, Segment=segment, TotalSegments=segments)
+            try:
+                while not stopped.is_set():
+                    response = client.scan(**kwargs)
+                    offer(response["Items"])
+                    if "LastEvaluatedKey" not in response:
+                        break
+                    kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+            except ClientError as err:
+                self.logger.error(
+                    "Couldn't scan segment %s of %s. Here's why: %s: %s",
+                    segment,
+                    table_name,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                offer(err)
+                return
+            except Exception as err:
+                # Raised again in the consuming thread, which would otherwise wait forever
+                offer(err)
+                return
+            # One None per segment marks its end
+            offer(None)
+
+        with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="scan") as executor:
+            for segment in range(segments):
+                executor.submit(scan_segment, segment)
+            try:
+                remaining = segments
+                while remaining:
+                    page = pages.get()
+                    if page is None:
+                        remaining -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield from page
+            finally:
+                # Also stops the other segments when the caller stops early
+                stopped.set()
 
 
     # def scan_movies(self, year_range):
@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+
+
+class LazyResource:
+    """Creates a client on first use, exactly once, however many threads ask at once.
+
+    Creation is timed, and a failed creation is retried on the next use, so a
+    slow or unavailable dependency delays only the requests that need it
+    instead of the process start.
+
+    Example:
+        twilio_client = LazyResource("twilio", lambda: Client(account_sid, auth_token))
+        twilio_client.get().messages.create(...)
+    """
+
+    def __init__(self, name, factory, logger=None, on_created=None):
+        """
+        :param name: The dependency's name, used in logs and status reports.
+        :param factory: Creates the client; called without arguments.
+        :param logger: Logger used to report creation times and failures.
+        :param on_created: Optional function called with the name and the
+                           seconds creation took.
+        """
+        self.name = name
+        self.factory = factory
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_created = on_created
+        self.lock = threading.Lock()
+        self.value = None
+        self.created = False
+        self.seconds = None
+        self.error = None
+
+
+    def get(self):
+        """
+        :return: The client, created by this call when it is the first use.
+        """
+        if self.created:
+            return self.value
+        with self.lock:
+            if not self.created:
+                started = time.monotonic()
+                try:
+                    value = self.factory()
+                except Exception as err:
+                    self.error = f"{type(err).__name__}: {err}"
+                    self.logger.error("Couldn't create %s. Here's why: %s", self.name, self.error)
+                    raise
+                self.seconds = time.monotonic() - started
+                self.value, self.created, self.error = value, True, None
+                self.logger.info("Created %s in %.3fs", self.name, self.seconds)
+                if self.on_created is not None:
+                    self.on_created(self.name, self.seconds)
+        return self.value
+
+
+    def set(self, value):
+        """
+        Uses value instead of creating the client, as tests and benchmarks do.
+        """
+        with self.lock:
+            self.value, self.created, self.error = value, True, None
+
+
+    def status(self):
+        """
+        :return: Whether the client exists, how long creating it took, and the
+                 last creation error.
+        """
+        return {"ready": self.created, "seconds": self.seconds, "error": self.error}
@@ -0,0 +1,345 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import openai
+import requests
+
+# Sent instead of a generated answer while OpenAI is unavailable or overloaded
+FALLBACK_REPLY = ("Our mentors are helping many people right now. "
+    "Please send your message again in a few minutes and we will get back to you.")
+
+# Errors worth retrying; anything else is a problem with the request itself
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling OpenAI while the circuit breaker is open."""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a call cannot finish before its deadline."""
+
+
+class SlotStream:
+    """A streamed answer that holds a concurrency slot until it is done with.
+
+    The slot is released once, when the events run out, when iterating them
+    fails, or when the stream is closed, including by garbage collection if
+    it is never iterated at all.
+    """
+
+    def __init__(self, events, slots):
+        """
+        :param events: The streamed answer.
+        :param slots: The semaphore the slot was taken from.
+        """
+        self.events = iter(events)
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.released = False
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if self.released:
+            raise StopIteration
+        try:
+            return next(self.events)
+        except BaseException:
+            self.close()
+            raise
+
+
+    def close(self):
+        """
+        Stops reading the answer and releases the slot.
+        """
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.slots.release()
+        close = getattr(self.events, "close", None)
+        if close is not None:
+            close()
+
+
+    def __del__(self):
+        self.close()
+
+
+class RateLimiter:
+    """Token buckets for a requests-per-minute and a tokens-per-minute quota.
+
+    Example:
+        limiter = RateLimiter(requests_per_minute=500, tokens_per_minute=40000)
+        if limiter.acquire(1200, deadline=time.monotonic() + 10):
+            ...
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param requests_per_minute: The request quota.
+        :param tokens_per_minute: The token quota.
+        :param clock: Function returning the current time in seconds.
+        :param sleep: Function used to wait for capacity.
+        """
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+
+    def acquire(self, tokens, deadline=None):
+        """
+        Waits until one request of the given size fits in both quotas.
+
+        :param tokens: The tokens the request is expected to use.
+        :param deadline: A clock() value after which to give up.
+        :return: True when the capacity was taken; False when the deadline would pass first.
+        """
+        wanted = {"requests": 1, "tokens": min(tokens, self.capacity["tokens"])}
+        while True:
+            with self.lock:
+                now = self.clock()
+                elapsed = now - self.updated
+                self.updated = now
+                for name, capacity in self.capacity.items():
+                    self.available[name] = min(capacity, self.available[name] + elapsed * capacity / 60)
+                wait = max(
+                    (wanted[name] - self.available[name]) * 60 / self.capacity[name]
+                    for name in self.capacity
+                )
+                if wait <= 0:
+                    for name in self.capacity:
+                        self.available[name] -= wanted[name]
+                    return True
+            if deadline is not None and now + wait > deadline:
+                return False
+            self.sleep(wait)
+
+
+class CircuitBreaker:
+    """Stops calls to a failing upstream for a while.
+
+    The circuit opens after a number of consecutive failures. Once the reset
+    timeout has passed, a single trial call is let through; it closes the
+    circuit when it succeeds and reopens it when it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        """
+        :param failure_threshold: Consecutive failures that open the circuit.
+        :param reset_timeout: Seconds the circuit stays open before a trial call.
+        :param clock: Function returning the current time in seconds.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+
+    @property
+    def state(self):
+        """
+        :return: "closed", "open" or "half-open".
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.clock() - self.opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+
+    def allow(self):
+        """
+        :return: True when a call may go ahead.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_timeout or self.trial_running:
+                return False
+            self.trial_running = True
+            return True
+
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+
+class LLMClient:
+    """A process-wide OpenAI chat client.
+
+    The client shares one pooled HTTP session between all threads, limits
+    concurrent calls and keeps within the requests and tokens per minute
+    quotas. Failed calls are retried with exponential backoff and full jitter,
+    waiting at least as long as a Retry-After header asks, and never past the
+    call's deadline. A circuit breaker stops calling OpenAI after repeated
+    failures, so callers can fall back to FALLBACK_REPLY at once.
+
+    Example:
+        response = get_client().chat_completion("gpt-4", messages, estimated_tokens=900)
+    """
+
+    def __init__(self, api_key=None, max_concurrency=8, requests_per_minute=500, tokens_per_minute=40000,
+                 timeout=30, max_retries=3, base_delay=1, max_delay=20, failure_threshold=5,
+                 reset_timeout=30, logger=None):
+        """
+        :param api_key: The OpenAI API key.
+        :param max_concurrency: Maximum calls in flight at once.
+        :param requests_per_minute: The request quota of the API key.
+        :param tokens_per_minute: The token quota of the API key.
+        :param timeout: Default seconds a call may take, including retries.
+        :param max_retries: Retries after the first attempt.
+        :param base_delay: Backoff before the first retry, doubled for each retry.
+        :param max_delay: Upper bound for the backoff.
+        :param failure_threshold: Consecutive failed calls that open the circuit.
+        :param reset_timeout: Seconds the circuit stays open.
+        :param logger: Logger used to report retries.
+        """
+        openai.api_key = api_key
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        session.mount("https://", adapter)
+        openai.requestssession = session
+
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = logger or logging.getLogger(__name__)
+
+
+    def chat_completion(self, model, messages, estimated_tokens=1000, timeout=None, **kwargs):
+        """
+        Calls openai.ChatCompletion.create within the client's limits.
+
+        :param model: The model name.
+        :param messages: The chat messages.
+        :param estimated_tokens: Prompt plus expected answer tokens, charged to the token quota.
+        :param timeout: Seconds the call may take, including waits and retries.
+        :param kwargs: Further arguments for ChatCompletion.create, such as stream.
+        :return: The ChatCompletion.create response.
+        :raises CircuitOpenError: When OpenAI is considered unavailable.
+        :raises DeadlineExceededError: When the call could not complete in time.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"OpenAI circuit is {self.breaker.state}")
+        attempt = 0
+        while True:
+            try:
+                response = self._attempt(model, messages, estimated_tokens, deadline, kwargs)
+            except RETRYABLE_ERRORS as err:
+                delay = self._backoff(attempt, err)
+                if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    self.breaker.record_failure()
+                    raise
+                self.logger.warning("OpenAI call failed with %s, retrying in %.1fs", err, delay)
+                time.sleep(delay)
+                attempt += 1
+            except DeadlineExceededError:
+                self.breaker.record_failure()
+                raise
+            except Exception:
+                # The request itself is wrong; OpenAI is healthy
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return response
+
+
+    def _attempt(self, model, messages, estimated_tokens, deadline, kwargs):
+        if not self.limiter.acquire(estimated_tokens, deadline):
+            raise DeadlineExceededError("OpenAI quota is exhausted until after the deadline")
+        if not self.slots.acquire(timeout=max(0, deadline - time.monotonic())):
+            raise DeadlineExceededError("No OpenAI connection became free before the deadline")
+        try:
+            response = openai.ChatCompletion.create(
+                model=model,
+                messages=messages,
+                request_timeout=max(1, deadline - time.monotonic()),
+                **kwargs
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        if kwargs.get("stream"):
+            # Hold the slot until the streamed answer has been read
+            return SlotStream(response, self.slots)
+        self.slots.release()
+        return response
+
+
+    def _backoff(self, attempt, err):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        headers = getattr(err, "headers", None) or {}
+        retry_after = headers.get("Retry-After") or headers.get("retry-after")
+        try:
+            return max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            return delay
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Gets the process-wide client, creating it from the environment on first use.
+    When APP_PROCESSES processes serve the app, each gets that share of the
+    quotas and concurrency, so together they stay within the API key's limits.
+
+    :return: The LLMClient.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            processes = max(1, int(os.environ.get("APP_PROCESSES", "1")))
+            _client = LLMClient(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                max_concurrency=max(1, int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8")) // processes),
+                requests_per_minute=max(1, int(os.environ.get("OPENAI_RPM", "500")) // processes),
+                tokens_per_minute=max(1, int(os.environ.get("OPENAI_TPM", "40000")) // processes),
+                timeout=float(os.environ.get("OPENAI_TIMEOUT", "30")),
+                max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", "3")),
+                failure_threshold=int(os.environ.get("OPENAI_CIRCUIT_THRESHOLD", "5")),
+                reset_timeout=float(os.environ.get("OPENAI_CIRCUIT_RESET", "30")),
+            )
+        return _client
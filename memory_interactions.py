@@ -0,0 +1,101 @@
+import bisect
+import threading
+
+from storage import InteractionStore
+
+# Tables live as long as the process, shared by every MemoryInteractions object
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+class MemoryInteractions(InteractionStore):
+    """Keeps interactions in process memory, for tests and load tests without I/O.
+
+    Each table is a dict from phone number to that phone's interactions, kept
+    sorted by timestamp, so a phone's newest turns are a slice away. Nothing is
+    persisted; the interactions are gone when the process exits.
+    """
+
+    def __init__(self, logger=None, cache=None):
+        """
+        :param logger: Logger used to report storage errors.
+        :param cache: Optional LRUCache or RedisCache holding each phone's interactions.
+        """
+        super().__init__(logger=logger, cache=cache)
+        self.table_name = None
+        self.table = None
+
+
+    def exists(self, table_name):
+        with _tables_lock:
+            if table_name not in _tables:
+                return False
+            self.table_name = table_name
+            self.table = _tables[table_name]
+        return True
+
+
+    def use_table(self, table_name):
+        # Nothing outlives the process, so there is no table to provision beforehand
+        self.create_table(table_name)
+
+
+    def create_table(self, table_name):
+        with _tables_lock:
+            self.table = _tables.setdefault(
+                table_name, {"phones": {}, "summaries": {}, "lock": threading.Lock()}
+            )
+            self.table_name = table_name
+        return self.table
+
+
+    def delete_table(self):
+        with _tables_lock:
+            _tables.pop(self.table_name, None)
+        self.table_name = None
+        self.table = None
+
+
+    def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None):
+        with self.table["lock"]:
+            # Copy the slice, so writes while the caller iterates don't affect it
+            items = self.table["phones"].get(phone, [])
+            if limit is not None:
+                items = items[-limit:] if newest_first else items[:limit]
+            items = list(reversed(items)) if newest_first else list(items)
+        for item in items:
+            yield dict(item)
+
+
+    def scan_all(self, segments=4, attributes=None, page_size=None):
+        with self.table["lock"]:
+            phones = list(self.table["phones"])
+        for phone in phones:
+            for item in self.iter_interactions(phone):
+                yield {name: item[name] for name in attributes if name in item} if attributes else item
+
+
+    def get_summary(self, phone):
+        with self.table["lock"]:
+            summary = self.table["summaries"].get(phone)
+        return dict(summary) if summary is not None else None
+
+
+    def put_summary(self, phone, summary, through):
+        with self.table["lock"]:
+            self.table["summaries"][phone] = {"summary": summary, "through": through}
+
+
+    def _store(self, item):
+        with self.table["lock"]:
+            items = self.table["phones"].setdefault(item["phone"], [])
+            if not items or items[-1]["timestamp"] < item["timestamp"]:
+                # The usual case: the newest interaction of the conversation
+                items.append(dict(item))
+                return
+            # Replace an item with the same key, as a DynamoDB put would
+            index = bisect.bisect_left([stored["timestamp"] for stored in items], item["timestamp"])
+            if index < len(items) and items[index]["timestamp"] == item["timestamp"]:
+                items[index] = dict(item)
+            else:
+                items.insert(index, dict(item))
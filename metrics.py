@@ -0,0 +1,161 @@
+import threading
+
+# Seconds; spans a DynamoDB read through a slow GPT-4 answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A count that only goes up, per combination of label values."""
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: The metric name.
+        :param help: The description shown by Prometheus.
+        :param labels: The label names.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+    def inc(self, amount=1, **labels):
+        """
+        :param amount: How much to add.
+        :param labels: The value of every label.
+        """
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, per combination of label values."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param name: The metric name.
+        :param help: The description shown by Prometheus.
+        :param labels: The label names.
+        :param buckets: The upper bounds of the buckets, ascending.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.lock = threading.Lock()
+        # label values -> [bucket counts..., sum, count]
+        self.values = {}
+
+
+    def observe(self, value, **labels):
+        """
+        :param value: The observation, in seconds for timings.
+        :param labels: The value of every label.
+        """
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+
+    def render(self):
+        with self.lock:
+            values = {key: list(state) for key, state in self.values.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {state[-1]}")
+        return lines
+
+
+class Gauge:
+    """A value read from a function whenever the metrics are collected."""
+
+    def __init__(self, name, help, function):
+        """
+        :param name: The metric name.
+        :param help: The description shown by Prometheus.
+        :param function: Returns the current value.
+        """
+        self.name = name
+        self.help = help
+        self.function = function
+
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(self.function())}"]
+
+
+class Registry:
+    """Collects metrics and renders them in the Prometheus text format.
+
+    Example:
+        registry = Registry()
+        stage_seconds = registry.register(Histogram("stage_seconds", "Time per stage", ["stage"]))
+        stage_seconds.observe(0.25, stage="query")
+        body = registry.render()
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric):
+        """
+        :param metric: A Counter, Histogram or Gauge.
+        :return: The metric.
+        """
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,82 @@
+import argparse
+import logging
+import os
+
+import boto3
+from botocore.exceptions import ClientError
+
+from interactions import Interactions, sortable_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(interactions, dry_run=False):
+    """
+    Rewrites every interaction whose sort key uses the legacy timestamp format.
+    Each item is moved in a transaction that puts the new key and deletes the old
+    one, so the app can keep serving while the migration runs.
+
+    :param interactions: An Interactions object whose table exists.
+    :param dry_run: Only count the items that would be migrated.
+    :return: The number of items migrated.
+    """
+    table = interactions.table
+    # The resource's client serializes plain Python values like the Table does
+    client = interactions.dyn_resource.meta.client
+    migrated = 0
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response["Items"]:
+            new_timestamp = sortable_timestamp(item["timestamp"])
+            if new_timestamp == item["timestamp"]:
+                continue
+            migrated += 1
+            if dry_run:
+                continue
+            new_item = dict(item, timestamp=new_timestamp)
+            try:
+                client.transact_write_items(
+                    TransactItems=[
+                        {
+                            "Put": {
+                                "TableName": table.name,
+                                "Item": new_item,
+                                "ConditionExpression": "attribute_not_exists(phone)",
+                            }
+                        },
+                        {
+                            "Delete": {
+                                "TableName": table.name,
+                                "Key": {"phone": item["phone"], "timestamp": item["timestamp"]},
+                            }
+                        },
+                    ]
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "TransactionCanceledException":
+                    raise
+                # A previous run may have written the new key already; only then
+                # is it safe to remove the legacy copy on its own.
+                existing = table.get_item(Key={"phone": item["phone"], "timestamp": new_timestamp})
+                if "Item" not in existing:
+                    raise
+                table.delete_item(Key={"phone": item["phone"], "timestamp": item["timestamp"]})
+        if "LastEvaluatedKey" not in response:
+            return migrated
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite interaction sort keys to the sortable ISO-8601 format.")
+    parser.add_argument("--table", default=os.environ.get("DDB_TABLE"), help="The interactions table (defaults to DDB_TABLE).")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the items that would be migrated.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+    interactions = Interactions(dynamodb, logger=logger)
+    if not interactions.exists(args.table):
+        parser.error(f"table {args.table} does not exist")
+    count = migrate(interactions, dry_run=args.dry_run)
+    logger.info("%s %s items in %s", "Would migrate" if args.dry_run else "Migrated", count, args.table)
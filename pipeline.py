@@ -0,0 +1,171 @@
+import logging
+import queue
+import threading
+from collections import deque
+
+
+class ReplyPipeline:
+    """Runs WhatsApp reply jobs in the background so the webhook can return at once.
+
+    Jobs are placed on a bounded queue and drained by a fixed pool of worker
+    threads. When the queue is full, submit refuses the job instead of blocking,
+    which lets the webhook push back on Twilio rather than pile up work.
+
+    Jobs submitted with the same key run one at a time, in the order they were
+    submitted: a worker that picks up a job whose key is already running
+    leaves it to the worker running that key, which runs it next. Keying
+    replies by phone keeps a phone's messages from each reading the history
+    before the others are stored.
+
+    Example:
+        pipeline = ReplyPipeline(process_message, workers=4, max_queue=100)
+        pipeline.start()
+        if not pipeline.submit(job, key=phone):
+            # queue is full, tell the caller to retry later
+            ...
+        pipeline.shutdown(timeout=30)
+    """
+
+    def __init__(self, handler, workers=4, max_queue=100, logger=None):
+        """
+        :param handler: Callable run by a worker for every submitted job.
+        :param workers: Number of worker threads.
+        :param max_queue: Maximum number of jobs waiting to be picked up,
+                          including those waiting behind a job with the same key.
+        :param logger: Logger used to report failed jobs.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_queue = max_queue
+        self.queue = queue.Queue(maxsize=max_queue)
+        # Running keys -> the jobs with that key waiting behind the running one
+        self.waiting = {}
+        self.threads = []
+        self.accepting = False
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0}
+
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        with self.lock:
+            if self.accepting:
+                return
+            self.accepting = True
+            for n in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"reply-worker-{n}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+
+    def submit(self, job, key=None):
+        """
+        Queues a job without blocking.
+
+        :param job: The job to hand to the handler.
+        :param key: Optional key, such as a phone number; jobs with the same
+                    key never run at the same time.
+        :return: True when the job was queued; False when the pipeline is full or
+                 shutting down.
+        """
+        with self.lock:
+            if not self.accepting or self._depth() >= self.max_queue:
+                self.stats["rejected"] += 1
+                return False
+            try:
+                self.queue.put_nowait((key, job))
+            except queue.Full:
+                self.stats["rejected"] += 1
+                return False
+            self.stats["submitted"] += 1
+            return True
+
+
+    def depth(self):
+        """
+        :return: The number of jobs waiting to be picked up.
+        """
+        with self.lock:
+            return self._depth()
+
+
+    def full(self):
+        """
+        :return: True when submit would refuse a job because the queue is full.
+        """
+        return self.depth() >= self.max_queue
+
+
+    def shutdown(self, timeout=30):
+        """
+        Stops accepting jobs and waits for queued and running jobs to finish.
+
+        :param timeout: Seconds to wait for each worker to drain.
+        :return: True when every worker exited within the timeout.
+        """
+        with self.lock:
+            if not self.accepting:
+                return True
+            self.accepting = False
+        for _ in self.threads:
+            # Sentinels go behind the queued jobs so those are drained first.
+            self.queue.put(None)
+        drained = True
+        for thread in self.threads:
+            thread.join(timeout)
+            drained = drained and not thread.is_alive()
+        if not drained:
+            self.logger.error(
+                "Reply pipeline shut down with %s jobs still queued", self.depth()
+            )
+        self.threads = []
+        return drained
+
+
+    def _depth(self):
+        # Called with the lock held
+        return self.queue.qsize() + sum(len(jobs) for jobs in self.waiting.values())
+
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                key, job = item
+                if key is not None:
+                    with self.lock:
+                        if key in self.waiting:
+                            # Another worker runs this key; it runs the job next
+                            self.waiting[key].append(job)
+                            continue
+                        self.waiting[key] = deque()
+                while job is not None:
+                    self._run(job)
+                    job = None
+                    if key is not None:
+                        with self.lock:
+                            if self.waiting[key]:
+                                job = self.waiting[key].popleft()
+                            else:
+                                del self.waiting[key]
+            finally:
+                self.queue.task_done()
+
+
+    def _run(self, job):
+        try:
+            self.handler(job)
+        except Exception:
+            self.logger.exception("Reply job failed")
+            with self.lock:
+                self.stats["failed"] += 1
+        else:
+            with self.lock:
+                self.stats["completed"] += 1
@@ -1,15 +1,35 @@
-from interactions import Interactions
+import argparse
+import logging
 import os
+
 import boto3
-import logging
-import time
 
-dynamodb = boto3.resource("dynamodb",region_name=os.environ["AWS_REGION"])
-table = os.environ["DDB_TABLE"]
-logger = logging.getLogger(__name__)
-interactions = Interactions(dynamodb, logger=logger)
+from bootstrap import bootstrap
+from bulk_load import match_capacity, rebuild, rebuild_name
+from interactions import Interactions
+
+# Recreating the table used to delete it and create it again under the same
+# name, which took the app down and lost every interaction. The table is now
+# rebuilt under a new name and left in place; see bulk_load.py for switching over.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recreate the interactions table under a new name.")
+    parser.add_argument("--table", default=os.environ.get("DDB_TABLE"), help="The table (defaults to DDB_TABLE).")
+    parser.add_argument("--empty", action="store_true", help="Create the new table without copying the interactions.")
+    parser.add_argument("--on-demand", action="store_true", help="Give the new table on-demand capacity instead of the old one's.")
+    args = parser.parse_args()
+    if not args.table:
+        parser.error("--table or DDB_TABLE is required")
 
-if interactions.exists(table):
-	interactions.delete_table()
-	time.sleep(10)
-interactions.create_table(table)
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+    interactions = Interactions(dynamodb, logger=logger)
+    destination = rebuild_name(args.table)
+    source = interactions.table if interactions.exists(args.table) else None
+    if args.empty or source is None:
+        bootstrap(interactions, destination)
+        if source is not None:
+            match_capacity(source, interactions.table, args.on_demand)
+        logger.info("Created %s; set DDB_TABLE=%s on the App Runner service to use it", destination, destination)
+    else:
+        rebuild(dynamodb, args.table, destination, on_demand=args.on_demand)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import re
+import unicodedata
+
+# Text that identifies a person: e-mail addresses, phone numbers, links and
+# ID-like numbers
+PERSONAL_DATA = re.compile(
+    r"[^\s@]+@[^\s@]+\.\w+"
+    r"|\+?\d[\d\s().-]{5,}\d"
+    r"|https?://\S+|www\.\S+",
+    re.IGNORECASE,
+)
+PUNCTUATION_AROUND = " \t\n.,;:!?\"'()[]{}…。？！؟"
+
+
+def normalize(text):
+    """
+    Normalizes a message so trivially different spellings of it match:
+    Unicode compatibility forms, case, runs of whitespace and punctuation at
+    either end.
+
+    :param text: The message.
+    :return: The normalized message.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split()).strip(PUNCTUATION_AROUND)
+
+
+def _digest(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Caches the model's answers to repeated questions.
+
+    An answer is cached under the mentor type, the model, the normalized
+    question and a hash of the whole prompt before it: the persona, the
+    summary and the earlier turns. Repeating a question in the same context
+    is therefore answered without calling the model.
+
+    Answers are only shared between phones when the conversation is short
+    (at most shared_max_turns earlier turns, and no summary) and neither the
+    question nor those turns contain personal data: e-mail addresses, phone
+    numbers, links, or the sender's profile name. Other answers are cached
+    for the asking phone alone, under a key derived from a hash of the phone
+    number. Keys never contain message text or phone numbers.
+
+    The backend is an LRUCache for one process or a RedisCache shared by all
+    instances; either bounds the entries and expires them after a TTL.
+
+    Example:
+        responses = ResponseCache(LRUCache(max_size=1000, ttl=86400))
+        key = responses.key(phone, "local", question, chatapp.messages, "gpt-4", name=name)
+        reply = responses.get(key)
+        if reply is None:
+            reply = chatapp.chat(prompt)
+            responses.set(key, reply)
+    """
+
+    def __init__(self, cache, shared_max_turns=1):
+        """
+        :param cache: An LRUCache or RedisCache holding the answers.
+        :param shared_max_turns: The most earlier turns a conversation may have
+                                 for its answers to be shared between phones.
+        """
+        self.cache = cache
+        self.shared_max_turns = shared_max_turns
+
+
+    def key(self, phone, mentor_type, question, context, model, name=None):
+        """
+        Builds the cache key of a question.
+
+        :param phone: The asking phone number.
+        :param mentor_type: Refugee/Local/AI
+        :param question: The user's question as they wrote it.
+        :param context: The prompt messages sent before the question, as
+                        {"role": ..., "content": ...} dicts.
+        :param model: The model that answers.
+        :param name: The sender's profile name, treated as personal data.
+        :return: The key.
+        """
+        normalized_context = [(message["role"], normalize(message["content"])) for message in context]
+        digest = _digest(mentor_type, model, normalize(question), _digest(normalized_context))
+        if self.shareable(question, context, name):
+            return f"shared:{digest}"
+        return f"phone:{_digest(phone)[:32]}:{digest}"
+
+
+    def shareable(self, question, context, name=None):
+        """
+        :param question: The user's question.
+        :param context: The prompt messages sent before the question.
+        :param name: The sender's profile name.
+        :return: True when the answer may be served to other phones.
+        """
+        if any(message["role"] == "system" and index > 0 for index, message in enumerate(context)):
+            # A summary of an earlier conversation
+            return False
+        user_texts = [message["content"] for message in context if message["role"] == "user"]
+        if len(user_texts) > self.shared_max_turns:
+            return False
+        # Any part of the profile name, as a whole word
+        names = [re.escape(part) for part in normalize(name or "").split() if len(part) > 1]
+        name_pattern = re.compile(r"\b(?:" + "|".join(names) + r")\b") if names else None
+        for text in user_texts + [question]:
+            if PERSONAL_DATA.search(text):
+                return False
+            if name_pattern is not None and name_pattern.search(normalize(text)):
+                return False
+        return True
+
+
+    def get(self, key):
+        """
+        :param key: A key from key().
+        :return: The cached answer, or None.
+        """
+        entry = self.cache.get(key)
+        return None if entry is None else entry["reply"]
+
+
+    def set(self, key, reply):
+        """
+        Caches an answer.
+
+        :param key: A key from key().
+        :param reply: The model's answer.
+        """
+        self.cache.set(key, {"reply": reply})
+
+
+    def stats(self):
+        """
+        :return: The hit and miss counters of the backend.
+        """
+        return self.cache.stats()
@@ -0,0 +1,67 @@
+import logging
+from collections import namedtuple
+
+# The model to call, the model to fail over to, the seconds the first call may
+# take, and why the model was chosen
+Route = namedtuple("Route", ["model", "fallback", "timeout", "reason"])
+
+
+class ModelRouter:
+    """Chooses between a fast model and the main model for each reply.
+
+    The main business-advice turn always goes to the main model. Other turns go
+    to the fast model when the message is short or when little of the
+    request's latency budget is left. Every route names the other model as a
+    fallback for when the first call times out.
+
+    Example:
+        router = ModelRouter(fast_model="gpt-3.5-turbo", main_model="gpt-4")
+        route = router.choose(message, previous_interaction_count=3, latency_budget=12)
+        reply = chatapp.chat(message, route=route)
+    """
+
+    def __init__(self, fast_model="gpt-3.5-turbo", main_model="gpt-4", short_message_chars=120,
+                 fast_below_budget=10, fast_timeout=10, main_timeout=25, logger=None):
+        """
+        :param fast_model: The low-latency model.
+        :param main_model: The model used for the main advice.
+        :param short_message_chars: Messages up to this length go to the fast model.
+        :param fast_below_budget: Seconds of latency budget under which the fast model is used.
+        :param fast_timeout: Seconds the fast model gets before failing over.
+        :param main_timeout: Seconds the main model gets before failing over.
+        :param logger: Logger used to record routing decisions.
+        """
+        self.fast_model = fast_model
+        self.main_model = main_model
+        self.short_message_chars = short_message_chars
+        self.fast_below_budget = fast_below_budget
+        self.timeouts = {fast_model: fast_timeout, main_model: main_timeout}
+        self.logger = logger or logging.getLogger(__name__)
+
+
+    def choose(self, message, previous_interaction_count, latency_budget=None):
+        """
+        Chooses the model for a reply.
+
+        :param message: The user's message.
+        :param previous_interaction_count: The number of earlier interactions.
+        :param latency_budget: Seconds left to answer, if the request has a budget.
+        :return: The Route to take.
+        """
+        if previous_interaction_count == 1:
+            model, reason = self.main_model, "main advice turn"
+        elif latency_budget is not None and latency_budget < self.fast_below_budget:
+            model, reason = self.fast_model, f"{latency_budget:.1f}s latency budget left"
+        elif len(message) <= self.short_message_chars:
+            model, reason = self.fast_model, f"short message of {len(message)} characters"
+        else:
+            model, reason = self.main_model, "long follow-up"
+
+        fallback = self.fast_model if model == self.main_model else self.main_model
+        timeout = self.timeouts[model]
+        if latency_budget is not None:
+            # Leave part of the budget for the fallback call
+            timeout = max(1, min(timeout, latency_budget / 2))
+        route = Route(model, fallback, timeout, reason)
+        self.logger.info("Routing to %s (fallback %s, timeout %.1fs): %s", model, fallback, timeout, reason)
+        return route
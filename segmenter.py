@@ -0,0 +1,175 @@
+import unicodedata
+
+# Characters that end a sentence, and so may end a WhatsApp chunk, including
+# the ideographic, Arabic and Devanagari ones
+SENTENCE_ENDS = [".", "?", "!", "\u2026", "\u3002", "\uff1f", "\uff01", "\u061f", "\u06d4", "\u0964"]
+
+# Twilio rejects WhatsApp bodies longer than this many characters
+WHATSAPP_MAX_CHARS = 1600
+
+ZERO_WIDTH_JOINER = "\u200d"
+
+
+def body_length(text):
+    """
+    Measures text the way the length limit counts it, in UTF-16 code units, so
+    an emoji outside the Basic Multilingual Plane counts twice.
+
+    :param text: The message body.
+    :return: The length of the body.
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_message(message, chunk_sz, max_chars=WHATSAPP_MAX_CHARS):
+    """
+    Splits a message into chunks of at least chunk_sz characters that end at a
+    sentence boundary, except for the last one. No chunk is longer than
+    max_chars; see SentenceSegmenter.
+
+    :param message: The message to split.
+    :param chunk_sz: The minimum chunk size.
+    :param max_chars: The maximum chunk length, as counted by body_length.
+    :return: A generator of chunks.
+    """
+    segmenter = SentenceSegmenter(chunk_sz, max_chars=max_chars)
+    yield from segmenter.feed(message)
+    yield from segmenter.flush()
+
+
+def _sentence_ends(text, start):
+    # Yields the index after each sentence end from start on. A sentence end
+    # followed by a digit ("3.5") or by another one ("?!", "...") doesn't end
+    # the sentence; one at the end of the text may not either, once more text
+    # arrives.
+    for j in range(start, len(text)):
+        if text[j] in SENTENCE_ENDS:
+            if j + 1 < len(text) and (text[j + 1] in SENTENCE_ENDS or text[j + 1].isdigit()):
+                continue
+            yield j + 1
+
+
+def _fitting(text, max_chars):
+    # The number of leading characters of text whose body_length is at most max_chars
+    if len(text) * 2 <= max_chars:
+        return len(text)
+    length = 0
+    for i, character in enumerate(text):
+        length += 2 if ord(character) > 0xFFFF else 1
+        if length > max_chars:
+            return i
+    return len(text)
+
+
+def _joins_previous(text, i):
+    # Whether text[i] belongs to the same user-perceived character as text[i - 1]:
+    # combining marks, joiners, variation selectors, skin tone modifiers, emoji
+    # tags and the second regional indicator of a flag
+    character = text[i]
+    code = ord(character)
+    if unicodedata.category(character) in ("Mn", "Mc", "Me") or character == ZERO_WIDTH_JOINER:
+        return True
+    if text[i - 1] == ZERO_WIDTH_JOINER or 0xFE00 <= code <= 0xFE0F:
+        return True
+    if 0x1F3FB <= code <= 0x1F3FF or 0xE0020 <= code <= 0xE007F:
+        return True
+    if 0x1F1E6 <= code <= 0x1F1FF:
+        indicators = 0
+        while i - indicators > 0 and 0x1F1E6 <= ord(text[i - indicators - 1]) <= 0x1F1FF:
+            indicators += 1
+        return indicators % 2 == 1
+    return False
+
+
+def _next_cut(text, size, max_chars, final):
+    # The end of the next chunk of text, or None until more text decides it
+    fits = _fitting(text, max_chars)
+    for end in _sentence_ends(text, size):
+        if end > fits:
+            break
+        if end == len(text) and not final:
+            return None
+        return end
+    else:
+        if fits == len(text):
+            return len(text) if final and text else None
+    # The chunk would be too long: end it at the last sentence end that fits,
+    # else after the last whitespace, else between two characters
+    ends = [end for end in _sentence_ends(text[:fits + 1], 0) if end <= fits]
+    if ends:
+        return ends[-1]
+    for cut in range(fits, 0, -1):
+        if text[cut - 1].isspace():
+            return cut
+    cut = fits
+    while cut > 1 and _joins_previous(text, cut):
+        cut -= 1
+    return max(cut, 1)
+
+
+class SentenceSegmenter:
+    """Cuts streamed text into chunks as soon as they are complete.
+
+    A chunk is complete at the first sentence end once it holds at least the
+    chunk size. The first chunk may use a smaller size so the user sees the
+    start of the answer sooner. A chunk that would grow past max_chars ends at
+    its last sentence end or whitespace that fits instead, and as a last resort
+    between two characters, never inside an accented letter, flag or emoji
+    sequence. Chunks are stripped of surrounding whitespace, and blank ones are
+    dropped.
+
+    Example:
+        segmenter = SentenceSegmenter(chunk_sz=300, first_chunk_sz=80)
+        for delta in chatapp.chat_stream(message):
+            for chunk in segmenter.feed(delta):
+                send(chunk)
+        for chunk in segmenter.flush():
+            send(chunk)
+    """
+
+    def __init__(self, chunk_sz, first_chunk_sz=None, max_chars=WHATSAPP_MAX_CHARS):
+        """
+        :param chunk_sz: The minimum chunk size.
+        :param first_chunk_sz: The minimum size of the first chunk; defaults to chunk_sz.
+        :param max_chars: The maximum chunk length, as counted by body_length.
+        """
+        self.chunk_sz = chunk_sz
+        self.first_chunk_sz = chunk_sz if first_chunk_sz is None else first_chunk_sz
+        self.max_chars = max_chars
+        self.buffer = ""
+        self.emitted = 0
+
+
+    def feed(self, text):
+        """
+        Adds streamed text.
+
+        :param text: The next fragment of the message.
+        :return: The chunks completed by this fragment.
+        """
+        self.buffer += text
+        return self._cut(final=False)
+
+
+    def flush(self):
+        """
+        Ends the message.
+
+        :return: The remaining text as final chunks, if any.
+        """
+        return self._cut(final=True)
+
+
+    def _cut(self, final):
+        chunks = []
+        while self.buffer:
+            size = self.first_chunk_sz if self.emitted == 0 else self.chunk_sz
+            cut = _next_cut(self.buffer, size, self.max_chars, final)
+            if cut is None:
+                break
+            chunk = self.buffer[:cut].strip()
+            self.buffer = self.buffer[cut:]
+            if chunk:
+                chunks.append(chunk)
+                self.emitted += 1
+        return chunks
@@ -0,0 +1,172 @@
+import logging
+import time
+from collections import namedtuple
+
+from twilio.base.exceptions import TwilioException
+
+from delivery import SUCCESS_STATUSES, TERMINAL_STATUSES
+
+# The outcome of sending one reply: whether every chunk reached the user, the
+# chunk SIDs in order, sid -> last status seen, when each chunk was accepted
+# (time.monotonic() values), and what went wrong, if anything
+SendResult = namedtuple("SendResult", ["succeeded", "sids", "statuses", "sent_at", "error"])
+
+
+class WhatsAppSender:
+    """Sends the chunks of a reply through Twilio, in order, without waiting
+    for each one's delivery.
+
+    Twilio doesn't guarantee the order of messages created in quick
+    succession, so a chunk is only submitted once the one before it is
+    "sent", that is, handed to WhatsApp, which keeps the order from there.
+    That status is polled every fraction of a second, for up to sent_timeout
+    seconds. Instead of also waiting for a chunk to be delivered before
+    submitting the next, up to max_in_flight chunks may be awaiting delivery
+    at once; their statuses are polled in between submissions, on the
+    calling thread. With max_in_flight=1 this is the old send, wait, send loop.
+
+    A chunk that fails, or that hasn't reached the user after max_polls
+    polls, fails the reply, and no further chunks are sent. With a
+    status_callback URL only the "sent" status is polled, to keep the order;
+    delivery is left to the callbacks, see DeliveryTracker.
+
+    Example:
+        sender = WhatsAppSender(twilio_client, "whatsapp:+15550000000", max_in_flight=3)
+        result = sender.send("whatsapp:+256700000000", split_message(reply, 300))
+        if not result.succeeded:
+            ...
+    """
+
+    def __init__(self, client, from_, max_in_flight=3, max_polls=3, status_callback=None,
+                 on_stage=None, logger=None, sent_timeout=10):
+        """
+        :param client: The Twilio client.
+        :param from_: The WhatsApp number replies are sent from.
+        :param max_in_flight: Chunks that may await delivery at once.
+        :param max_polls: Status polls of a chunk, k seconds apart for the k-th poll.
+        :param status_callback: Optional URL Twilio reports delivery statuses to.
+        :param on_stage: Optional on_stage(stage, started) called after each
+                         "twilio_send" and "delivery_wait", with the
+                         time.monotonic() the stage started at.
+        :param logger: Logger used to report failed sends.
+        :param sent_timeout: Seconds a chunk may take to be sent before the
+                             reply fails instead of sending the next one.
+        """
+        self.client = client
+        self.from_ = from_
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_polls = max_polls
+        self.status_callback = status_callback
+        self.on_stage = on_stage
+        self.logger = logger or logging.getLogger(__name__)
+        self.sent_timeout = sent_timeout
+
+
+    def send(self, to, chunks):
+        """
+        Sends a reply.
+
+        :param to: The recipient's WhatsApp number.
+        :param chunks: The chunks of the reply, in order; any iterable, so
+                       chunks of a streamed answer go out as they are produced.
+        :return: A SendResult.
+        """
+        sids = []
+        statuses = {}
+        sent_at = []
+        # Chunks awaiting delivery, oldest first: dicts of sid, created, polls, next_poll
+        in_flight = []
+        for chunk in chunks:
+            if sids:
+                error = self._await_sent(sids[-1], statuses)
+                if error:
+                    return SendResult(False, sids, statuses, sent_at, error)
+            # Wait for a free slot before submitting the next chunk
+            while len(in_flight) >= self.max_in_flight:
+                error = self._poll(in_flight, statuses, wait=True)
+                if error:
+                    return SendResult(False, sids, statuses, sent_at, error)
+
+            started = time.monotonic()
+            try:
+                message = self.client.messages.create(**self._message(to, chunk))
+            except TwilioException as err:
+                self.logger.error("Couldn't send chunk %s of the reply to %s. Here's why: %s", len(sids) + 1, to, err)
+                return SendResult(False, sids, statuses, sent_at, f"sending response message {len(sids) + 1} failed: {err}")
+            self._stage("twilio_send", started)
+            sids.append(message.sid)
+            statuses[message.sid] = message.status
+            sent_at.append(time.monotonic())
+            if self.status_callback is None:
+                in_flight.append({"sid": message.sid, "created": started, "polls": 0, "next_poll": sent_at[-1] + 1})
+                error = self._poll(in_flight, statuses, wait=False)
+                if error:
+                    return SendResult(False, sids, statuses, sent_at, error)
+
+        while in_flight:
+            error = self._poll(in_flight, statuses, wait=True)
+            if error:
+                return SendResult(False, sids, statuses, sent_at, error)
+        return SendResult(True, sids, statuses, sent_at, None)
+
+
+    def _message(self, to, chunk):
+        message = {"to": to, "from_": self.from_, "body": chunk}
+        if self.status_callback is not None:
+            message["status_callback"] = self.status_callback
+        return message
+
+
+    def _await_sent(self, sid, statuses):
+        # Polls a chunk until WhatsApp has it, so the next chunk can't overtake
+        # it. Returns an error when it failed or took longer than sent_timeout.
+        deadline = time.monotonic() + self.sent_timeout
+        delay = 0.25
+        while statuses[sid] not in SUCCESS_STATUSES and statuses[sid] not in TERMINAL_STATUSES:
+            if time.monotonic() + delay > deadline:
+                return f"response message sid={sid} was not sent within {self.sent_timeout}s"
+            time.sleep(delay)
+            try:
+                statuses[sid] = self.client.messages(sid).fetch().status
+            except TwilioException as err:
+                self.logger.warning("Couldn't fetch the status of %s. Here's why: %s", sid, err)
+            delay = min(delay * 2, 1)
+        if statuses[sid] not in SUCCESS_STATUSES:
+            return f"delivery of response message sid={sid} failed with status {statuses[sid]}"
+        return None
+
+
+    def _poll(self, in_flight, statuses, wait):
+        # Fetches the status of the chunks that are due, after sleeping until
+        # the first one is when wait is set, and retires the chunks that are
+        # done. Returns an error when a retired chunk failed.
+        if wait:
+            delay = min(chunk["next_poll"] for chunk in in_flight) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.monotonic()
+        for chunk in list(in_flight):
+            sid = chunk["sid"]
+            if statuses[sid] not in TERMINAL_STATUSES and chunk["polls"] < self.max_polls:
+                if chunk["next_poll"] > now:
+                    continue
+                try:
+                    statuses[sid] = self.client.messages(sid).fetch().status
+                except TwilioException as err:
+                    # A failed fetch uses up the poll; the next one may succeed
+                    self.logger.warning("Couldn't fetch the status of %s. Here's why: %s", sid, err)
+                chunk["polls"] += 1
+                # The k-th poll comes k seconds after the one before, as in the old loop
+                chunk["next_poll"] = now + chunk["polls"] + 1
+                if statuses[sid] not in TERMINAL_STATUSES and chunk["polls"] < self.max_polls:
+                    continue
+            in_flight.remove(chunk)
+            self._stage("delivery_wait", chunk["created"])
+            if statuses[sid] not in SUCCESS_STATUSES:
+                return f"delivery of response message sid={sid} failed with status {statuses[sid]}"
+        return None
+
+
+    def _stage(self, stage, started):
+        if self.on_stage is not None:
+            self.on_stage(stage, started)
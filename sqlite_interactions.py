@@ -0,0 +1,169 @@
+import sqlite3
+import threading
+
+from storage import InteractionStore
+
+COLUMNS = ("phone", "timestamp", "received_message", "sent_message", "mentor_type", "name", "tokens")
+
+
+class SqliteInteractions(InteractionStore):
+    """Keeps interactions in a local SQLite database.
+
+    The interactions table's primary key is (phone, timestamp), so reading a
+    phone's newest turns is an index range scan. The database runs in WAL
+    mode, letting readers carry on while a reply is written, and every thread
+    gets a connection of its own.
+    """
+
+    def __init__(self, path, logger=None, cache=None, timeout=30):
+        """
+        :param path: The database file. In-memory databases (":memory:" or "")
+                     are refused: each thread's connection would get a
+                     different, empty one.
+        :param logger: Logger used to report storage errors.
+        :param cache: Optional LRUCache or RedisCache holding each phone's interactions.
+        :param timeout: Seconds a write waits for another connection's transaction.
+        """
+        if path in (":memory:", ""):
+            raise ValueError("SqliteInteractions needs a database file; an in-memory database is per connection")
+        super().__init__(logger=logger, cache=cache)
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.table_name = None
+
+
+    def exists(self, table_name):
+        found = self._execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+        ).fetchone()
+        if found is None:
+            return False
+        self.table_name = table_name
+        return True
+
+
+    def use_table(self, table_name):
+        # Creating a missing SQLite table is a quick local operation
+        self.create_table(table_name)
+
+
+    def create_table(self, table_name):
+        connection = self._connection()
+        try:
+            with connection:
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self._quote(table_name)} ("
+                    "phone TEXT NOT NULL, timestamp TEXT NOT NULL, received_message TEXT, "
+                    "sent_message TEXT, mentor_type TEXT, name TEXT, tokens INTEGER, "
+                    "PRIMARY KEY (phone, timestamp)) WITHOUT ROWID"
+                )
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self._quote(table_name + '_summary')} ("
+                    "phone TEXT PRIMARY KEY, summary TEXT, through TEXT)"
+                )
+        except sqlite3.Error as err:
+            self.logger.error("Couldn't create table %s. Here's why: %s", table_name, err)
+            raise
+        self.table_name = table_name
+
+
+    def delete_table(self):
+        connection = self._connection()
+        try:
+            with connection:
+                connection.execute(f"DROP TABLE IF EXISTS {self._quote(self.table_name)}")
+                connection.execute(f"DROP TABLE IF EXISTS {self._quote(self.table_name + '_summary')}")
+        except sqlite3.Error as err:
+            self.logger.error("Couldn't delete table. Here's why: %s", err)
+            raise
+        self.table_name = None
+
+
+    def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None):
+        query = (
+            f"SELECT {', '.join(COLUMNS)} FROM {self._quote(self.table_name)} "
+            f"WHERE phone = ? ORDER BY timestamp {'DESC' if newest_first else 'ASC'}"
+        )
+        parameters = (phone,)
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters += (limit,)
+        cursor = self._execute(query, parameters)
+        while True:
+            rows = cursor.fetchmany(page_size or 100)
+            if not rows:
+                return
+            for row in rows:
+                item = dict(zip(COLUMNS, row))
+                if item["tokens"] is None:
+                    del item["tokens"]
+                yield item
+
+
+    def scan_all(self, segments=4, attributes=None, page_size=None):
+        columns = [column for column in COLUMNS if not attributes or column in attributes]
+        cursor = self._execute(f"SELECT {', '.join(columns)} FROM {self._quote(self.table_name)}")
+        while True:
+            rows = cursor.fetchmany(page_size or 1000)
+            if not rows:
+                return
+            for row in rows:
+                yield {column: value for column, value in zip(columns, row) if value is not None}
+
+
+    def get_summary(self, phone):
+        row = self._execute(
+            f"SELECT summary, through FROM {self._quote(self.table_name + '_summary')} WHERE phone = ?", (phone,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"summary": row[0], "through": row[1]}
+
+
+    def put_summary(self, phone, summary, through):
+        self._write(
+            f"INSERT OR REPLACE INTO {self._quote(self.table_name + '_summary')} VALUES (?, ?, ?)",
+            (phone, summary, through),
+        )
+
+
+    def _store(self, item):
+        self._write(
+            f"INSERT OR REPLACE INTO {self._quote(self.table_name)} ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})",
+            tuple(item.get(column) for column in COLUMNS),
+        )
+
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # WAL keeps the database consistent with fewer syncs
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+
+    def _execute(self, query, parameters=()):
+        try:
+            return self._connection().execute(query, parameters)
+        except sqlite3.Error as err:
+            self.logger.error("Couldn't read from %s. Here's why: %s", self.table_name, err)
+            raise
+
+
+    def _write(self, query, parameters):
+        connection = self._connection()
+        try:
+            with connection:
+                connection.execute(query, parameters)
+        except sqlite3.Error as err:
+            self.logger.error("Couldn't write to %s. Here's why: %s", self.table_name, err)
+            raise
+
+
+    def _quote(self, identifier):
+        return '"' + identifier.replace('"', '""') + '"'
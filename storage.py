@@ -0,0 +1,275 @@
+import logging
+from abc import ABC, abstractmethod
+
+
+class InteractionStore(ABC):
+    """The storage interface of the WhatsApp mentor's interactions.
+
+    Implementations keep each phone's interactions ordered by timestamp,
+    together with the phone's rolling summary. They must provide exists,
+    use_table, create_table, delete_table, iter_interactions, scan_all,
+    get_summary, put_summary and _store; this class builds add_interaction,
+    query_interactions, query_history, query_context and update_summary on
+    top of them, including the optional history cache.
+
+    Implementations:
+        Interactions         -- one DynamoDB item per interaction
+        CompactInteractions  -- one DynamoDB item per conversation
+        MemoryInteractions   -- in-process dict, for tests and load tests
+        SqliteInteractions   -- a local SQLite database file
+    """
+
+    def __init__(self, logger=None, cache=None):
+        """
+        :param logger: Logger used to report storage errors.
+        :param cache: Optional LRUCache or RedisCache holding each phone's
+                      interactions, written through by add_interaction.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.cache = cache
+        # Only the DynamoDB layout buffers writes; see WriteBehindBuffer
+        self.write_behind = None
+
+
+    @abstractmethod
+    def exists(self, table_name):
+        """
+        Determines whether a table exists, and uses it when it does.
+
+        :param table_name: The name of the table to check.
+        :return: True when the table exists; otherwise, False.
+        """
+
+
+    @abstractmethod
+    def use_table(self, table_name):
+        """
+        Uses a table without checking that it exists, so no request is made
+        before the first read or write.
+
+        :param table_name: The name of the table.
+        """
+
+
+    @abstractmethod
+    def create_table(self, table_name):
+        """
+        Creates a table for interactions and uses it.
+
+        :param table_name: The name of the table to create.
+        """
+
+
+    @abstractmethod
+    def delete_table(self):
+        """
+        Deletes the table.
+        """
+
+
+    @abstractmethod
+    def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None):
+        """
+        Lazily reads the interactions by phone number.
+
+        :param phone: phone number.
+        :param newest_first: Yield the newest interaction first.
+        :param page_size: The number of items read at a time, where that applies.
+        :param limit: Stop after this many interactions.
+        :return: A generator of interactions by phone number.
+        """
+
+
+    @abstractmethod
+    def get_summary(self, phone):
+        """
+        Gets the rolling summary of a phone's conversation.
+
+        :param phone: phone number.
+        :return: The summary as {"summary": text, "through": timestamp of the last
+                 summarized interaction}, or None when there is none.
+        """
+
+
+    @abstractmethod
+    def put_summary(self, phone, summary, through):
+        """
+        Stores the rolling summary of a phone's conversation.
+
+        :param phone: phone number.
+        :param summary: The summary text.
+        :param through: The timestamp of the last summarized interaction.
+        """
+
+
+    @abstractmethod
+    def scan_all(self, segments=4, attributes=None, page_size=None):
+        """
+        Reads every interaction of every phone, in no particular order, without
+        holding more than a few pages of them in memory.
+
+        :param segments: The number of parts read in parallel, where that applies.
+        :param attributes: Optional attribute names to read; defaults to all.
+        :param page_size: The number of items read at a time, where that applies.
+        :return: A generator of interactions.
+        """
+
+
+    @abstractmethod
+    def _store(self, item):
+        """
+        Writes one interaction item.
+
+        :param item: The interaction, as built by add_interaction.
+        """
+
+
+    def add_interaction(self, phone, timestamp, received_message, sent_message, mentor_type, name, tokens=None):
+        """
+        Adds an interaction to the table.
+
+        :param phone: The phone number.
+        :param timestamp: timestamp of the interaction.
+        :param received_message: The message received.
+        :param sent_message: The message sent from AI.
+        :param mentor_type: Refugee/Local/AI
+        :param name: The name of the person.
+        :param tokens: Optional prompt tokens used by the two messages, stored so
+                       they are not counted again.
+        """
+        item = {
+            "phone": phone,
+            "timestamp": timestamp,
+            "received_message": received_message,
+            "sent_message": sent_message,
+            "mentor_type": mentor_type,
+            "name": name,
+        }
+        if tokens is not None:
+            item["tokens"] = tokens
+        self._store(item)
+        if self.cache is not None:
+            # Only extend conversations that are already cached; otherwise the
+            # next query reads this item from the table.
+            cached = self.cache.get(phone)
+            if cached is not None:
+                self.cache.set(phone, dict(cached, items=cached["items"] + [item]))
+
+
+    def query_interactions(self, phone):
+        """
+        Queries for all interactions by phone number, oldest first, following
+        every page of the query. When a cache is configured, the conversation is
+        served from it after the first query.
+
+        :param phone: phone number.
+        :return: The list of interactions by phone number.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(phone)
+            if cached is not None and cached["complete"]:
+                return list(cached["items"])
+        # Snapshot the unwritten items first, so an item written during the query is still seen
+        pending = self.write_behind.pending(phone) if self.write_behind is not None else []
+        items = self._with_pending(list(self.iter_interactions(phone)), pending)
+        if self.cache is not None:
+            self.cache.set(phone, {"items": items, "complete": True})
+        return items
+
+
+    def query_history(self, phone, limit):
+        """
+        Queries for the newest interactions by phone number. Only the requested
+        number of items is read, however long the conversation is.
+
+        :param phone: phone number.
+        :param limit: The maximum number of interactions to return.
+        :return: The newest interactions by phone number, oldest first.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(phone)
+            if cached is not None and (cached["complete"] or len(cached["items"]) >= limit):
+                return cached["items"][-limit:]
+        pending = self.write_behind.pending(phone) if self.write_behind is not None else []
+        items = list(self.iter_interactions(phone, newest_first=True, page_size=limit, limit=limit))
+        items.reverse()
+        complete = len(items) < limit
+        items = self._with_pending(items, pending)[-limit:]
+        if self.cache is not None:
+            self.cache.set(phone, {"items": items, "complete": complete})
+        return items
+
+
+    def query_context(self, phone, limit):
+        """
+        Reads what a reply is built from: the rolling summary of a phone's
+        conversation and the interactions it doesn't cover. With a summary,
+        that is every interaction after it, however many; without one, the
+        newest limit interactions. When a cache is configured, both are
+        served from it after the first read.
+
+        :param phone: phone number.
+        :param limit: The maximum number of interactions to return when there
+                      is no summary.
+        :return: The interactions, oldest first, and the summary as returned
+                 by get_summary.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(phone)
+            # Entries cached by query_history or query_interactions don't hold the summary
+            if cached is not None and "summary" in cached:
+                summary = cached["summary"]
+                items = cached["items"]
+                if summary is None and (cached["complete"] or len(items) >= limit):
+                    return items[-limit:], None
+                if summary is not None and (cached["complete"] or (items and items[0]["timestamp"] <= summary["through"])):
+                    return [item for item in items if item["timestamp"] > summary["through"]], summary
+        pending = self.write_behind.pending(phone) if self.write_behind is not None else []
+        turns = self.iter_interactions(phone, newest_first=True, page_size=limit)
+        # Start reading the turns first: the compact layout then takes the summary from the item it read
+        first = next(turns, None)
+        summary = self.get_summary(phone)
+        items = [first] if first is not None else []
+        complete = first is None
+        # Stop before reading further pages than needed
+        while items and not complete:
+            if (summary is None and len(items) >= limit) or (summary is not None and items[-1]["timestamp"] <= summary["through"]):
+                break
+            item = next(turns, None)
+            if item is None:
+                complete = True
+            else:
+                items.append(item)
+        items.reverse()
+        items = self._with_pending(items, pending)
+        if self.cache is not None:
+            # Keep the newest interaction the summary covers, so a cached entry shows it reaches the summary
+            self.cache.set(phone, {"items": items, "complete": complete, "summary": summary})
+        if summary is not None:
+            return [item for item in items if item["timestamp"] > summary["through"]], summary
+        return items[-limit:], None
+
+
+    def update_summary(self, phone, summary, through):
+        """
+        Stores the rolling summary of a phone's conversation, and updates the
+        cached conversation with it.
+
+        :param phone: phone number.
+        :param summary: The summary text.
+        :param through: The timestamp of the last summarized interaction.
+        """
+        self.put_summary(phone, summary, through)
+        if self.cache is not None:
+            cached = self.cache.get(phone)
+            if cached is not None:
+                self.cache.set(phone, dict(cached, summary={"summary": summary, "through": through}))
+
+
+    def _with_pending(self, items, pending):
+        # Adds interactions still waiting in the write-behind buffer
+        stored = {item["timestamp"] for item in items}
+        pending = [item for item in pending if item["timestamp"] not in stored]
+        if not pending:
+            return items
+        return sorted(items + pending, key=lambda item: item["timestamp"])
@@ -0,0 +1,23 @@
+import boto3
+import pytest
+
+from interactions import Interactions
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    """A Boto3 DynamoDB resource backed by moto."""
+    moto = pytest.importorskip("moto")
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        yield boto3.resource("dynamodb", region_name="us-east-1")
+
+
+@pytest.fixture
+def interactions(dynamodb):
+    """An Interactions object for a new, empty table."""
+    store = Interactions(dynamodb)
+    store.create_table("interactions")
+    return store
@@ -0,0 +1,120 @@
+import threading
+
+from coalescer import MessageCoalescer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+
+    def __call__(self):
+        return self.now
+
+
+class Dispatches:
+    def __init__(self, taken=True):
+        self.taken = taken
+        self.batches = []
+        self.event = threading.Event()
+
+
+    def __call__(self, phone, batch):
+        self.batches.append((phone, list(batch)))
+        self.event.set()
+        return self.taken
+
+
+def test_burst_is_dispatched_after_a_quiet_window():
+    clock = FakeClock()
+    coalescer = MessageCoalescer(Dispatches(), window=2, clock=clock)
+    coalescer.add("p1", "a")
+    clock.now = 1
+    coalescer.add("p1", "b")
+    coalescer.add("p2", "c")
+
+    assert coalescer._take_due(2.9, everything=False) == []
+    assert coalescer._take_due(3, everything=False) == [("p1", ["a", "b"]), ("p2", ["c"])]
+
+
+def test_burst_is_dispatched_after_max_wait():
+    clock = FakeClock()
+    coalescer = MessageCoalescer(Dispatches(), window=2, max_wait=3, clock=clock)
+    for now, message in ((0, "a"), (1.5, "b"), (2.9, "c")):
+        clock.now = now
+        coalescer.add("p1", message)
+
+    assert coalescer._take_due(3, everything=False) == [("p1", ["a", "b", "c"])]
+
+
+def test_messages_wait_while_the_phone_runs():
+    clock = FakeClock()
+    coalescer = MessageCoalescer(Dispatches(), window=2, clock=clock)
+    coalescer.add("p1", "a")
+    assert coalescer._take_due(2, everything=False) == [("p1", ["a"])]
+
+    clock.now = 3
+    coalescer.add("p1", "b")
+    assert coalescer._take_due(100, everything=False) == []
+
+    clock.now = 4
+    coalescer.finished("p1")
+    assert coalescer._take_due(5.9, everything=False) == []
+    assert coalescer._take_due(6, everything=False) == [("p1", ["b"])]
+    coalescer.finished("p1")
+    assert coalescer.phones == {}
+
+
+def test_thread_dispatches_a_burst_once():
+    dispatches = Dispatches()
+    coalescer = MessageCoalescer(dispatches, window=0.05)
+    coalescer.start()
+    try:
+        for message in ("a", "b", "c"):
+            coalescer.add("p1", message)
+        assert dispatches.event.wait(2)
+    finally:
+        coalescer.shutdown()
+
+    assert dispatches.batches == [("p1", ["a", "b", "c"])]
+
+
+def test_refused_batch_is_retried_after_a_window():
+    dispatches = Dispatches(taken=False)
+    coalescer = MessageCoalescer(dispatches, window=0.05)
+    coalescer.start()
+    try:
+        coalescer.add("p1", "a")
+        assert dispatches.event.wait(2)
+        dispatches.event.clear()
+        dispatches.taken = True
+        assert dispatches.event.wait(2)
+    finally:
+        coalescer.shutdown()
+
+    assert dispatches.batches == [("p1", ["a"]), ("p1", ["a"])]
+
+
+def test_shutdown_dispatches_buffered_messages_at_once():
+    dispatches = Dispatches()
+    coalescer = MessageCoalescer(dispatches, window=60)
+    coalescer.start()
+    coalescer.add("p1", "a")
+    coalescer.add("p2", "b")
+    coalescer.shutdown()
+
+    assert sorted(dispatches.batches) == [("p1", ["a"]), ("p2", ["b"])]
+
+
+def test_shutdown_drops_batches_that_are_not_taken():
+    dropped = []
+    coalescer = MessageCoalescer(
+        Dispatches(taken=False), window=60, on_drop=lambda phone, batch: dropped.append((phone, batch)),
+    )
+    coalescer.start()
+    coalescer.add("p1", "a")
+    coalescer.add("p1", "b")
+    coalescer.shutdown()
+
+    assert dropped == [("p1", ["a", "b"])]
+    assert coalescer.phones == {}
@@ -0,0 +1,71 @@
+import pytest
+
+import compact_interactions
+from compact_interactions import CompactInteractions, decode_turns, encode_turns
+
+TURNS = [
+    ("2024-01-01T10:00:00", "Hola, ¿cómo estás?", "Bien 😀", 42),
+    ("2024-01-01T10:01:00", "", "Empty messages survive too", None),
+    ("2024-01-01T10:02:00", "نعم", "日本語のテキスト", 7),
+]
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_transcript_round_trip(codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    transcript = encode_turns(TURNS, codec)
+
+    assert transcript[:1] == (b"s" if codec == "zstd" else b"z")
+    assert decode_turns(transcript) == [(*turn[:3], turn[3] or 0) for turn in TURNS]
+
+
+def test_empty_transcript_decodes_to_no_turns():
+    assert decode_turns(b"") == []
+    assert decode_turns(encode_turns([])) == []
+
+
+@pytest.fixture
+def compact(dynamodb, monkeypatch):
+    # Spill after a few turns rather than after 12 KB
+    monkeypatch.setattr(compact_interactions, "SEGMENT_BYTES", 200)
+    store = CompactInteractions(dynamodb)
+    store.create_table("interactions")
+    return store
+
+
+def message(index):
+    return f"message {index} " + "x" * 40
+
+
+def test_appended_turns_spill_into_segments(compact):
+    for index in range(20):
+        compact.add_interaction("p", f"t{index:03}", message(index), f"reply {index}", "refugee", "Ana", tokens=index)
+
+    conversation = compact._get_conversation("p")
+    segments = compact.table.scan(FilterExpression="begins_with(#ts, :prefix)",
+                                  ExpressionAttributeNames={"#ts": "timestamp"},
+                                  ExpressionAttributeValues={":prefix": compact_interactions.SEGMENT_PREFIX})["Items"]
+    assert int(conversation["turns"]) == 20
+    assert int(conversation["segments"]) == len(segments) > 0
+
+    oldest_first = list(compact.iter_interactions("p"))
+    assert [item["timestamp"] for item in oldest_first] == [f"t{index:03}" for index in range(20)]
+    assert oldest_first[3] == {
+        "phone": "p", "timestamp": "t003", "received_message": message(3), "sent_message": "reply 3",
+        "mentor_type": "refugee", "name": "Ana", "tokens": 3,
+    }
+    newest_first = [item["timestamp"] for item in compact.iter_interactions("p", newest_first=True, limit=5)]
+    assert newest_first == [f"t{index:03}" for index in range(19, 14, -1)]
+
+
+def test_put_conversation_matches_appended_turns(compact):
+    turns = [(f"t{index:03}", message(index), f"reply {index}", index) for index in range(20)]
+    assert compact.put_conversation("p", "refugee", "Ana", turns, {"summary": "so far", "through": "t009"})
+    assert not compact.put_conversation("p", "refugee", "Ana", turns)
+
+    assert int(compact._get_conversation("p")["segments"]) > 0
+    items = list(compact.iter_interactions("p"))
+    assert [(item["timestamp"], item["received_message"], item["sent_message"], item.get("tokens", 0))
+            for item in items] == turns
+    assert compact.get_summary("p") == {"summary": "so far", "through": "t009"}
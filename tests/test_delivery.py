@@ -0,0 +1,101 @@
+import pytest
+
+from delivery import DeliveryTracker
+
+
+class Completions:
+    def __init__(self):
+        self.calls = []
+
+
+    def __call__(self, record, succeeded, statuses):
+        self.calls.append((record, succeeded, statuses))
+
+
+@pytest.fixture(params=["local", "table"])
+def make_tracker(request):
+    # Trackers made by one call share their storage, like processes sharing a table
+    table = request.getfixturevalue("interactions").table if request.param == "table" else None
+    shared = {}
+
+    def make(on_complete, timeout=60):
+        tracker = DeliveryTracker(on_complete, table=table, timeout=timeout)
+        if table is None:
+            tracker.replies = shared.setdefault("replies", tracker.replies)
+            tracker.lock = shared.setdefault("lock", tracker.lock)
+        return tracker
+    return make
+
+
+def test_completes_once_every_chunk_is_terminal(make_tracker):
+    completions = Completions()
+    tracker = make_tracker(completions)
+    reply_id = tracker.begin()
+    tracker.track(reply_id, ["SM1", "SM2"], {"phone": "p"}, {"SM1": "queued"})
+
+    assert tracker.update(reply_id, "SM1", "delivered")
+    assert completions.calls == []
+    assert tracker.update(reply_id, "SM2", "read")
+
+    assert completions.calls == [({"phone": "p"}, True, {"SM1": "delivered", "SM2": "read"})]
+    assert tracker.pending() == 0
+
+
+def test_callbacks_before_track_are_kept(make_tracker):
+    completions = Completions()
+    tracker = make_tracker(completions)
+    reply_id = tracker.begin()
+    tracker.update(reply_id, "SM1", "delivered")
+    tracker.track(reply_id, ["SM1"], {"phone": "p"}, {"SM1": "queued"})
+
+    assert completions.calls == [({"phone": "p"}, True, {"SM1": "delivered"})]
+
+
+def test_terminal_status_is_never_left(make_tracker):
+    completions = Completions()
+    tracker = make_tracker(completions)
+    reply_id = tracker.begin()
+    tracker.track(reply_id, ["SM1", "SM2"], {"phone": "p"})
+    tracker.update(reply_id, "SM1", "undelivered")
+
+    assert not tracker.update(reply_id, "SM1", "sent")
+    tracker.update(reply_id, "SM2", "delivered")
+    assert completions.calls == [({"phone": "p"}, False, {"SM1": "undelivered", "SM2": "delivered"})]
+
+
+def test_only_one_tracker_completes_a_reply(make_tracker):
+    sender_completions, other_completions = Completions(), Completions()
+    sender = make_tracker(sender_completions)
+    other = make_tracker(other_completions)
+    reply_id = sender.begin()
+    sender.track(reply_id, ["SM1"], {"phone": "p"})
+
+    assert other.update(reply_id, "SM1", "delivered")
+    # The sender times the reply out later, and must not complete it again
+    assert sender.sweep(now=float("inf")) == 0
+    assert sender._finish(reply_id) is None
+
+    assert sender_completions.calls == []
+    assert other_completions.calls == [({"phone": "p"}, True, {"SM1": "delivered"})]
+
+
+def test_timed_out_reply_completes_with_last_statuses(make_tracker):
+    completions = Completions()
+    tracker = make_tracker(completions, timeout=0)
+    reply_id = tracker.begin()
+    tracker.track(reply_id, ["SM1", "SM2"], {"phone": "p"}, {"SM1": "sent"})
+
+    assert tracker.sweep(now=float("inf")) == 1
+    assert completions.calls == [({"phone": "p"}, False, {"SM1": "sent", "SM2": None})]
+    tracker.update(reply_id, "SM2", "delivered")
+    assert len(completions.calls) == 1
+
+
+def test_unknown_reply_or_sid_is_ignored(make_tracker):
+    completions = Completions()
+    tracker = make_tracker(completions)
+    reply_id = tracker.begin()
+    tracker.track(reply_id, ["SM1"], {"phone": "p"})
+
+    assert not tracker.update("unknown", "SM1", "delivered")
+    assert completions.calls == []
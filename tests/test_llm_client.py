@@ -0,0 +1,104 @@
+from llm_client import CircuitBreaker, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+
+    def __call__(self):
+        return self.now
+
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_rate_limiter_waits_for_the_request_quota():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100000, clock=clock, sleep=clock.sleep)
+
+    for _ in range(60):
+        assert limiter.acquire(10)
+    assert clock.now == 0
+    assert limiter.acquire(10)
+    assert clock.now == 1
+
+
+def test_rate_limiter_waits_for_the_token_quota():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=600, clock=clock, sleep=clock.sleep)
+
+    assert limiter.acquire(600)
+    assert limiter.acquire(300)
+    assert clock.now == 30
+
+
+def test_rate_limiter_gives_up_at_the_deadline():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=1, tokens_per_minute=1000, clock=clock, sleep=clock.sleep)
+
+    assert limiter.acquire(10)
+    assert not limiter.acquire(10, deadline=30)
+    assert clock.now == 0
+    assert limiter.acquire(10, deadline=60)
+
+
+def test_rate_limiter_caps_oversized_requests_at_the_quota():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=500, clock=clock, sleep=clock.sleep)
+
+    assert limiter.acquire(5000)
+    assert clock.now == 0
+
+
+def test_breaker_opens_after_consecutive_failures():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=clock)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_through_when_half_open():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+
+    clock.now = 29
+    assert not breaker.allow()
+    clock.now = 30
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens_the_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30, clock=clock)
+    for _ in range(5):
+        breaker.record_failure()
+
+    clock.now = 40
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    clock.now = 70
+    assert breaker.state == "half-open"
+    assert breaker.allow()
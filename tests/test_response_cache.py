@@ -0,0 +1,55 @@
+from cache import LRUCache
+from response_cache import ResponseCache, normalize
+
+PERSONA = {"role": "system", "content": "You are a mentor."}
+
+
+def make_cache():
+    return ResponseCache(LRUCache(max_size=100, ttl=60))
+
+
+def test_normalize_ignores_case_spacing_and_end_punctuation():
+    assert normalize("  How do I  open a BANK account?! ") == "how do i open a bank account"
+    assert normalize("Ｆｕｌｌｗｉｄｔｈ。") == "fullwidth"
+
+
+def test_same_question_in_the_same_context_shares_a_key():
+    responses = make_cache()
+    key = responses.key("+1", "local", "How do I find work?", [PERSONA], "gpt-4")
+
+    assert key.startswith("shared:")
+    assert responses.key("+2", "local", "how do i find work", [PERSONA], "gpt-4") == key
+    assert responses.key("+2", "refugee", "How do I find work?", [PERSONA], "gpt-4") != key
+    assert responses.key("+2", "local", "How do I find work?", [PERSONA], "gpt-3.5-turbo") != key
+    assert "find work" not in key and "+1" not in key
+
+
+def test_personal_data_keeps_answers_per_phone():
+    responses = make_cache()
+    for question in ("Mail me at ana@example.com", "Call +256 700 123 456", "See https://example.com/me"):
+        key = responses.key("+1", "local", question, [PERSONA], "gpt-4")
+        assert key.startswith("phone:")
+        assert key != responses.key("+2", "local", question, [PERSONA], "gpt-4")
+    assert responses.key("+1", "local", "Ana needs a job", [PERSONA], "gpt-4", name="Ana Lopez").startswith("phone:")
+    assert responses.key("+1", "local", "Banana bread?", [PERSONA], "gpt-4", name="Ana").startswith("shared:")
+
+
+def test_long_conversations_and_summaries_are_not_shared():
+    responses = make_cache()
+    turns = [PERSONA]
+    for index in range(2):
+        turns += [{"role": "user", "content": f"question {index}"}, {"role": "assistant", "content": "answer"}]
+    summary = [PERSONA, {"role": "system", "content": "Earlier they asked about housing."}]
+
+    assert not responses.shareable("next question", turns)
+    assert responses.shareable("next question", turns[:3])
+    assert not responses.shareable("next question", summary)
+
+
+def test_answers_round_trip():
+    responses = make_cache()
+    key = responses.key("+1", "local", "Hello?", [PERSONA], "gpt-4")
+
+    assert responses.get(key) is None
+    responses.set(key, "Hi there")
+    assert responses.get(key) == "Hi there"
@@ -0,0 +1,59 @@
+import pytest
+
+from segmenter import SentenceSegmenter, body_length, split_message
+
+
+def test_body_length_counts_utf16_code_units():
+    assert body_length("abc") == 3
+    assert body_length("é") == 1
+    assert body_length("😀") == 2
+    assert body_length("👍🏽") == 4
+
+
+def test_chunks_end_at_sentence_ends():
+    message = "One two. Three four five. Six."
+    assert list(split_message(message, 5)) == ["One two.", "Three four five.", "Six."]
+
+
+def test_decimals_and_repeated_punctuation_do_not_end_a_sentence():
+    message = "It costs 3.5 dollars?! Really."
+    assert list(split_message(message, 5)) == ["It costs 3.5 dollars?!", "Really."]
+
+
+@pytest.mark.parametrize("character", ["a", "é", "😀", "👍🏽", "🇫🇷", "👩‍👩‍👧"])
+def test_chunks_never_exceed_the_limit(character):
+    message = character * 500
+    chunks = list(split_message(message, 10, max_chars=64))
+
+    assert "".join(chunks) == message
+    assert all(0 < body_length(chunk) <= 64 for chunk in chunks)
+    # Every chunk holds whole characters, never half a surrogate pair or sequence
+    assert all(len(chunk) % len(character) == 0 for chunk in chunks)
+
+
+def test_long_sentence_is_cut_at_whitespace():
+    message = "word " * 40
+    chunks = list(split_message(message, 10, max_chars=32))
+
+    assert all(body_length(chunk) <= 32 for chunk in chunks)
+    assert all(chunk.split(" ") == ["word"] * len(chunk.split(" ")) for chunk in chunks)
+
+
+def test_streamed_chunks_match_split_message():
+    message = "Short start. Then a much longer sentence follows here. And one more! Done?"
+    segmenter = SentenceSegmenter(20, first_chunk_sz=5)
+    chunks = []
+    for index in range(0, len(message), 3):
+        chunks += segmenter.feed(message[index:index + 3])
+    chunks += segmenter.flush()
+
+    assert chunks[0] == "Short start."
+    assert " ".join(chunks) == message
+    assert chunks == ["Short start."] + list(split_message(message[len("Short start. "):], 20))
+
+
+def test_sentence_end_at_end_of_fragment_waits_for_more_text():
+    segmenter = SentenceSegmenter(1)
+    assert segmenter.feed("Version 3.") == []
+    assert segmenter.feed("5 is out. Next") == ["Version 3.5 is out."]
+    assert segmenter.flush() == ["Next"]
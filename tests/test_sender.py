@@ -0,0 +1,133 @@
+import types
+
+import pytest
+from twilio.base.exceptions import TwilioException
+
+import sender
+from sender import WhatsAppSender
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+
+
+    def monotonic(self):
+        return self.now
+
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeMessages:
+    """Twilio's messages resource. Every status fetch moves a chunk one step
+    along its path of statuses, "queued", "sent", "delivered" by default."""
+
+    def __init__(self, paths=None, fail_create_at=None):
+        self.paths = paths or {}
+        self.fail_create_at = fail_create_at
+        self.created = []
+        self.statuses = {}
+        self.steps = {}
+        # For each chunk, the status of the chunk before it when it was created
+        self.previous_at_create = []
+
+
+    def create(self, to, from_, body, status_callback=None):
+        index = len(self.created)
+        if index == self.fail_create_at:
+            raise TwilioException("rejected")
+        self.previous_at_create.append(self.statuses[f"SM{index - 1}"] if index else None)
+        sid = f"SM{index}"
+        self.created.append({"to": to, "body": body, "status_callback": status_callback})
+        self.steps[sid] = 0
+        self.statuses[sid] = self._path(index)[0]
+        return types.SimpleNamespace(sid=sid, status=self.statuses[sid])
+
+
+    def __call__(self, sid):
+        return types.SimpleNamespace(fetch=lambda: self._fetch(sid))
+
+
+    def _path(self, index):
+        return self.paths.get(index, ["queued", "sent", "delivered"])
+
+
+    def _fetch(self, sid):
+        path = self._path(int(sid[2:]))
+        self.steps[sid] = min(self.steps[sid] + 1, len(path) - 1)
+        self.statuses[sid] = path[self.steps[sid]]
+        return types.SimpleNamespace(status=self.statuses[sid])
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(sender, "time", fake)
+    return fake
+
+
+def make_sender(messages, **kwargs):
+    client = types.SimpleNamespace(messages=messages)
+    return WhatsAppSender(client, "whatsapp:+15550000000", **kwargs)
+
+
+def test_chunks_are_sent_in_order_once_the_previous_is_sent():
+    messages = FakeMessages()
+    result = make_sender(messages, max_in_flight=3).send("whatsapp:+1", ["one", "two", "three"])
+
+    assert result.succeeded and result.error is None
+    assert [message["body"] for message in messages.created] == ["one", "two", "three"]
+    assert result.sids == ["SM0", "SM1", "SM2"]
+    assert messages.previous_at_create == [None, "sent", "sent"]
+    assert result.statuses == {"SM0": "delivered", "SM1": "delivered", "SM2": "delivered"}
+
+
+def test_in_flight_chunks_are_capped():
+    messages = FakeMessages()
+    result = make_sender(messages, max_in_flight=1).send("whatsapp:+1", ["one", "two"])
+
+    assert result.succeeded
+    # With one chunk in flight, the first is delivered before the second goes out
+    assert messages.previous_at_create == [None, "delivered"]
+
+
+def test_failed_chunk_stops_the_reply():
+    messages = FakeMessages(paths={0: ["queued", "undelivered"]})
+    result = make_sender(messages).send("whatsapp:+1", ["one", "two"])
+
+    assert not result.succeeded
+    assert "SM0" in result.error and "undelivered" in result.error
+    assert len(messages.created) == 1
+
+
+def test_chunk_not_sent_in_time_stops_the_reply(fake_time):
+    messages = FakeMessages(paths={0: ["queued"]})
+    result = make_sender(messages, sent_timeout=5).send("whatsapp:+1", ["one", "two"])
+
+    assert not result.succeeded
+    assert "was not sent within 5s" in result.error
+    assert len(messages.created) == 1
+    assert fake_time.now <= 5
+
+
+def test_failed_create_stops_the_reply():
+    messages = FakeMessages(fail_create_at=1)
+    result = make_sender(messages).send("whatsapp:+1", ["one", "two", "three"])
+
+    assert not result.succeeded
+    assert result.error.startswith("sending response message 2 failed")
+    assert result.sids == ["SM0"]
+
+
+def test_status_callback_leaves_delivery_to_the_callbacks():
+    messages = FakeMessages()
+    result = make_sender(messages, status_callback="https://example.com/status?reply=r").send(
+        "whatsapp:+1", ["one", "two"]
+    )
+
+    assert result.succeeded
+    assert all(message["status_callback"] == "https://example.com/status?reply=r" for message in messages.created)
+    assert messages.previous_at_create == [None, "sent"]
+    assert result.statuses == {"SM0": "sent", "SM1": "queued"}
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from memory_interactions import MemoryInteractions
+from sqlite_interactions import SqliteInteractions
+from storage import InteractionStore
+
+
+def test_backend_must_implement_the_whole_interface():
+    class NoSummaries(InteractionStore):
+        def exists(self, table_name): return True
+        def use_table(self, table_name): pass
+        def create_table(self, table_name): pass
+        def delete_table(self): pass
+        def iter_interactions(self, phone, newest_first=False, page_size=None, limit=None): return iter(())
+        def scan_all(self, segments=4, attributes=None, page_size=None): return iter(())
+        def _store(self, item): pass
+
+    with pytest.raises(TypeError, match="get_summary"):
+        NoSummaries()
+    with pytest.raises(TypeError):
+        InteractionStore()
+
+
+@pytest.mark.parametrize("path", [":memory:", ""])
+def test_sqlite_refuses_in_memory_databases(path):
+    with pytest.raises(ValueError):
+        SqliteInteractions(path)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    store = MemoryInteractions() if request.param == "memory" else SqliteInteractions(str(tmp_path / "test.db"))
+    store.create_table("interactions")
+    return store
+
+
+def test_interactions_and_summaries_round_trip(store):
+    for index in range(5):
+        store.add_interaction("p", f"t{index}", f"question {index}", f"answer {index}", "local", "Ana")
+    store.update_summary("p", "Asked about work.", "t2")
+
+    items, summary = store.query_context("p", 10)
+    assert [item["timestamp"] for item in items] == ["t3", "t4"]
+    assert summary == {"summary": "Asked about work.", "through": "t2"}
+    assert [item["timestamp"] for item in store.query_history("p", 2)] == ["t3", "t4"]
+
+
+def test_sqlite_threads_share_the_database(tmp_path):
+    store = SqliteInteractions(str(tmp_path / "test.db"))
+    store.create_table("interactions")
+    threads = [
+        threading.Thread(target=store.add_interaction, args=("p", f"t{index}", "q", "a", "local", "Ana"))
+        for index in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(list(store.iter_interactions("p"))) == 4
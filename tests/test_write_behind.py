@@ -0,0 +1,124 @@
+import logging
+
+from botocore.exceptions import ClientError
+
+from write_behind import WriteBehindBuffer
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "BatchWriteItem")
+
+
+class FakeTable:
+    def __init__(self, resource):
+        self.resource = resource
+
+
+    def put_item(self, Item):
+        if Item.get("bad"):
+            raise client_error("ValidationException")
+        self.resource.written.append(Item)
+
+
+class FakeResource:
+    """Answers BatchWriteItem calls from a script of responses and errors,
+    then writes everything."""
+
+    def __init__(self, script=()):
+        self.script = list(script)
+        self.calls = []
+        self.written = []
+
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems["interactions"]
+        self.calls.append([request["PutRequest"]["Item"] for request in requests])
+        outcome = self.script.pop(0) if self.script else "ok"
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome == "unprocessed":
+            self.written += [request["PutRequest"]["Item"] for request in requests[1:]]
+            return {"UnprocessedItems": {"interactions": requests[:1]}}
+        self.written += [request["PutRequest"]["Item"] for request in requests]
+        return {"UnprocessedItems": {}}
+
+
+    def Table(self, name):
+        return FakeTable(self)
+
+
+def item(index, **attributes):
+    return dict({"phone": "p", "timestamp": f"t{index:03}"}, **attributes)
+
+
+def make_buffer(resource, **kwargs):
+    return WriteBehindBuffer(resource, "interactions", base_delay=0, **kwargs)
+
+
+def test_unprocessed_items_and_throttling_are_retried():
+    resource = FakeResource(["unprocessed", client_error("ProvisionedThroughputExceededException")])
+    buffer = make_buffer(resource)
+    for index in range(3):
+        buffer.put(item(index))
+
+    assert buffer.flush()
+    assert sorted(written["timestamp"] for written in resource.written) == ["t000", "t001", "t002"]
+    assert [len(call) for call in resource.calls] == [3, 1, 1]
+    assert buffer.pending("p") == []
+
+
+def test_items_stay_pending_when_retries_run_out():
+    resource = FakeResource([client_error("ThrottlingException")] * 3)
+    buffer = make_buffer(resource, max_retries=2)
+    buffer.put(item(0))
+
+    assert not buffer.flush()
+    assert buffer.pending("p") == [item(0)]
+    assert buffer.flush()
+    assert resource.written == [item(0)]
+
+
+def test_rejected_batch_dead_letters_only_the_bad_item(caplog):
+    resource = FakeResource([client_error("ValidationException")])
+    buffer = make_buffer(resource)
+    buffer.put(item(0))
+    buffer.put(item(1, bad=True))
+    buffer.put(item(2))
+
+    with caplog.at_level(logging.ERROR):
+        assert buffer.flush()
+    assert resource.written == [item(0), item(2)]
+    dropped = [record.getMessage() for record in caplog.records if "Dropped" in record.getMessage()]
+    assert len(dropped) == 1
+    assert "p/t001" in dropped[0] and '"bad": true' in dropped[0]
+
+
+def test_full_buffer_dead_letters_the_oldest_item(caplog):
+    buffer = make_buffer(FakeResource(), max_buffer=2)
+    with caplog.at_level(logging.ERROR):
+        for index in range(3):
+            buffer.put(item(index))
+
+    assert buffer.pending("p") == [item(1), item(2)]
+    assert any("p/t000" in record.getMessage() and "BufferFull" in record.getMessage() for record in caplog.records)
+
+
+def test_batches_hold_each_key_once():
+    resource = FakeResource()
+    buffer = make_buffer(resource)
+    buffer.put(item(0, text="old"))
+    buffer.put(item(0, text="new"))
+
+    assert buffer.flush()
+    assert resource.calls == [[item(0, text="new")]]
+
+
+def test_shutdown_writes_to_dynamodb(interactions):
+    buffer = WriteBehindBuffer(interactions.dyn_resource, interactions.table.name, flush_interval=60)
+    buffer.start()
+    for index in range(30):
+        buffer.put(item(index, text="hi"))
+    buffer.shutdown()
+
+    assert interactions.table.scan(Select="COUNT")["Count"] == 30
+    assert buffer.pending("p") == []
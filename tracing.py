@@ -0,0 +1,60 @@
+import contextvars
+import json
+import logging
+import time
+import uuid
+
+# The trace ID of the message being handled by the current thread or request
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+def new_trace_id(message_sid=None):
+    """
+    :param message_sid: The Twilio MessageSid, used as the trace ID so logs
+                        line up with Twilio's console.
+    :return: A trace ID.
+    """
+    return message_sid or uuid.uuid4().hex
+
+
+def set_trace_id(trace_id):
+    """
+    Makes trace_id the current trace ID.
+
+    :return: A token for reset_trace_id.
+    """
+    return _trace_id.set(trace_id)
+
+
+def reset_trace_id(token):
+    """
+    Restores the trace ID that was current before set_trace_id.
+    """
+    _trace_id.reset(token)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace ID to every log record as record.trace_id."""
+
+    def filter(self, record):
+        record.trace_id = _trace_id.get() or "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line, including the trace ID."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", None) or _trace_id.get(),
+            "message": record.getMessage(),
+        }
+        for key in ("stage", "seconds", "phone"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
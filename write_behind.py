@@ -0,0 +1,209 @@
+import json
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+# The most items DynamoDB accepts in one BatchWriteItem call
+MAX_BATCH = 25
+
+# Errors worth retrying; any other error means DynamoDB rejects the items as
+# they are, and retrying them would only block the items behind them
+RETRYABLE_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+    "ServiceUnavailable",
+}
+
+
+class WriteBehindBuffer:
+    """Buffers interaction items and writes them to DynamoDB in batches.
+
+    Items are written with BatchWriteItem once a full batch is buffered or the
+    flush interval has passed, whichever comes first. UnprocessedItems,
+    throttling and transient errors are retried with exponential backoff.
+    When DynamoDB rejects a batch outright, its items are written one by one,
+    and the ones it still rejects are dropped and logged in full, so a bad
+    item can't hold up the buffer. Until an item is written, pending returns
+    it so reads can include it. The buffer holds at most max_buffer items;
+    past that the oldest are dropped the same way.
+
+    Example:
+        buffer = WriteBehindBuffer(dynamodb, "Interactions")
+        buffer.start()
+        buffer.put(item)
+        buffer.shutdown()
+    """
+
+    def __init__(self, dyn_resource, table_name, batch_size=MAX_BATCH, flush_interval=1.0,
+                 max_retries=8, base_delay=0.05, max_buffer=10000, logger=None):
+        """
+        :param dyn_resource: A Boto3 DynamoDB resource.
+        :param table_name: The table the items are written to.
+        :param batch_size: Items written per BatchWriteItem call, at most 25.
+        :param flush_interval: Seconds an item may wait for a full batch.
+        :param max_retries: Retries for UnprocessedItems before the batch is put back.
+        :param base_delay: Backoff before the first retry, doubled for each retry.
+        :param max_buffer: Most items buffered at once, for when DynamoDB is
+                           unavailable for a while.
+        :param logger: Logger used to report write errors.
+        """
+        self.dyn_resource = dyn_resource
+        self.table_name = table_name
+        self.batch_size = min(batch_size, MAX_BATCH)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_buffer = max_buffer
+        self.logger = logger or logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        self.buffer = []
+        self.inflight = []
+        self.thread = None
+        self.stopping = False
+
+
+    def start(self):
+        """
+        Starts the thread that flushes the buffer.
+        """
+        if self.thread is None:
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self.thread.start()
+
+
+    def put(self, item):
+        """
+        Buffers an item for writing.
+
+        :param item: The item, with the table's key attributes.
+        """
+        with self.condition:
+            if len(self.buffer) >= self.max_buffer:
+                self._dead_letter(self.buffer.pop(0), "BufferFull", f"the buffer already holds {self.max_buffer} items")
+            self.buffer.append(item)
+            if len(self.buffer) >= self.batch_size:
+                self.condition.notify()
+
+
+    def pending(self, phone):
+        """
+        :param phone: phone number.
+        :return: The items of the phone that are not written yet, oldest first.
+        """
+        with self.condition:
+            return [item for item in self.inflight + self.buffer if item["phone"] == phone]
+
+
+    def flush(self):
+        """
+        Writes every buffered item now.
+
+        :return: True when everything was written.
+        """
+        while True:
+            with self.condition:
+                if not self.buffer:
+                    return True
+                batch = self.buffer[:self.batch_size]
+                del self.buffer[:self.batch_size]
+                self.inflight = batch
+            unwritten = self._write(batch)
+            with self.condition:
+                self.inflight = []
+                if unwritten:
+                    # Keep the items visible and try them again on the next flush
+                    self.buffer[:0] = unwritten
+                    return False
+
+
+    def shutdown(self):
+        """
+        Stops the flushing thread and writes whatever is still buffered.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if not self.flush():
+            with self.condition:
+                self.logger.error("Lost %s buffered interactions at shutdown", len(self.buffer))
+
+
+    def _write(self, batch):
+        # Writes a batch, and returns the items to try again later
+        # DynamoDB rejects a batch that writes the same key twice; keep the last
+        unique = {(item["phone"], item["timestamp"]): item for item in batch}
+        requests = [{"PutRequest": {"Item": item}} for item in unique.values()]
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.dyn_resource.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as err:
+                self.logger.error(
+                    "Couldn't write %s interactions to %s. Here's why: %s: %s",
+                    len(requests),
+                    self.table_name,
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                if err.response["Error"]["Code"] not in RETRYABLE_ERRORS:
+                    # One bad item fails the whole batch; find it by writing them one by one
+                    return self._write_each([request["PutRequest"]["Item"] for request in requests])
+            except BotoCoreError as err:
+                self.logger.error(
+                    "Couldn't write %s interactions to %s. Here's why: %s", len(requests), self.table_name, err
+                )
+            else:
+                requests = response.get("UnprocessedItems", {}).get(self.table_name, [])
+                if not requests:
+                    return []
+            time.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+        self.logger.error("Gave up writing %s interactions to %s for now", len(requests), self.table_name)
+        return [request["PutRequest"]["Item"] for request in requests]
+
+
+    def _write_each(self, items):
+        # Writes items one at a time, dropping the ones DynamoDB rejects, and
+        # returns the items to try again later
+        table = self.dyn_resource.Table(self.table_name)
+        unwritten = []
+        for item in items:
+            try:
+                table.put_item(Item=item)
+            except ClientError as err:
+                if err.response["Error"]["Code"] in RETRYABLE_ERRORS:
+                    unwritten.append(item)
+                else:
+                    self._dead_letter(item, err.response["Error"]["Code"], err.response["Error"]["Message"])
+            except BotoCoreError:
+                unwritten.append(item)
+        return unwritten
+
+
+    def _dead_letter(self, item, code, message):
+        # The log line is the only copy of the item left, so it carries all of it
+        self.logger.error(
+            "Dropped the interaction %s/%s. Here's why: %s: %s. Item: %s",
+            item["phone"],
+            item["timestamp"],
+            code,
+            message,
+            json.dumps(item, default=str),
+        )
+
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.stopping and len(self.buffer) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                if self.stopping:
+                    return
+            self.flush()